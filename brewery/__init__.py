@@ -13,6 +13,8 @@ __version__ = '0.8.0'
 
 from metadata import *
 from streams import *
+from metrics import *
+from aggregates import *
 from utils import *
 
 __all__ = [
@@ -24,3 +26,5 @@ __all__ = [
 
 __all__ += metadata.__all__
 __all__ += streams.__all__
+__all__ += metrics.__all__
+__all__ += aggregates.__all__
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Aggregate functions used by the aggregate node and by data sources that aggregate rows"""
+
+__all__ = [
+    "AggregateFunction",
+    "DEFAULT_AGGREGATIONS",
+    "aggregate_function",
+    "register_aggregate_function",
+    "aggregate_function_names"
+]
+
+# Aggregations of measures without explicitly requested aggregations
+DEFAULT_AGGREGATIONS = ("sum", "min", "max", "average")
+
+_functions = {}
+
+class AggregateFunction(object):
+    """Aggregate function computed from values of a field in a group of rows. The function does
+    not keep any data itself: there is a state for each group, which is created by
+    :meth:`initial_state`, updated by :meth:`aggregate` and converted to result by
+    :meth:`result`. States of two parts of a group can be merged by :meth:`merge`, therefore
+    groups might be aggregated in parts, such as in partitions or in separate runs.
+
+    Empty values (``None``) are not aggregated, as in SQL. Function of a group without any
+    values returns ``None`` (count functions return 0).
+
+    States should be picklable, as they are stored in checkpoints and temporary files.
+
+    :Attributes:
+        * `name`: name of the function, used in names of aggregated fields
+        * `storage_type`: storage type of the result or ``None`` if it is the same as type of the
+          aggregated field
+    """
+
+    name = None
+    storage_type = None
+
+    def initial_state(self):
+        """Return state of a group without any values. Default is ``None``."""
+        return None
+
+    def aggregate(self, state, value):
+        """Return `state` updated with `value`. `value` is never ``None``. Mutable states might
+        be modified in place and returned."""
+        raise NotImplementedError("Subclasses of AggregateFunction should implement aggregate()")
+
+    def merge(self, state, other):
+        """Return state of group values from both `state` and `other`. Values of `other` come
+        after values of `state` in the input."""
+        raise NotImplementedError("Subclasses of AggregateFunction should implement merge()")
+
+    def result(self, state):
+        """Return aggregated value of `state`. Default returns the state."""
+        return state
+
+def register_aggregate_function(function, name=None):
+    """Make aggregate `function` (:class:`AggregateFunction` instance) available by `name`,
+    default is name of the function. Registered functions can be used in aggregations of the
+    aggregate node."""
+    _functions[name or function.name] = function
+
+def aggregate_function(name):
+    """Return aggregate function registered as `name`. Raises `ValueError` for unknown
+    functions."""
+    try:
+        return _functions[name]
+    except KeyError:
+        raise ValueError("Unknown aggregate function '%s'" % name)
+
+def aggregate_function_names():
+    """Return sorted list of names of registered aggregate functions."""
+    return sorted(_functions.keys())
+
+class _Count(AggregateFunction):
+    name = "count"
+    storage_type = "integer"
+
+    def initial_state(self):
+        return 0
+
+    def aggregate(self, state, value):
+        return state + 1
+
+    def merge(self, state, other):
+        return state + other
+
+class _Sum(AggregateFunction):
+    name = "sum"
+
+    def aggregate(self, state, value):
+        if state is None:
+            return value
+        return state + value
+
+    def merge(self, state, other):
+        if state is None:
+            return other
+        if other is None:
+            return state
+        return state + other
+
+class _Min(AggregateFunction):
+    name = "min"
+
+    def aggregate(self, state, value):
+        if state is None or value < state:
+            return value
+        return state
+
+    def merge(self, state, other):
+        if other is None:
+            return state
+        return self.aggregate(state, other)
+
+class _Max(AggregateFunction):
+    name = "max"
+
+    def aggregate(self, state, value):
+        if state is None or value > state:
+            return value
+        return state
+
+    def merge(self, state, other):
+        if other is None:
+            return state
+        return self.aggregate(state, other)
+
+class _Average(AggregateFunction):
+    """State is list [`sum`, `count`]."""
+    name = "average"
+    storage_type = "float"
+
+    def aggregate(self, state, value):
+        if state is None:
+            return [value, 1]
+        state[0] += value
+        state[1] += 1
+        return state
+
+    def merge(self, state, other):
+        if state is None:
+            return other
+        if other is None:
+            return state
+        return [state[0] + other[0], state[1] + other[1]]
+
+    def result(self, state):
+        if state is None:
+            return None
+        return float(state[0]) / state[1]
+
+class _CountDistinct(AggregateFunction):
+    """State is set of values."""
+    name = "count_distinct"
+    storage_type = "integer"
+
+    def initial_state(self):
+        return set()
+
+    def aggregate(self, state, value):
+        state.add(value)
+        return state
+
+    def merge(self, state, other):
+        return state | other
+
+    def result(self, state):
+        return len(state)
+
+class _First(AggregateFunction):
+    name = "first"
+
+    def aggregate(self, state, value):
+        if state is None:
+            return value
+        return state
+
+    def merge(self, state, other):
+        if state is None:
+            return other
+        return state
+
+class _Last(AggregateFunction):
+    name = "last"
+
+    def aggregate(self, state, value):
+        return value
+
+    def merge(self, state, other):
+        if other is None:
+            return state
+        return other
+
+class _Variance(AggregateFunction):
+    """Sample variance. State is list [`count`, `mean`, `sum of squared differences from the
+    mean`], updated by Welford's method."""
+    name = "variance"
+    storage_type = "float"
+
+    def aggregate(self, state, value):
+        if state is None:
+            return [1, float(value), 0.0]
+        state[0] += 1
+        delta = value - state[1]
+        state[1] += delta / state[0]
+        state[2] += delta * (value - state[1])
+        return state
+
+    def merge(self, state, other):
+        if state is None:
+            return other
+        if other is None:
+            return state
+        count = state[0] + other[0]
+        delta = other[1] - state[1]
+        mean = state[1] + delta * other[0] / count
+        squares = state[2] + other[2] + delta * delta * state[0] * other[0] / count
+        return [count, mean, squares]
+
+    def result(self, state):
+        if state is None or state[0] < 2:
+            return None
+        return state[2] / (state[0] - 1)
+
+for _function in [_Count(), _Sum(), _Min(), _Max(), _Average(), _CountDistinct(), _First(),
+                  _Last(), _Variance()]:
+    register_aggregate_function(_function)
+
+register_aggregate_function(_functions["average"], "avg")
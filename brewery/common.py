@@ -1,5 +1,6 @@
 import StringIO
 import traceback
+import sys
 
 __all__ = [
     "FieldError",
@@ -22,7 +23,7 @@ class StreamRuntimeError(Exception):
         * `message`: exception message
         * `node`: node where exception was raised
         * `exception`: exception that was raised while running the node
-        * `traceback`: stack traceback
+        * `traceback`: stack traceback (string if the node was run in another process)
         * `inputs`: array of field lists for each input
         * `output`: output field list
     """
@@ -60,8 +61,12 @@ class StreamRuntimeError(Exception):
         text += "\ntraceback\n"
 
         try:
-            l = traceback.format_list(traceback.extract_tb(self.traceback))
-            text += "".join(l)
+            if isinstance(self.traceback, basestring):
+                # Traceback formatted in another process
+                text += self.traceback
+            else:
+                l = traceback.format_list(traceback.extract_tb(self.traceback))
+                text += "".join(l)
         except Exception as e:
             text += "<unable to get traceback string: %s>" % e
 
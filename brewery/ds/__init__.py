@@ -19,6 +19,8 @@ __all__ = (
     "DataStream",
     "DataSource",
     "DataTarget",
+    "aggregated_fields",
+    "measure_aggregations",
 
     "CSVDataSource",
     "CSVDataTarget",
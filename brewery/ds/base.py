@@ -22,10 +22,19 @@
 # Optional (for performance):
 # * append_row(row) - row is tuple of values, raises exception if there are more values than fields
 # * append_record(record) - record is a dictionary, raises exception if dict key is not in field list
+#
+# Optional (for stream checkpoints):
+# * sources: position() and seek(position)
+# * targets: commit() and resume(position)
+#
+# Optional (for filtering in the data store):
+# * sources: push_filter(conditions), prune_fields(names) and push_aggregation(keys, measures)
 
 import urllib2
 import urlparse
 import brewery.dq
+import brewery.metadata
+import brewery.aggregates
 import copy
 
 def open_resource(resource, mode = None):
@@ -55,6 +64,46 @@ def open_resource(resource, mode = None):
         handle = resource
 
     return (handle, should_close)
+
+def measure_aggregations(measures):
+    """Return list of tuples (`field`, `aggregations`) for `measures` - list of field names,
+    which are aggregated by :data:`brewery.aggregates.DEFAULT_AGGREGATIONS`, or tuples
+    (`field`, `aggregations`) where `aggregations` is a list of aggregate function names."""
+
+    result = []
+    for measure in measures:
+        if isinstance(measure, basestring):
+            result.append((measure, list(brewery.aggregates.DEFAULT_AGGREGATIONS)))
+        else:
+            (field, aggregations) = measure
+            result.append((field, list(aggregations)))
+    return result
+
+def aggregated_fields(fields, keys, measures, count_field="record_count"):
+    """Return :class:`brewery.metadata.FieldList` of aggregated rows: fields `keys` from `fields`
+    followed by aggregations of each of `measures` (see :func:`measure_aggregations`) named
+    `field_aggregation` and record count field `count_field`. Storage type of an aggregation is
+    the type of the aggregate function result or the type of the aggregated field."""
+
+    result = brewery.metadata.FieldList()
+
+    if keys:
+        for field in fields.fields(keys):
+            result.append(field)
+
+    for (measure, aggregations) in measure_aggregations(measures):
+        field_type = fields.field(measure).storage_type
+        for aggregation in aggregations:
+            function = brewery.aggregates.aggregate_function(aggregation)
+            result.append(brewery.metadata.Field(measure + "_" + aggregation,
+                                                 storage_type=function.storage_type or field_type,
+                                                 analytical_type="range"))
+
+    result.append(brewery.metadata.Field(count_field, storage_type="integer",
+                                         analytical_type="range"))
+
+    return result
+
 class DataStream(object):
     """Shared methods for data targets and data sources"""
     
@@ -141,6 +190,65 @@ class DataSource(DataStream):
         """
         raise NotImplementedError()
 
+    def position(self):
+        """Return read position - a picklable object that can be passed to :meth:`seek` to
+        continue reading after the data that were read so far. Used for stream checkpoints.
+        Subclasses might implement this method.
+        """
+        raise NotImplementedError()
+
+    def seek(self, position):
+        """Continue reading from `position` returned by :meth:`position`. Called after
+        `initialize()` and before reading any data. Subclasses might implement this method.
+        """
+        raise NotImplementedError()
+
+    def push_filter(self, conditions):
+        """Read only rows matching all `conditions`. Conditions are tuples (`field`, `operator`,
+        `value`) where operator is one of ``==``, ``!=``, ``<``, ``<=``, ``>``, ``>=``, ``in`` and
+        ``not in`` (`value` is a list for the last two). Rows have to match as if the condition
+        was evaluated in Python, including ``None`` values. Called after `initialize()` and
+        before reading any data, might be called more than once.
+
+        Returns ``True`` if the source will filter the rows, ``False`` if it can not filter by
+        all of the conditions - then no condition is applied. Default implementation returns
+        ``False``.
+        """
+        return False
+
+    def prune_fields(self, names):
+        """Read only fields with `names` (any collection of field names), values of other fields
+        should not be read or converted at all. Names of fields that the source does not provide
+        are ignored. Called after `initialize()` and before reading any data.
+
+        Returns ``True`` if `fields` were reduced to the fields from `names`, in their original
+        order. Default implementation does nothing and returns ``False``.
+        """
+        return False
+
+    def push_aggregation(self, keys, measures, count_field="record_count"):
+        """Read aggregated rows instead of the source rows: rows grouped by fields `keys`, with
+        aggregations of each of `measures` (see :func:`measure_aggregations`) and number of rows
+        as `count_field`, in order of the first row of each group. Empty values are not
+        aggregated, see :class:`brewery.aggregates.AggregateFunction`. `fields` are set as
+        returned by :func:`aggregated_fields`. Called after `initialize()`, :meth:`push_filter`
+        and :meth:`prune_fields` and before reading any data.
+
+        Returns ``True`` if the source will read aggregated rows, ``False`` if it can not compute
+        all of the aggregations. Default implementation returns ``False``.
+        """
+        return False
+
+    def size_hint(self):
+        """Return estimated number of rows the source will read, so nodes processing more inputs
+        can decide which input is smaller. Called after `initialize()`, :meth:`push_filter` and
+        :meth:`push_aggregation`. The estimate does not have to be exact, but it should be cheap
+        compared to reading the data.
+
+        Returns ``None`` if the number is not known - this is the default implementation.
+        """
+        return None
+
     def read_fields(self, limit = 0, collapse = False):
         """Read field descriptions from data source. You should use this for datasets that do not
         provide metadata directly, such as CSV files, document bases databases or directories with
@@ -224,4 +332,26 @@ class DataTarget(DataStream):
         if dict is used, the keys should be valid field names.        
         """
         raise NotImplementedError()
+
+    def commit(self):
+        """Make all appended objects durable and return position of the committed output - a
+        picklable object that can be passed to :meth:`resume`. Used for stream checkpoints.
+        Subclasses might implement this method.
+        """
+        raise NotImplementedError()
+
+    def resume(self, position):
+        """Continue writing after output committed at `position` returned by :meth:`commit`,
+        output written after the commit is discarded. Called before `initialize()`, which then
+        should not start a new output (truncate, write headers, create tables). Subclasses might
+        implement this method.
+        """
+        raise NotImplementedError()
+
+    def rollback(self):
+        """Discard objects appended after the last :meth:`commit`, if the target can do it.
+        Called before `finalize()` when the stream failed, so the output is not written twice
+        when the stream is resumed. Default implementation does nothing.
+        """
+        pass
      
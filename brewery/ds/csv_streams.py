@@ -3,10 +3,14 @@
 
 import csv
 import codecs
+import os
 import cStringIO
 import base
 import brewery.metadata
 
+# Number of bytes read from beginning of a file to estimate number of rows
+SIZE_SAMPLE_BYTES = 65536
+
 class UTF8Recoder(object):
     """
     Iterator that reads an encoded stream and reencodes the input to UTF-8
@@ -51,14 +55,24 @@ class UnicodeReader:
         self.reader = csv.reader(f, dialect=dialect, **kwds)
         self.converters = []
         self.empty_as_null = empty_as_null
+        self.row_count = 0
+        self.indexes = None
 
-    def set_fields(self, fields):
+    def set_fields(self, fields, indexes=None):
+        """Set `fields` of read rows. If `indexes` of columns are specified, then only these
+        columns are converted and returned."""
         self.converters = [storage_conversion[f.storage_type] for f in fields]
+        self.indexes = indexes
 
     def next(self):
         row = self.reader.next()
+        self.row_count += 1
         result = []
 
+        if self.indexes is not None:
+            length = len(row)
+            row = [row[i] if i < length else "" for i in self.indexes]
+
         # FIXME: make this nicer, this is just quick hack
         for i, value in enumerate(row):
             if self.converters:
@@ -167,6 +181,7 @@ class CSVDataSource(base.DataSource):
         self.close_file = False
         self.skip_rows = skip_rows
         self.fields = fields
+        self._first_row = 0
         
     def initialize(self):
         """Initialize CSV source stream:
@@ -234,11 +249,50 @@ class CSVDataSource(base.DataSource):
                 self.fields = brewery.metadata.FieldList(fields)
             
         self.reader.set_fields(self.fields)
+        self._first_row = self.reader.row_count
         
     def finalize(self):
         if self.file and self.close_file:
             self.file.close()
 
+    def position(self):
+        """Return number of data rows read."""
+        return self.reader.row_count - self._first_row
+
+    def seek(self, position):
+        """Skip rows up to `position` - number of data rows."""
+        for i in range(position - self.position()):
+            self.reader.next()
+
+    def prune_fields(self, names):
+        """Read only fields with `names`, other columns are not converted."""
+        selected = [(i, field) for (i, field) in enumerate(self.fields.fields())
+                                                        if field.name in names]
+        self.fields = brewery.metadata.FieldList([field for (i, field) in selected])
+        self.reader.set_fields(self.fields, [i for (i, field) in selected])
+        return True
+
+    def size_hint(self):
+        """Estimate number of data rows from size of the file and number of lines in its first
+        `SIZE_SAMPLE_BYTES` bytes. Values with line breaks are not taken into account. Returns
+        ``None`` if the resource is not a local file."""
+
+        path = getattr(self.file, "name", None)
+        if not isinstance(path, basestring) or not os.path.isfile(path):
+            return None
+
+        size = os.path.getsize(path)
+        with open(path, "rb") as handle:
+            sample = handle.read(SIZE_SAMPLE_BYTES)
+
+        lines = sample.count("\n")
+        if len(sample) < size and lines:
+            lines = size * lines // len(sample)
+        elif sample and not sample.endswith("\n"):
+            lines += 1
+
+        return max(lines - self._first_row, 0)
+
     def rows(self):
         if not self.reader:
             raise RuntimeError("Stream is not initialized")
@@ -273,16 +327,22 @@ class CSVDataTarget(base.DataTarget):
 
         self.close_file = False
         self.file = None
+        self._resume_position = None
         
     def initialize(self):
-        mode = "w" if self.truncate else "a"
-
-        self.file, self.close_file = base.open_resource(self.resource, mode)
+        if self._resume_position is not None:
+            self.file, self.close_file = base.open_resource(self.resource, "r+b")
+            # Discard rows written after the commit
+            self.file.seek(self._resume_position)
+            self.file.truncate()
+        else:
+            mode = "w" if self.truncate else "a"
+            self.file, self.close_file = base.open_resource(self.resource, mode)
 
         self.writer = UnicodeWriter(self.file, encoding = self.encoding, 
                                     dialect = self.dialect, **self.kwds)
         
-        if self.write_headers:
+        if self.write_headers and self._resume_position is None:
             self.writer.writerow(self.fields.names())
 
         self.field_names = self.fields.names()
@@ -291,6 +351,17 @@ class CSVDataTarget(base.DataTarget):
         if self.file and self.close_file:
             self.file.close()
 
+    def commit(self):
+        """Flush written rows and return file offset after the last row."""
+        self.file.flush()
+        if hasattr(self.file, "fileno"):
+            os.fsync(self.file.fileno())
+        return self.file.tell()
+
+    def resume(self, position):
+        """Continue writing at file offset `position`."""
+        self._resume_position = position
+
     def append(self, obj):
         if type(obj) == dict:
             row = []
@@ -3,6 +3,8 @@
 
 import base
 import brewery.dq
+import brewery.metadata
+import brewery.aggregates
 
 try:
     import pymongo
@@ -10,6 +12,16 @@ except:
     from brewery.utils import MissingPackage
     pymongo = MissingPackage("pymongo", "MongoDB streams", "http://www.mongodb.org/downloads/")
 
+# Group accumulators of aggregate functions which can be computed by the database. Distinct
+# values are collected with $addToSet and counted when the result is read.
+_mongo_accumulators = {
+    "sum": "$sum",
+    "min": "$min",
+    "max": "$max",
+    "average": "$avg",
+    "count_distinct": "$addToSet"
+}
+
 class MongoDBDataSource(base.DataSource):
     """docstring for ClassName
     """
@@ -35,6 +47,8 @@ class MongoDBDataSource(base.DataSource):
 
         self.collection = None
         self.fields = None
+        self._query = []
+        self._aggregation = None
 
     def initialize(self):
         """Initialize Mongo source stream:
@@ -50,6 +64,98 @@ class MongoDBDataSource(base.DataSource):
         self.database = self.connection[self.database_name]
         self.collection = self.database[self.collection_name]
 
+    def size_hint(self):
+        """Return number of documents counted by the database, ``None`` if the documents are
+        aggregated."""
+        if self._aggregation:
+            return None
+        return self.collection.find(self._spec()).count()
+
+    def push_filter(self, conditions):
+        """Filter documents in the database with a query document."""
+        query = []
+        for (field, operator, value) in conditions:
+            document = _condition_document(field, operator, value)
+            if document is None:
+                return False
+            query.append(document)
+
+        self._query += query
+        return True
+
+    def prune_fields(self, names):
+        """Read only fields with `names`."""
+        fields = [field for field in self.fields if field.name in names]
+        self.fields = brewery.metadata.FieldList(fields)
+        return True
+
+    def push_aggregation(self, keys, measures, count_field="record_count"):
+        """Aggregate documents in the database with an aggregation pipeline."""
+        measures = base.measure_aggregations(measures)
+        for (field, aggregations) in measures:
+            for aggregation in aggregations:
+                if brewery.aggregates.aggregate_function(aggregation).name \
+                        not in _mongo_accumulators:
+                    return False
+
+        fields = brewery.metadata.FieldList(self.fields)
+        self._aggregation = (list(keys), measures)
+        self.fields = base.aggregated_fields(fields, keys, measures, count_field)
+        return True
+
+    def _aggregated_rows(self):
+        """Return list of aggregated rows computed by the database."""
+
+        (keys, measures) = self._aggregation
+
+        # Field names might contain dots, which are not allowed in result documents
+        group = {
+            "_id": dict(("k%d" % i, "$" + key) for (i, key) in enumerate(keys)),
+            "first": {"$min": "$_id"},
+            "count": {"$sum": 1}
+        }
+        columns = []
+        for (measure, aggregations) in measures:
+            for aggregation in aggregations:
+                name = brewery.aggregates.aggregate_function(aggregation).name
+                column = "m%d" % len(columns)
+                group[column] = {_mongo_accumulators[name]: "$" + measure}
+                columns.append((column, name))
+
+        pipeline = []
+        spec = self._spec()
+        if spec:
+            pipeline.append({"$match": spec})
+        pipeline.append({"$group": group})
+        # Groups in order of their first document
+        pipeline.append({"$sort": {"first": 1}})
+
+        result = self.collection.aggregate(pipeline)
+        # Older pymongo returns the command response
+        if isinstance(result, dict):
+            result = result["result"]
+
+        rows = []
+        for document in result:
+            row = [document["_id"].get("k%d" % i) for i in range(len(keys))]
+            for (column, name) in columns:
+                value = document[column]
+                if name == "count_distinct":
+                    value = len([item for item in value if item is not None])
+                row.append(value)
+            row.append(document["count"])
+            rows.append(tuple(row))
+
+        return rows
+
+    def _spec(self):
+        """Return query document of pushed filters."""
+        if not self._query:
+            return None
+        elif len(self._query) == 1:
+            return self._query[0]
+        else:
+            return {"$and": self._query}
 
     def read_fields(self, limit=0):
         keys = []
@@ -102,21 +208,58 @@ class MongoDBDataSource(base.DataSource):
     def rows(self):
         if not self.collection:
             raise RuntimeError("Stream is not initialized")
-        fields = self.fields.names
-        iterator = self.collection.find(fields=fields)
+        if self._aggregation:
+            return iter(self._aggregated_rows())
+        fields = [field.name for field in self.fields]
+        iterator = self.collection.find(self._spec(), fields=fields)
         return MongoDBRowIterator(iterator, fields)
 
     def records(self):
         if not self.collection:
             raise RuntimeError("Stream is not initialized")
+        if self._aggregation:
+            names = self.fields.names()
+            return iter([dict(zip(names, row)) for row in self._aggregated_rows()])
         # return MongoDBRowIterator(self.field_names, self.collection.find())
         if self.fields:
             fields = self.fields.names()
         else:
             fields = None
-        iterator = self.collection.find(fields=fields)
+        iterator = self.collection.find(self._spec(), fields=fields)
         return MongoDBRecordIterator(iterator, self.expand)
 
+# Query operators of filter conditions
+_query_operators = {
+    "!=": "$ne",
+    "<": "$lt",
+    "<=": "$lte",
+    ">": "$gt",
+    ">=": "$gte",
+    "in": "$in",
+    "not in": "$nin"
+}
+
+def _condition_document(field, operator, value):
+    """Return query document for a filter condition or ``None`` if the condition can not be
+    expressed. Python 2 orders ``None`` before all values, so ``None`` matches ``<`` and ``<=``
+    conditions."""
+
+    if operator == "==":
+        return {field: value}
+
+    query_operator = _query_operators.get(operator)
+    if not query_operator:
+        return None
+
+    if operator in ("in", "not in"):
+        value = list(value)
+
+    document = {field: {query_operator: value}}
+    if operator in ("<", "<="):
+        document = {"$or": [document, {field: None}]}
+
+    return document
+
 class MongoDBRowIterator(object):
     """Wrapper for pymongo.cursor.Cursor to be able to return rows() as tuples and records() as 
     dictionaries"""
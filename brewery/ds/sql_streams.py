@@ -3,6 +3,7 @@
 
 import base
 import brewery.metadata
+import brewery.aggregates
 
 try:
     import sqlalchemy
@@ -39,6 +40,9 @@ except:
     _sql_to_brewery_types = ()
     concrete_sql_type_map = {}
 
+# Aggregate functions which can be computed by the database
+_sql_aggregations = ("count", "sum", "min", "max", "average", "count_distinct")
+
 def split_table_schema(table_name):
     """Get schema and table name from table reference.
 
@@ -137,7 +141,7 @@ class SQLDataSource(base.DataSource):
     """
     def __init__(self, connection=None, url=None,
                     table=None, statement=None, schema=None, autoinit = True,
-                    **options):
+                    ordered=False, **options):
         """Creates a relational database data source stream.
         
         :Attributes:
@@ -147,6 +151,9 @@ class SQLDataSource(base.DataSource):
             * statement: SQL statement to be used as a data source (not supported yet)
             * autoinit: initialize on creation, no explicit initialize() is 
               needed
+            * ordered: read rows ordered by primary key, so read positions are the same in every
+              run. Set by `seek()` and by source nodes of checkpointed streams. Default is
+              ``False``
             * options: SQL alchemy connect() options
         """
 
@@ -170,10 +177,16 @@ class SQLDataSource(base.DataSource):
         self.statement = statement
         self.schema = schema
         self.options = options
+        self.ordered = ordered
 
         self.context = None
         self.table = None
         self.fields = None
+        self._position = 0
+        self._offset = 0
+        self._filters = []
+        self._columns = None
+        self._aggregation = None
         
         if autoinit:
             self.initialize()
@@ -184,7 +197,7 @@ class SQLDataSource(base.DataSource):
         """
         if not self.context:
             self.context = SQLContext(self.url, self.connection, self.schema)
-        if not self.table:
+        if self.table is None:
             self.table = self.context.table(self.table_name)
         if not self.fields:
             self.read_fields()
@@ -197,18 +210,198 @@ class SQLDataSource(base.DataSource):
         return self.fields
 
     def rows(self):
-        if not self.dataset:
+        if self.table is None:
             raise RuntimeError("Stream is not initialized")
-        return self.context.table.select().execute()
+
+        if self._aggregation:
+            statement = self._aggregation_statement()
+        else:
+            statement = self.table.select()
+            if self._columns is not None:
+                statement = statement.with_only_columns(self._columns)
+
+            if self._filters:
+                statement = statement.where(sqlalchemy.and_(*self._filters))
+
+            # Order by primary key only if positions have to be the same in every run, ordering
+            # can be expensive
+            key = list(self.table.primary_key.columns)
+            if self.ordered and key:
+                statement = statement.order_by(*key)
+
+        if self._offset:
+            statement = statement.offset(self._offset)
+
+        self._position = self._offset
+        for row in self.context.connection.execute(statement):
+            self._position += 1
+            yield row
 
     def records(self):
-        if not self.dataset:
-            raise RuntimeError("Stream is not initialized")
-        fields = self.field_names
+        fields = self.fields.names()
         for row in self.rows():
             record = dict(zip(fields, row))
             yield record
 
+    def position(self):
+        """Return number of rows read. Positions are repeatable only if the source is
+        `ordered`."""
+        return self._position
+
+    def seek(self, position):
+        """Continue reading after `position` rows. Rows are read ordered by the primary key."""
+        self._offset = position
+        self.ordered = True
+
+    def size_hint(self):
+        """Return number of rows counted by the database, ``None`` if the rows are
+        aggregated."""
+        if self._aggregation:
+            return None
+
+        statement = sqlalchemy.select([sqlalchemy.func.count()], from_obj=self.table)
+        if self._filters:
+            statement = statement.where(sqlalchemy.and_(*self._filters))
+        count = self.context.connection.execute(statement).scalar()
+
+        return max(count - self._offset, 0)
+
+    def push_filter(self, conditions):
+        """Filter rows in the database with a ``WHERE`` clause."""
+        columns = self.table.columns
+        names = columns.keys()
+
+        clauses = []
+        for (field, operator, value) in conditions:
+            if field not in names:
+                return False
+            clause = _condition_clause(columns[field], operator, value)
+            if clause is None:
+                return False
+            clauses.append(clause)
+
+        self._filters += clauses
+        return True
+
+    def prune_fields(self, names):
+        """Select only columns of fields with `names`."""
+        fields = [field for field in self.fields if field.name in names]
+        if not fields:
+            return False
+
+        self._columns = [self.table.columns[field.name] for field in fields]
+        self.fields = brewery.metadata.FieldList(fields)
+        return True
+
+    def push_aggregation(self, keys, measures, count_field="record_count"):
+        """Aggregate rows in the database with a ``GROUP BY`` statement. Groups are ordered by
+        the first row of the group, as aggregated by the aggregate node, therefore rows with
+        keys are aggregated only if the table has a single column primary key."""
+        if keys and len(self.table.primary_key.columns) != 1:
+            return False
+
+        names = self.table.columns.keys()
+        measures = base.measure_aggregations(measures)
+        for name in list(keys) + [field for (field, aggregations) in measures]:
+            if name not in names:
+                return False
+
+        for (field, aggregations) in measures:
+            for aggregation in aggregations:
+                if brewery.aggregates.aggregate_function(aggregation).name \
+                        not in _sql_aggregations:
+                    return False
+
+        self._aggregation = (list(keys), measures)
+        self.fields = base.aggregated_fields(fields_from_table(self.table), keys, measures,
+                                             count_field)
+        return True
+
+    def _aggregation_statement(self):
+        """Return grouping statement of pushed aggregation."""
+        (keys, measures) = self._aggregation
+        columns = self.table.columns
+        func = sqlalchemy.func
+
+        key_columns = [columns[name] for name in keys]
+        selection = list(key_columns)
+        functions = {
+            "count": func.count,
+            "sum": func.sum,
+            "min": func.min,
+            "max": func.max,
+            "average": func.avg,
+            "count_distinct": lambda column: func.count(column.distinct())
+        }
+        for (name, aggregations) in measures:
+            column = columns[name]
+            for aggregation in aggregations:
+                function = functions[brewery.aggregates.aggregate_function(aggregation).name]
+                selection.append(function(column))
+        selection.append(func.count())
+
+        statement = sqlalchemy.select(selection, from_obj=self.table)
+        if self._filters:
+            statement = statement.where(sqlalchemy.and_(*self._filters))
+
+        if key_columns:
+            statement = statement.group_by(*key_columns)
+            # Groups in order of their first row, as read without aggregation
+            primary_key = list(self.table.primary_key.columns)
+            statement = statement.order_by(func.min(primary_key[0]))
+        else:
+            # Aggregate node does not produce any row from empty input
+            statement = statement.having(func.count() > 0)
+
+        return statement
+
+def _condition_clause(column, operator, value):
+    """Return SQLAlchemy clause for a filter condition on `column` (see
+    :meth:`brewery.ds.DataSource.push_filter`) or ``None`` if the condition can not be expressed.
+    Python 2 orders ``None`` before all values and ``None != value`` is true, while comparisons
+    with SQL ``NULL`` are never true, therefore ``NULL`` is tested explicitly."""
+
+    is_null = column == None
+
+    if operator in ("in", "not in"):
+        values = [item for item in value if item is not None]
+        has_null = len(values) != len(value)
+
+        if operator == "in":
+            clauses = []
+            if values:
+                clauses.append(column.in_(values))
+            if has_null:
+                clauses.append(is_null)
+            if not clauses:
+                return None
+            return sqlalchemy.or_(*clauses)
+        else:
+            if has_null:
+                if values:
+                    return sqlalchemy.and_(~column.in_(values), column != None)
+                return column != None
+            if not values:
+                return None
+            return sqlalchemy.or_(~column.in_(values), is_null)
+
+    if operator == "==":
+        return column == value
+    elif operator == "!=":
+        if value is None:
+            return column != None
+        return sqlalchemy.or_(column != value, is_null)
+    elif operator == "<":
+        return sqlalchemy.or_(column < value, is_null)
+    elif operator == "<=":
+        return sqlalchemy.or_(column <= value, is_null)
+    elif operator == ">":
+        return column > value
+    elif operator == ">=":
+        return column >= value
+    else:
+        return None
+
 class SQLDataTarget(base.DataTarget):
     """docstring for ClassName
     """
@@ -217,7 +410,7 @@ class SQLDataTarget(base.DataTarget):
                     create=False, replace=False,
                     add_id_key=False, id_key_name=None,
                     buffer_size=None, fields=None, concrete_type_map=None,
-                    **options):
+                    transactional=False, **options):
         """Creates a relational database data target stream.
         
         :Attributes:
@@ -235,6 +428,9 @@ class SQLDataTarget(base.DataTarget):
             * buffer_size: size of INSERT buffer - how many records are collected before they are
               inserted using multi-insert statement. Default is 1000
             * fields : fieldlist for a new table
+            * transactional: insert records in a transaction which is committed by `commit()`
+              and on finalization and rolled back by `rollback()`. Used by stream checkpoints.
+              Can be changed until the first records are inserted. Default is ``False``
         
         Note: avoid auto-detection when you are reading from remote URL stream.
         
@@ -267,6 +463,11 @@ class SQLDataTarget(base.DataTarget):
         else:
             self.buffer_size = 1000
 
+        self.transactional = transactional
+        self._transaction = None
+        self._committed_count = 0
+        self._resuming = False
+
     def initialize(self):
         """Initialize source stream:
         """
@@ -275,12 +476,12 @@ class SQLDataTarget(base.DataTarget):
                                   connection=self.connection,
                                   schema=self.schema)
 
-        if self.create:
+        if self.create and not self._resuming:
             self.table = self._create_table()
         else:
             self.table = self.context.table(self.table_name)
 
-        if self.truncate:
+        if self.truncate and not self._resuming:
             self.table.delete().execute()
 
         if not self.fields:
@@ -290,6 +491,7 @@ class SQLDataTarget(base.DataTarget):
 
         self.insert_command = self.table.insert()
         self._buffer = []
+        self._count = self._committed_count
 
     def _create_table(self):
         """Create a table."""
@@ -338,8 +540,43 @@ class SQLDataTarget(base.DataTarget):
         """Closes the stream, flushes buffered data"""
 
         self._flush()
+        if self._transaction:
+            self._transaction.commit()
+            self._transaction = None
         self.context.close()
 
+    def commit(self):
+        """Insert buffered records and commit the transaction. Returns number of committed
+        records. Records inserted after the commit are rolled back by :meth:`rollback` or if the
+        process fails, so a stream resumed from a checkpoint does not insert them twice."""
+
+        self._flush()
+        if self._transaction:
+            self._transaction.commit()
+            self._transaction = None
+        self._committed_count = self._count
+        return self._committed_count
+
+    def rollback(self):
+        """Discard buffered records and roll back records inserted after the last commit, if
+        the target is transactional. Records of a target which is not transactional can not be
+        rolled back and are inserted on finalization."""
+
+        if not self.transactional:
+            return
+
+        self._buffer = []
+        if self._transaction:
+            self._transaction.rollback()
+            self._transaction = None
+        self._count = self._committed_count
+
+    def resume(self, position):
+        """Continue inserting into the existing table - the table is not created nor truncated.
+        Position is number of committed records."""
+        self._resuming = True
+        self._committed_count = position
+
     def append(self, obj):
         if type(obj) == dict:
             record = obj
@@ -347,10 +584,13 @@ class SQLDataTarget(base.DataTarget):
             record = dict(zip(self.field_names, obj))
 
         self._buffer.append(record)
+        self._count += 1
         if len(self._buffer) >= self.buffer_size:
             self._flush()
 
     def _flush(self):
         if len(self._buffer) > 0:
+            if self.transactional and not self._transaction:
+                self._transaction = self.context.connection.begin()
             self.context.connection.execute(self.insert_command, self._buffer)
             self._buffer = []
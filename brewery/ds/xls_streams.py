@@ -62,6 +62,10 @@ class XLSDataSource(base.DataSource):
         if self.file and self.close_file:
             self.file.close()
 
+    def size_hint(self):
+        """Return number of rows of the sheet without header and skipped rows."""
+        return max(self.sheet.nrows - (self.skip_rows or 0), 0)
+
     def rows(self):
         if not self.sheet:
             raise RuntimeError("XLS Stream is not initialized - there is no sheet")
@@ -43,14 +43,25 @@ class YamlDirectoryDataSource(base.DataSource):
         self.expand = expand
         self.filename_field = filename_field
         self.extension = extension
+        self._position = 0
+        self._offset = 0
 
     def initialize(self):
         pass
 
+    def position(self):
+        """Return number of files read. Files are read in order of their names."""
+        return self._position
+
+    def seek(self, position):
+        """Continue reading after `position` files."""
+        self._offset = position
+
     def records(self):
-        files = os.listdir(self.path)
+        files = sorted(os.listdir(self.path))
 
-        for base_name in files:
+        self._position = self._offset
+        for base_name in files[self._offset:]:
             split = os.path.splitext(base_name)
             if split[1] != self.extension:
                 pass
@@ -64,15 +75,17 @@ class YamlDirectoryDataSource(base.DataSource):
             if self.filename_field:
                 record[self.filename_field] = base_name
 
+            self._position += 1
             yield record
 
     def rows(self):
-        if not self.field_names:
+        if not self.fields:
             raise Exception("Field names not initialized, can not generate rows")
 
+        field_names = self.fields.names()
         for record in self.records():
             row = []
-            for field in self.field_names:
+            for field in field_names:
                 row.append(record.get(field))
             yield row
 
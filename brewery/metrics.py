@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+"""Runtime metrics of streams"""
+
+__all__ = [
+    "StreamMetrics",
+    "NodeMetrics",
+    "PipeMetrics",
+    "BottleneckReport"
+]
+
+class NodeMetrics(object):
+    """Runtime metrics of a stream node.
+
+    :Attributes:
+        * `name`: node name or node label if the node has no name
+        * `rows_in`: number of rows received from all inputs
+        * `rows_out`: number of rows passed to the outputs
+        * `wall_time`: time in seconds the node thread was running
+        * `cpu_time`: CPU time in seconds consumed by the node thread or ``None`` if the platform
+          does not provide per-thread CPU time
+        * `input_wait_time`: time in seconds the node waited for data from inputs
+        * `output_wait_time`: time in seconds the node was blocked by full outputs
+        * `thread`: name of the node that runs this node in its thread. Differs from `name` for
+          fused nodes, which share wall and CPU time of the thread with their source node.
+        * `cache_hits`: number of function results the node took from its cache or ``None`` if
+          the node does not cache results, see :meth:`brewery.nodes.Node.start_cache`
+        * `cache_misses`: number of function results the node had to compute despite the cache
+          or ``None`` if the node does not cache results
+    """
+
+    def __init__(self, name=None):
+        self.name = name
+        self.rows_in = 0
+        self.rows_out = 0
+        self.wall_time = 0.0
+        self.cpu_time = None
+        self.input_wait_time = 0.0
+        self.output_wait_time = 0.0
+        self.thread = name
+        self.cache_hits = None
+        self.cache_misses = None
+
+    @property
+    def busy_time(self):
+        """Time in seconds the node thread was neither waiting for input nor blocked by
+        outputs."""
+        return max(self.wall_time - self.input_wait_time - self.output_wait_time, 0.0)
+
+    def as_dict(self):
+        """Return metrics as a dictionary."""
+        return {
+            "name": self.name,
+            "rows_in": self.rows_in,
+            "rows_out": self.rows_out,
+            "wall_time": self.wall_time,
+            "cpu_time": self.cpu_time,
+            "input_wait_time": self.input_wait_time,
+            "output_wait_time": self.output_wait_time,
+            "thread": self.thread,
+            "cache_hits": self.cache_hits,
+            "cache_misses": self.cache_misses
+        }
+
+    def __repr__(self):
+        return "<NodeMetrics %s: in %d, out %d, wall %.3fs>" % (self.name, self.rows_in,
+                                                                  self.rows_out, self.wall_time)
+
+class PipeMetrics(object):
+    """Runtime metrics of a pipe between two nodes.
+
+    :Attributes:
+        * `source`: name of the source node
+        * `target`: name of the target node
+        * `batches`: number of batches sent through the pipe
+        * `rows`: number of rows sent through the pipe
+        * `peak_buffered_rows`: maximal number of rows waiting in the pipe for the target node or
+          ``None`` if the pipe does not track it
+        * `producer_wait_time`: time in seconds the source node was blocked by the full pipe
+        * `consumer_wait_time`: time in seconds the target node waited for data
+    """
+
+    def __init__(self, source=None, target=None):
+        self.source = source
+        self.target = target
+        self.batches = 0
+        self.rows = 0
+        self.peak_buffered_rows = None
+        self.producer_wait_time = 0.0
+        self.consumer_wait_time = 0.0
+
+    def as_dict(self):
+        """Return metrics as a dictionary."""
+        return {
+            "source": self.source,
+            "target": self.target,
+            "batches": self.batches,
+            "rows": self.rows,
+            "peak_buffered_rows": self.peak_buffered_rows,
+            "producer_wait_time": self.producer_wait_time,
+            "consumer_wait_time": self.consumer_wait_time
+        }
+
+    def __repr__(self):
+        return "<PipeMetrics %s -> %s: %d rows in %d batches>" % (self.source, self.target,
+                                                                   self.rows, self.batches)
+
+class StreamMetrics(object):
+    """Runtime metrics of a stream run.
+
+    :Attributes:
+        * `wall_time`: duration of the run in seconds
+        * `nodes`: dictionary of :class:`NodeMetrics` where keys are node names
+        * `pipes`: list of :class:`PipeMetrics`
+    """
+
+    def __init__(self):
+        self.wall_time = 0.0
+        self.nodes = {}
+        self.pipes = []
+
+    def node(self, name):
+        """Return metrics of node `name`."""
+        return self.nodes[name]
+
+    def pipe(self, source, target):
+        """Return metrics of pipe between nodes `source` and `target`."""
+        for pipe in self.pipes:
+            if pipe.source == source and pipe.target == target:
+                return pipe
+        raise KeyError("No pipe between %s and %s" % (source, target))
+
+    def bottleneck_report(self, node_order=None):
+        """Return :class:`BottleneckReport` - node that limits the stream throughput, critical
+        path and time nodes spent blocked by back-pressure. `node_order` is list of node names in
+        topological order (as from :meth:`brewery.streams.Stream.sorted_nodes`), if not
+        provided, the order is derived from the pipes."""
+
+        if node_order is None:
+            node_order = self._topological_order()
+
+        sources = dict((name, []) for name in node_order)
+        for pipe in self.pipes:
+            sources[pipe.target].append(pipe.source)
+
+        # Fused nodes share a thread - the thread is the unit of measurement
+        threads = {}
+        for name in node_order:
+            threads.setdefault(self.nodes[name].thread, []).append(name)
+
+        thread_busy = {}
+        for (thread, names) in threads.items():
+            wall_time = self.nodes[thread].wall_time
+            waits = sum(self.nodes[name].input_wait_time + self.nodes[name].output_wait_time
+                            for name in names)
+            thread_busy[thread] = max(wall_time - waits, 0.0)
+
+        report = BottleneckReport()
+        report.wall_time = self.wall_time
+
+        for name in node_order:
+            node = self.nodes[name]
+            busy_time = thread_busy[node.thread]
+            if self.wall_time:
+                utilization = busy_time / self.wall_time
+            else:
+                utilization = 0.0
+            report.nodes.append({
+                "name": name,
+                "thread": node.thread,
+                "busy_time": busy_time,
+                "utilization": utilization,
+                "input_wait_time": node.input_wait_time,
+                "backpressure_time": node.output_wait_time
+            })
+
+        if not node_order:
+            return report
+
+        bottleneck = max(thread_busy.keys(), key=lambda thread: thread_busy[thread])
+        report.bottleneck = bottleneck
+        report.bottleneck_nodes = threads[bottleneck]
+        report.busy_time = thread_busy[bottleneck]
+
+        # Nodes upstream of the bottleneck thread
+        upstream = set()
+        pending = list(threads[bottleneck])
+        while pending:
+            for source in sources[pending.pop()]:
+                if source not in upstream and self.nodes[source].thread != bottleneck:
+                    upstream.add(source)
+                    pending.append(source)
+
+        report.upstream = [{"name": name,
+                            "backpressure_time": self.nodes[name].output_wait_time}
+                                for name in node_order if name in upstream]
+
+        # Critical path: longest path by busy time. Busy time of a thread is counted once, at
+        # the first node of the thread.
+        length = {}
+        previous = {}
+        for name in node_order:
+            if self.nodes[name].thread == name:
+                weight = thread_busy[name]
+            else:
+                weight = 0.0
+
+            previous[name] = None
+            best = 0.0
+            for source in sources[name]:
+                if previous[name] is None or length[source] > best:
+                    best = length[source]
+                    previous[name] = source
+            length[name] = best + weight
+
+        # On ties prefer nodes further downstream
+        name = max(reversed(node_order), key=lambda name: length[name])
+        report.critical_path_time = length[name]
+        path = []
+        while name is not None:
+            path.append(name)
+            name = previous[name]
+        path.reverse()
+        report.critical_path = path
+
+        return report
+
+    def _topological_order(self):
+        """Return node names sorted so that sources precede their targets."""
+        remaining = set(self.nodes.keys())
+        order = []
+        while remaining:
+            ready = sorted(name for name in remaining
+                            if not any(pipe.target == name and pipe.source in remaining
+                                       for pipe in self.pipes))
+            if not ready:
+                raise ValueError("Stream metrics contain a cycle")
+            order += ready
+            remaining.difference_update(ready)
+        return order
+
+    def as_dict(self):
+        """Return metrics as a dictionary, suitable for JSON serialization."""
+        return {
+            "wall_time": self.wall_time,
+            "nodes": [metrics.as_dict() for metrics in self.nodes.values()],
+            "pipes": [metrics.as_dict() for metrics in self.pipes]
+        }
+
+class BottleneckReport(object):
+    """Report of a node that limits throughput of a stream. Created by
+    :meth:`StreamMetrics.bottleneck_report`.
+
+    Nodes fused together run in one thread and are measured as one unit - the thread.
+
+    :Attributes:
+        * `bottleneck`: name of the thread (node) with the largest busy time - time when it was
+          neither waiting for input nor blocked by full outputs
+        * `bottleneck_nodes`: names of nodes run in the bottleneck thread
+        * `busy_time`: busy time of the bottleneck thread in seconds
+        * `wall_time`: duration of the run
+        * `critical_path`: list of node names on the longest path through the stream graph,
+          where path length is sum of busy times
+        * `critical_path_time`: busy time of the critical path in seconds
+        * `nodes`: list of dictionaries with keys ``name``, ``thread``, ``busy_time``,
+          ``utilization`` (busy time of the thread divided by run duration), ``input_wait_time``
+          and ``backpressure_time`` - time the node was blocked by full outputs
+        * `upstream`: list of dictionaries with keys ``name`` and ``backpressure_time`` for nodes
+          upstream of the bottleneck
+    """
+
+    def __init__(self):
+        self.bottleneck = None
+        self.bottleneck_nodes = []
+        self.busy_time = 0.0
+        self.wall_time = 0.0
+        self.critical_path = []
+        self.critical_path_time = 0.0
+        self.nodes = []
+        self.upstream = []
+
+    def __str__(self):
+        lines = []
+        if self.wall_time:
+            ratio = self.busy_time / self.wall_time
+        else:
+            ratio = 0.0
+
+        lines.append("bottleneck: %s (busy %.3fs, %.0f%% of run)"
+                        % (" + ".join(self.bottleneck_nodes), self.busy_time, ratio * 100))
+        lines.append("critical path: %s (busy %.3fs)"
+                        % (" -> ".join(self.critical_path), self.critical_path_time))
+
+        if self.upstream:
+            lines.append("idle upstream nodes (blocked by back-pressure):")
+            for node in self.upstream:
+                lines.append("    %s: %.3fs" % (node["name"], node["backpressure_time"]))
+
+        lines.append("nodes:")
+        for node in self.nodes:
+            lines.append("    %-20s busy %8.3fs %5.0f%%  input wait %8.3fs  back-pressure %8.3fs"
+                            % (node["name"], node["busy_time"], node["utilization"] * 100,
+                               node["input_wait_time"], node["backpressure_time"]))
+
+        return "\n".join(lines)
@@ -21,6 +21,7 @@ __all__ = [
     # Record nodes
     "SampleNode",
     "AppendNode",
+    "MergeNode",
     "DistinctNode",
     "AggregateNode",
     "AuditNode",
@@ -2,6 +2,9 @@
 # -*- coding: utf-8 -*-
 
 import brewery.utils as utils
+import threading
+import operator
+from parallel import OrderedBatchMap
 
 __all__ = (
     "create_node",
@@ -10,7 +13,8 @@ __all__ = (
     "NodeFinished",
     "Node",
     "SourceNode",
-    "TargetNode"
+    "TargetNode",
+    "KeyFilter"
 )
 
 # FIXME: temporary dictionary to record displayed warnings about __node_info__
@@ -85,6 +89,31 @@ class Node(object):
     
     .. abstract_node
     """
+
+    # Parallel processing of batches, see start_workers(). Defined on class level, as not all
+    # nodes call Node.__init__()
+    workers = 1
+    worker_type = "process"
+    _batch_map = None
+
+    # Memoization of functions evaluated by the node, see start_cache()
+    pure = False
+    cache_size = 10000
+    _cache = None
+
+    # Stream checkpoints, see checkpoint_state()
+    supports_checkpoints = False
+    _checkpointer = None
+    _barrier_request = None
+
+    # Filtering and aggregation in data sources, see filter_conditions() and aggregation()
+    filter_pushed_down = False
+    aggregation_pushed_down = False
+
+    # Estimated numbers of input rows, see size_hint()
+    uses_size_hints = False
+    input_size_hints = None
+
     def __init__(self):
         """Creates a new data processing node.
         
@@ -92,6 +121,13 @@ class Node(object):
             * `inputs`: input pipes
             * `outputs`: output pipes
             * `description`: custom node annotation
+            * `workers`: number of workers processing input batches in parallel, see
+              :meth:`start_workers`. Default is 1 - no workers.
+            * `worker_type`: ``process`` (default) or ``thread``
+            * `pure`: declares that functions evaluated by the node depend only on their input
+              values, their results might be cached, see :meth:`start_cache`. Default is
+              ``False``.
+            * `cache_size`: maximal number of cached results of a pure node. Default is 10000.
         """
 
         super(Node, self).__init__()
@@ -118,15 +154,114 @@ class Node(object):
         pass
 
     def finalize(self):
-        """Finalizes the node. Default implementation does nothing."""
+        """Finalizes the node. Default implementation stops workers, if there are any."""
+        self.stop_workers()
+
+    def abort(self):
+        """Called by the stream before :meth:`finalize` when the stream run failed. Nodes should
+        discard output which was not committed yet, so a stream resumed from a checkpoint does
+        not produce it twice. Default implementation does nothing."""
         pass
 
+    def start_workers(self):
+        """Start pool of `workers` that will run :meth:`process_batch` in parallel, if `workers`
+        is greater than 1. Batches are processed in separate processes or threads, depending on
+        `worker_type`, and output rows keep the order of input rows. Only nodes that do not keep
+        any state between rows should use workers, as each worker has its own copy of the node
+        (or shares it with the other worker threads).
+
+        Should be called at the end of :meth:`initialize` - worker processes get a copy of the
+        initialized node. Workers are used by the default :meth:`run` implementation.
+        """
+        self.stop_workers()
+
+        if self.workers > 1:
+            processes = (self.worker_type != "thread")
+            self._batch_map = OrderedBatchMap(self, self.workers, processes)
+            self._batch_map.start()
+
+    def start_cache(self):
+        """Create a least recently used cache of function results, if the node is declared
+        `pure` and `cache_size` is not zero. Nodes that evaluate functions of field values use the
+        cache, if there is one, to evaluate the function only once for the same input values.
+        Should be called from :meth:`initialize` before :meth:`start_workers`.
+        """
+
+        if self.pure and self.cache_size:
+            # Worker threads share the node and its cache
+            shared = self.workers > 1 and self.worker_type == "thread"
+            self._cache = utils.LRUCache(self.cache_size, shared=shared)
+        else:
+            self._cache = None
+
+    @property
+    def cache_hits(self):
+        """Number of function results taken from the cache or ``None`` if the node does not
+        cache results."""
+        if self._cache is None:
+            return None
+        return self._cache.hits
+
+    @property
+    def cache_misses(self):
+        """Number of function results that were not found in the cache or ``None`` if the node
+        does not cache results."""
+        if self._cache is None:
+            return None
+        return self._cache.misses
+
+    def stop_workers(self):
+        """Stop workers started by :meth:`start_workers`."""
+        if self._batch_map:
+            self._batch_map.terminate()
+            self._batch_map = None
+
     def run(self):
-        """Main method for running the node code. Subclasses should implement this method.
+        """Main method for running the node code. Subclasses should implement this method or the
+        :meth:`process_row` method. Default implementation passes each batch of rows from the
+        single input through :meth:`process_batch`, in parallel if workers were started.
         """
-        
-        raise NotImplementedError("Subclasses of Node should implement the run() method")
-        
+
+        if self._batch_map:
+            for batch in self._batch_map.map(self.input.batches()):
+                if batch:
+                    self.put_batch(batch)
+            return
+
+        for batch in self.input.batches():
+            batch = self.process_batch(batch)
+            if batch:
+                self.put_batch(batch)
+
+    def process_batch(self, rows):
+        """Process list of input `rows` and return list of rows that are passed to the outputs.
+        Default implementation calls :meth:`process_row` for each row. Subclasses might override
+        this method to process whole batch at once. The node owns the `rows` list and might
+        modify it or return it.
+        """
+
+        process_row = self.process_row
+        result = []
+        for row in rows:
+            row = process_row(row)
+            if row is not None:
+                result.append(row)
+        return result
+
+    def process_row(self, row):
+        """Process one input `row` and return a row that is passed to the outputs or ``None`` if
+        the row should be discarded. Nodes that process rows one by one should implement this
+        method instead of ``run()``. Node might raise `NodeFinished` when it does not want any more
+        rows.
+
+        Stream might fuse such nodes with their source node: the stream will call this method
+        directly from the source node's thread without any intermediate pipe. If a node implements
+        both, ``run()`` and this method, they should be equivalent.
+        """
+
+        raise NotImplementedError("Subclasses of Node should implement the run() or "
+                                  "process_row() method")
+
     @property
     def input(self):
         """Return single node imput if exists. Convenience property for nodes which process only one
@@ -184,7 +319,131 @@ class Node(object):
         # This is not very safe, as run() might not expect it
         if not active_outputs:
             raise NodeFinished
+
+        if self._barrier_request is not None:
+            self._emit_barrier()
   
+    def put_batch(self, rows):
+        """Put list of rows into all output pipes. The list is passed to the output pipe as it
+        is, therefore it should not be modified by the node afterwards. Raises `NodeFinished` the
+        same way as :meth:`put`.
+        """
+        outputs = [output for output in self.outputs if not output.closed()]
+
+        if not outputs:
+            raise NodeFinished
+
+        # Each output gets its own list, the receiving nodes might modify it
+        for output in outputs[1:]:
+            output.put_batch(list(rows))
+        outputs[0].put_batch(rows)
+
+        if self._barrier_request is not None:
+            self._emit_barrier()
+
+    def checkpoint_state(self):
+        """Return state of the node to be stored in a stream checkpoint. The state should be
+        picklable. Called from the node's thread between two batches, when all data received so
+        far are processed.
+
+        Source nodes should return their read position, target nodes should commit their output
+        and return position of the committed output. Default implementation returns ``None`` -
+        the node keeps no state between batches.
+
+        Only nodes with `supports_checkpoints` set to ``True`` are checkpointed. Stream with a
+        node that does not support checkpoints is run without checkpoints.
+        """
+        return None
+
+    def restore_state(self, state):
+        """Restore `state` returned by :meth:`checkpoint_state` when a stream is resumed from a
+        checkpoint. Called before :meth:`initialize`, the node should continue from the state
+        when it is initialized. Default implementation does nothing."""
+        pass
+
+    def filter_conditions(self):
+        """Return conditions of rows passed by a filtering node, so the stream can push the
+        filter into a data source, such as SQL ``WHERE`` clause. Returns tuple (`conditions`,
+        `exact`) where `conditions` is a list of conditions as described in
+        :meth:`brewery.ds.DataSource.push_filter` and `exact` is ``True`` if the conditions are
+        equivalent to the node's filter, not only a part of it. Default implementation returns
+        ``None`` - the node does not filter rows or its filter can not be expressed with
+        conditions.
+
+        When exact conditions were pushed into the source, the stream sets `filter_pushed_down`
+        to ``True`` and the node should pass all rows.
+        """
+        return None
+
+    def aggregation(self):
+        """Return aggregation performed by the node, so the stream can push it into a data
+        source, such as SQL ``GROUP BY`` statement. Returns tuple (`keys`, `measures`,
+        `count_field`) as described in :meth:`brewery.ds.DataSource.push_aggregation` or
+        ``None`` if the node does not aggregate. Default implementation returns ``None``.
+
+        When the aggregation was pushed into the source, the stream sets
+        `aggregation_pushed_down` to ``True`` before the node is initialized and the node should
+        pass input rows - the aggregated rows - to the output.
+        """
+        return None
+
+    def size_hint(self, input_hints):
+        """Return estimated number of rows passed by the node, so the stream can estimate sizes
+        of inputs of the following nodes. `input_hints` is a list of estimated numbers of rows of
+        the node's inputs, ``None`` for unknown. Return ``None`` if the number is not known.
+        Default implementation returns the estimate of the only input of the node - filters are
+        not taken into account.
+
+        Estimates are computed only for nodes with `uses_size_hints` set to ``True``: after all
+        nodes are initialized the stream sets their `input_size_hints` to list of estimates of
+        their inputs.
+        """
+        if len(input_hints) == 1:
+            return input_hints[0]
+        return None
+
+    def input_key_filters(self):
+        """Return list of tuples (`input index`, :class:`KeyFilter`) - filters of input rows by
+        values of key fields, so the stream can drop rows that the node would drop anyway right
+        at the source node of the input, such as rows without a matching key in an inner join.
+        The node should set or cancel all returned filters when it is run, because the source
+        nodes wait for them. Filters are applied only with the ``thread`` executor. Default
+        implementation returns empty list.
+
+        Called by the stream after all nodes are initialized and `input_size_hints` are set.
+        """
+        return []
+
+    def required_input_fields(self, output_names):
+        """Return set of names of input fields the node needs to produce output fields with
+        `output_names`, so the stream can tell source nodes to read only fields that are used.
+        `output_names` is a set of names required by the following nodes or ``None`` if all
+        output fields are required. Returned set might contain names of fields that are not in the
+        input. Return ``None`` if all input fields are required - this is the default
+        implementation.
+
+        Called before the node is initialized, therefore the result should depend only on the
+        node's configuration.
+        """
+        return None
+
+    def _emit_barrier(self):
+        """Pass checkpoint barrier requested by the stream to the outputs. Called by source nodes
+        after data objects were put into the outputs."""
+        number = self._barrier_request
+        self._barrier_request = None
+        self._pass_barrier(number)
+
+    def _pass_barrier(self, number):
+        """Record state of the node for checkpoint `number` and pass the checkpoint barrier to
+        the outputs."""
+        if self._checkpointer:
+            self._checkpointer.node_reached(self, number, self.checkpoint_state())
+
+        for output in self.outputs:
+            if not output.closed():
+                output.put_barrier(number)
+
     def put_record(self, obj):
         """Put record into all output pipes. Convenience method. Not recommended to be used.
 
@@ -293,6 +552,11 @@ class SourceNode(Node):
     .. abstract_node
     
     """
+
+    # Filters of output rows by keys, set by the stream, see Node.input_key_filters()
+    output_key_filters = ()
+    _key_predicates = None
+
     def __init__(self):
         super(SourceNode, self).__init__()
 
@@ -300,9 +564,134 @@ class SourceNode(Node):
     def output_fields(self):
         raise NotImplementedError("SourceNode subclasses should implement output_fields")
 
+    def apply_key_filters(self):
+        """Wait until all `output_key_filters` are set or cancelled and apply them: filters with
+        few keys are pushed into the data source with ``push_filter()`` (see
+        :meth:`KeyFilter.conditions`) if the node can do that, other rows are checked by
+        :meth:`put` and :meth:`put_batch`. Called by the stream before the node is run."""
+
+        self._key_predicates = None
+        predicates = []
+        for key_filter in self.output_key_filters:
+            key_filter.wait()
+            if not key_filter.active:
+                continue
+
+            conditions = key_filter.conditions()
+            if conditions is not None and hasattr(self, "push_filter") \
+                    and self.push_filter(conditions):
+                continue
+            predicates.append(key_filter.predicate(self.output_fields))
+
+        if predicates:
+            self._key_predicates = predicates
+
+    def _passes_key_filters(self, obj):
+        for predicate in self._key_predicates:
+            if not predicate(obj):
+                return False
+        return True
+
+    def put(self, obj):
+        if self._key_predicates and not self._passes_key_filters(obj):
+            return
+        super(SourceNode, self).put(obj)
+
+    def put_batch(self, rows):
+        if self._key_predicates:
+            rows = [row for row in rows if self._passes_key_filters(row)]
+            if not rows:
+                return
+        super(SourceNode, self).put_batch(rows)
+
     def add_input(self, pipe):
         raise Exception("Should not add input pipe to a source node")
 
+class KeyFilter(object):
+    """Filter of rows by values of key `fields`, created by a node that drops rows without
+    matching keys - such as inner join of the merge node - and applied by the source node of the
+    rows. Rows are dropped before they are passed through the other nodes. Keys are known only
+    when the node has read its other inputs, therefore the source node waits until the filter is
+    set by :meth:`set_keys` or cancelled by :meth:`cancel`.
+
+    When there are at most `max_exact_keys` keys, the filter contains the keys and they might be
+    passed to a data source, such as SQL ``IN`` condition. More keys are kept in a
+    :class:`brewery.utils.BloomFilter`: rows with the keys always pass, rows with other keys pass
+    with probability `error_rate`.
+
+    :Attributes:
+        * `fields`: names of key fields
+        * `keys`: set of keys or ``None``
+        * `bloom`: Bloom filter of keys or ``None``
+    """
+
+    max_exact_keys = 1000
+    error_rate = 0.01
+
+    def __init__(self, fields):
+        super(KeyFilter, self).__init__()
+        self.fields = list(fields)
+        self.keys = None
+        self.bloom = None
+        self._ready = threading.Event()
+
+    @property
+    def active(self):
+        """``True`` if the filter has keys."""
+        return self.keys is not None or self.bloom is not None
+
+    @property
+    def finished(self):
+        """``True`` if keys were set or the filter was cancelled."""
+        return self._ready.is_set()
+
+    def set_keys(self, keys, count):
+        """Set keys of rows that pass - iterable of key values for a single field, tuples for
+        compound keys. `count` is number of keys or its upper bound."""
+        if count <= self.max_exact_keys:
+            self.keys = set(keys)
+        else:
+            bloom = utils.BloomFilter(count, self.error_rate)
+            for key in keys:
+                bloom.add(key)
+            self.bloom = bloom
+        self._ready.set()
+
+    def cancel(self):
+        """Pass all rows, the keys will not be set."""
+        self._ready.set()
+
+    def wait(self):
+        """Wait until keys are set or the filter is cancelled."""
+        # Waiting with a timeout can be interrupted
+        while not self._ready.wait(1):
+            pass
+
+    def conditions(self):
+        """Return filter conditions for :meth:`brewery.ds.DataSource.push_filter` - ``in``
+        condition with exact keys of a single field. Returns ``None`` for compound keys, for keys
+        in a Bloom filter and for empty key values, which would not be matched by a database."""
+        if self.keys is None or len(self.fields) != 1 or None in self.keys:
+            return None
+        return [(self.fields[0], "in", list(self.keys))]
+
+    def predicate(self, fields):
+        """Return function that returns ``True`` for rows (lists or records) with `fields` that
+        might have one of the keys."""
+        if self.keys is not None:
+            keys = self.keys
+        else:
+            keys = self.bloom
+        row_key = operator.itemgetter(*fields.indexes(self.fields))
+        record_key = operator.itemgetter(*self.fields)
+
+        def predicate(obj):
+            if isinstance(obj, dict):
+                return record_key(obj) in keys
+            return row_key(obj) in keys
+
+        return predicate
+
 class TargetNode(Node):
     """Abstract class for all target nodes
     
@@ -6,6 +6,7 @@ import re
 import brewery
 import brewery.ds as ds
 from brewery.common import FieldError
+from brewery.utils import expression_names, row_function, function_field_names
 import itertools
 
 class FieldMapNode(base.Node):
@@ -34,6 +35,8 @@ class FieldMapNode(base.Node):
         ]
     }
 
+    supports_checkpoints = True
+
     def __init__(self, map_fields = None, drop_fields = None, keep_fields=None):
         super(FieldMapNode, self).__init__()
 
@@ -74,12 +77,25 @@ class FieldMapNode(base.Node):
         self._output_fields = self.map.map(self.input.fields)
         self.filter = self.map.row_filter(self.input.fields)
 
-    def run(self):
-        self.mapped_field_names = self.mapped_fields.keys()
+    def required_input_fields(self, output_names):
+        renamed = dict((target, source) for (source, target) in self.mapped_fields.items())
 
-        for row in self.input.rows():
-            row = self.filter.filter(row)
-            self.put(row)
+        if output_names is None:
+            if self.kept_fields:
+                return set(self.kept_fields)
+            return None
+
+        names = set(renamed.get(name, name) for name in output_names)
+        if self.kept_fields:
+            names &= self.kept_fields
+        return names
+
+    def process_row(self, row):
+        return self.filter.filter(row)
+
+    def process_batch(self, rows):
+        row_filter = self.filter.filter
+        return [row_filter(row) for row in rows]
 
 class TextSubstituteNode(base.Node):
     """Substitute text in a field using regular expression."""
@@ -107,11 +123,31 @@ class TextSubstituteNode(base.Node):
                 "description": "List of substitutions: each substition is a two-element tuple "
                                "(`pattern`, `replacement`) where `pattern` is a regular expression "
                                "that will be replaced using `replacement`"
+            },
+            {
+                "name": "workers",
+                "description": "Number of workers processing batches in parallel. Default is 1"
+            },
+            {
+                "name": "worker_type",
+                "description": "Type of workers: process (default) or thread"
+            },
+            {
+                "name": "pure",
+                "description": "Flag whether substitutions of recently seen values are cached. "
+                               "Default is False"
+            },
+            {
+                "name": "cache_size",
+                "description": "Maximal number of cached results. Default is 10000"
             }
         ]
     }
 
-    def __init__(self, field, derived_field = None):
+    supports_checkpoints = True
+
+    def __init__(self, field, derived_field = None, workers = 1, worker_type = "process",
+                 pure = False, cache_size = 10000):
         """Creates a node for text replacement.
         
         :Attributes:
@@ -119,6 +155,12 @@ class TextSubstituteNode(base.Node):
             * `derived_field`: new field to be created after substitutions. If set to ``None`` then the
               source field will be replaced with new substituted value. Default is ``None`` - same field
               replacement.
+            * `workers`: number of workers substituting batches of rows in parallel, see
+              :meth:`brewery.nodes.Node.start_workers`. Default is 1 - no workers.
+            * `worker_type`: ``process`` (default) or ``thread``
+            * `pure`: if ``True``, then substitutions of recently seen values are cached, see
+              :meth:`brewery.nodes.Node.start_cache`. Default is ``False``.
+            * `cache_size`: maximal number of cached substitutions. Default is 10000.
         
         """
         super(TextSubstituteNode, self).__init__()
@@ -126,6 +168,10 @@ class TextSubstituteNode(base.Node):
         self.field = field
         self.derived_field = derived_field
         self.substitutions = []
+        self.workers = workers
+        self.worker_type = worker_type
+        self.pure = pure
+        self.cache_size = cache_size
         
     def add_substitution(self, pattern, repl):
         """Add replacement rule for field.
@@ -141,27 +187,36 @@ class TextSubstituteNode(base.Node):
     # @property
     # def output_fields(self):
     #     pass
-        
-    def run(self):
-        pipe = self.input
 
-        if self.derived_field:
-            append = True
+    def initialize(self):
+        self.index = self.input_fields.index(self.field)
+        self.start_cache()
+        self.start_workers()
+
+    def required_input_fields(self, output_names):
+        if output_names is None:
+            return None
+        return output_names | set([self.field])
+
+    def substitute(self, value):
+        """Return `value` with all substitutions applied."""
+        for (pattern, repl) in self.substitutions:
+            value = re.sub(pattern, repl, value)
+        return value
+
+    def process_row(self, row):
+        value = row[self.index]
+        if self._cache is None:
+            value = self.substitute(value)
         else:
-            append = False
+            value = self._cache.get((value, ), self.substitute, value)
 
-        index = self.input_fields.index(self.field)
-            
-        for row in pipe.rows():
-            value = row[index]
-            for (pattern, repl) in self.substitutions:
-                value = re.sub(pattern, repl, value)
-            if append:
-                row.append(value)
-            else:
-                row[index] = value
+        if self.derived_field:
+            row.append(value)
+        else:
+            row[self.index] = value
 
-            self.put(row)
+        return row
 
 
 class StringStripNode(base.Node):
@@ -186,6 +241,8 @@ class StringStripNode(base.Node):
         ]
     }
 
+    supports_checkpoints = True
+
     def __init__(self, fields = None, chars = None):
         """Creates a node for string stripping.
 
@@ -199,8 +256,7 @@ class StringStripNode(base.Node):
         self.fields = fields
         self.chars = chars
 
-    def run(self):
-
+    def initialize(self):
         if self.fields:
             fields = self.fields
         else:
@@ -209,15 +265,30 @@ class StringStripNode(base.Node):
                 if field.storage_type == "string" or field.storage_type == "text":
                     fields.append(field)
 
-        indexes = self.input_fields.indexes(fields)
+        self.indexes = self.input_fields.indexes(fields)
 
-        for row in self.input.rows():
-            for index in indexes:
+    def required_input_fields(self, output_names):
+        if output_names is None:
+            return None
+        return output_names | set(str(field) for field in self.fields or [])
+
+    def process_row(self, row):
+        for index in self.indexes:
+            value = row[index]
+            if value:
+                row[index] = value.strip(self.chars)
+
+        return row
+
+    def process_batch(self, rows):
+        chars = self.chars
+        for index in self.indexes:
+            for row in rows:
                 value = row[index]
                 if value:
-                    row[index] = value.strip(self.chars)
+                    row[index] = value.strip(chars)
 
-            self.put(row)
+        return rows
 
 class CoalesceValueToTypeNode(base.Node):
     """Coalesce values of selected fields, or fields of given type to match the type.
@@ -250,14 +321,38 @@ class CoalesceValueToTypeNode(base.Node):
                 "name": "empty_values",
                 "description": "dictionary of type -> value pairs to be set when field is "
                                "considered empty (null)"
+            },
+            {
+                "name": "workers",
+                "description": "Number of workers processing batches in parallel. Default is 1"
+            },
+            {
+                "name": "worker_type",
+                "description": "Type of workers: process (default) or thread"
+            },
+            {
+                "name": "pure",
+                "description": "Flag whether numbers coalesced from recently seen values are "
+                               "cached. Default is False"
+            },
+            {
+                "name": "cache_size",
+                "description": "Maximal number of cached results. Default is 10000"
             }
         ]
     }
 
-    def __init__(self, fields = None, types = None, empty_values = None):
+    supports_checkpoints = True
+
+    def __init__(self, fields = None, types = None, empty_values = None, workers = 1,
+                 worker_type = "process", pure = False, cache_size = 10000):
         super(CoalesceValueToTypeNode, self).__init__()
         self.fields = fields
         self.types = types
+        self.workers = workers
+        self.worker_type = worker_type
+        self.pure = pure
+        self.cache_size = cache_size
 
         if empty_values:
             self.empty_values = empty_values
@@ -281,47 +376,66 @@ class CoalesceValueToTypeNode(base.Node):
         self.string_none = self.empty_values.get("string")
         self.integer_none = self.empty_values.get("integer")
         self.float_none = self.empty_values.get("float")
+
+        self.start_cache()
+        self.start_workers()
+
+    def required_input_fields(self, output_names):
+        if output_names is None:
+            return None
+        return output_names | set(str(field) for field in self.fields or [])
         
-    def run(self):
-        
-        for row in self.input.rows():
-            for i in self.string_indexes:
-                value = row[i]
-                if type(value) == str or type(value) == unicode:
-                    value = value.strip()
-                elif value:
-                    value = unicode(value)
-                    
-                if value == "" or value is None:
-                    value = self.string_none
+    def coalesce_string(self, value):
+        if type(value) == str or type(value) == unicode:
+            value = value.strip()
+        elif value:
+            value = unicode(value)
 
-                row[i] = value
+        if value == "" or value is None:
+            value = self.string_none
 
-            for i in self.integer_indexes:
-                value = row[i]
-                if type(value) == str or type(value) == unicode:
-                    value = re.sub(r"\s", "", value.strip())
+        return value
 
-                try:
-                    value = int(value)
-                except:
-                    value = self.integer_none
+    def coalesce_integer(self, value):
+        if type(value) == str or type(value) == unicode:
+            value = re.sub(r"\s", "", value.strip())
 
-                row[i] = value
+        try:
+            value = int(value)
+        except:
+            value = self.integer_none
 
-            for i in self.float_indexes:
-                value = row[i]
-                if type(value) == str or type(value) == unicode:
-                    value = re.sub(r"\s", "", value.strip())
+        return value
 
-                try:
-                    value = float(value)
-                except:
-                    value = self.float_none
+    def coalesce_float(self, value):
+        if type(value) == str or type(value) == unicode:
+            value = re.sub(r"\s", "", value.strip())
 
-                row[i] = value
-        
-            self.put(row)
+        try:
+            value = float(value)
+        except:
+            value = self.float_none
+
+        return value
+
+    def process_row(self, row):
+        # Stripping a string is cheaper than a cache lookup, only numbers are cached
+        for i in self.string_indexes:
+            row[i] = self.coalesce_string(row[i])
+
+        cache = self._cache
+        conversions = ((self.integer_indexes, "integer", self.coalesce_integer),
+                       (self.float_indexes, "float", self.coalesce_float))
+
+        for (indexes, storage_type, coalesce) in conversions:
+            for i in indexes:
+                value = row[i]
+                if cache is None:
+                    row[i] = coalesce(value)
+                else:
+                    row[i] = cache.get((storage_type, value), coalesce, value)
+
+        return row
 
 class ValueThresholdNode(base.Node):
     """Create a field that will refer to a value bin based on threshold(s). Values of `range` type
@@ -487,6 +601,14 @@ class DeriveNode(base.Node):
 
         node.formula = "i / 2"
 
+    Results of expensive formulas, which depend only on the field values, can be cached by
+    declaring the node `pure`. The formula is then evaluated once for the same values of fields
+    used by the formula (all fields for callables with ``**record``):
+
+    .. code-block:: python
+
+        node = DeriveNode(lookup_country, "country", pure=True, cache_size=50000)
+
     """
 
     node_info = {
@@ -512,20 +634,47 @@ class DeriveNode(base.Node):
                 "name": "storage_type",
                  "description": "Storage type of the new field",
                  "default": "unknown"
+            },
+            {
+                "name": "workers",
+                "description": "Number of workers processing batches in parallel. Default is 1"
+            },
+            {
+                "name": "worker_type",
+                "description": "Type of workers: process (default) or thread"
+            },
+            {
+                "name": "pure",
+                "description": "Flag whether the formula depends only on values of the fields, "
+                               "results are then cached. Default is False"
+            },
+            {
+                "name": "cache_size",
+                "description": "Maximal number of cached results. Default is 10000"
             }
         ]
     }
 
+    supports_checkpoints = True
+
 
     def __init__(self, formula = None, field_name = "new_field", analytical_type = "unknown",
-                        storage_type = "unknown"):
-        """Creates and initializes selection node
+                        storage_type = "unknown", workers = 1, worker_type = "process",
+                        pure = False, cache_size = 10000):
+        """Creates and initializes selection node. Expensive formulas can be evaluated in
+        parallel by `workers` processes (or threads if `worker_type` is ``thread``), see
+        :meth:`brewery.nodes.Node.start_workers`. Results of `pure` formulas are cached, see
+        :meth:`brewery.nodes.Node.start_cache`.
         """
         super(DeriveNode, self).__init__()
         self.formula = formula
         self.field_name = field_name
         self.analytical_type = analytical_type
         self.storage_type = storage_type
+        self.workers = workers
+        self.worker_type = worker_type
+        self.pure = pure
+        self.cache_size = cache_size
         self._output_fields = None
 
     @property
@@ -533,11 +682,27 @@ class DeriveNode(base.Node):
         return self._output_fields
 
     def initialize(self):
-        if isinstance(self.formula, basestring):
-            self._expression = compile(self.formula, "SelectNode condition", "eval")
-            self._formula_callable = self._eval_expression
+        input_names = self.input.fields.names()
+
+        # Formula is evaluated directly on rows, without creating records
+        if self.formula:
+            self._row_formula = row_function(self.formula, input_names, globals(),
+                                             "DeriveNode formula")
+        else:
+            self._row_formula = None
+
+        # Cached results are keyed by values of fields used by the formula
+        names = function_field_names(self.formula, input_names) if self.formula else None
+        if names is None:
+            self._key_indexes = range(len(input_names))
+        else:
+            self._key_indexes = [input_names.index(name) for name in names]
+
+        # Derived field might replace an input field
+        if self.field_name in input_names:
+            self._replaced_index = input_names.index(self.field_name)
         else:
-            self._formula_callable = self.formula
+            self._replaced_index = None
 
         self._output_fields = brewery.FieldList()
 
@@ -548,17 +713,32 @@ class DeriveNode(base.Node):
                                   storage_type = self.storage_type)
         self._output_fields.append(new_field)
 
-    def _eval_expression(self, **record):
-        return eval(self._expression, None, record)
+        self.start_cache()
+        self.start_workers()
+
+    def required_input_fields(self, output_names):
+        if output_names is None or not isinstance(self.formula, basestring):
+            return None
+        names = expression_names(self.formula)
+        if names is None:
+            return None
+        return (output_names - set([self.field_name])) | names
+
+    def process_row(self, row):
+        if not self._row_formula:
+            value = None
+        elif self._cache is None:
+            value = self._row_formula(row)
+        else:
+            key = tuple([row[i] for i in self._key_indexes])
+            value = self._cache.get(key, self._row_formula, row)
 
-    def run(self):
-        for record in self.input.records():
-            if self._formula_callable:
-                record[self.field_name] = self._formula_callable(**record)
-            else:
-                record[self.field_name] = None
+        row = list(row)
+        if self._replaced_index is not None:
+            row[self._replaced_index] = value
+        row.append(value)
 
-            self.put_record(record)
+        return row
 
 class BinningNode(base.Node):
     """Derive a bin/category field from a value.
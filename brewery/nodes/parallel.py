@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Pools of workers used by nodes that process their input in parallel."""
+
+import multiprocessing
+import threading
+import os
+import errno
+import Queue
+import collections
+import traceback
+from brewery.common import StreamError
+
+__all__ = (
+    "WorkerPool",
+    "OrderedBatchMap"
+)
+
+# Interval in seconds in which the pool checks whether its workers are alive
+WORKER_POLL_INTERVAL = 0.1
+
+class WorkerPool(object):
+    """Pool of workers running in separate processes (or threads). Each worker has its own
+    queue of messages, therefore messages with the same key might be sent to the same worker
+    (partitioning).
+
+    Worker is an object with two methods:
+
+    * ``process(message)`` - process a message and return reply or ``None`` when there is nothing
+      to reply
+    * ``finish()`` - called after the last message, returns final result of the worker
+
+    Worker object is copied to the worker processes when the pool is started, therefore the pool
+    should be started from the main thread before the stream starts running, for example in node's
+    :meth:`brewery.nodes.Node.initialize`. Messages, replies and results have to be picklable.
+    Workers should not use logging.
+
+    :Parameters:
+        * `worker`: worker object or list of worker objects, one for each worker. Single worker
+          object is shared by all worker threads, processes get their own copy.
+        * `count`: number of workers, ignored if list of workers is given
+        * `processes`: if ``True`` (default) then workers run in separate processes, otherwise in
+          threads. Threads are sufficient for workers that spend most of the time in I/O.
+        * `depth`: maximal number of messages waiting in a worker's queue. Default is 2.
+    """
+
+    def __init__(self, worker, count=None, processes=True, depth=2):
+        super(WorkerPool, self).__init__()
+
+        if isinstance(worker, (list, tuple)):
+            self.workers = list(worker)
+        else:
+            self.workers = [worker] * (count or 1)
+
+        self.processes = processes
+        self.depth = depth
+
+        self._inboxes = []
+        self._outbox = None
+        self._handles = []
+        self._pending = collections.deque()
+        self._finished = set()
+        self._results = []
+        self._owner_pid = None
+
+    @property
+    def count(self):
+        """Number of workers in the pool"""
+        return len(self.workers)
+
+    def start(self):
+        """Start the workers."""
+
+        if self.processes:
+            queue_class = multiprocessing.Queue
+            handle_class = multiprocessing.Process
+        else:
+            queue_class = Queue.Queue
+            handle_class = threading.Thread
+
+        self._owner_pid = os.getpid()
+        self._outbox = queue_class()
+        self._pending.clear()
+        self._finished = set()
+        self._results = [None] * self.count
+
+        for (index, worker) in enumerate(self.workers):
+            inbox = queue_class(self.depth)
+            handle = handle_class(target=_worker_loop,
+                                  args=(worker, index, inbox, self._outbox))
+            handle.daemon = True
+            self._inboxes.append(inbox)
+            self._handles.append(handle)
+
+        for handle in self._handles:
+            handle.start()
+
+    def send(self, index, message):
+        """Send `message` to worker `index`. Blocks while the worker's queue is full."""
+        inbox = self._inboxes[index]
+        while True:
+            try:
+                inbox.put(message, True, WORKER_POLL_INTERVAL)
+                return
+            except Queue.Full:
+                if not self._is_alive(index):
+                    self._drain()
+                    raise StreamError("Worker %d terminated unexpectedly" % index)
+
+    def receive(self):
+        """Wait for a reply from any of the workers. Returns tuple (`index`, `reply`). Raises
+        `StreamError` when a worker failed."""
+
+        while True:
+            (index, kind, value) = self._next_message()
+            if kind == "reply":
+                return (index, value)
+
+    def finish(self):
+        """Tell all workers that there are no more messages and wait for their final results.
+        Returns list of results in order of workers. Replies to messages that were not received
+        yet are discarded."""
+
+        for index in range(self.count):
+            self.send(index, None)
+
+        while len(self._finished) < self.count:
+            self._next_message()
+
+        self.terminate()
+
+        return self._results
+
+    def _next_message(self):
+        """Wait for next message from the workers and return it as tuple (`index`, `kind`,
+        `value`). Results of finished workers are recorded."""
+
+        while True:
+            if self._pending:
+                (index, kind, value) = self._pending.popleft()
+            else:
+                try:
+                    (index, kind, value) = self._outbox.get(True, WORKER_POLL_INTERVAL)
+                except Queue.Empty:
+                    self._check_alive()
+                    continue
+
+            if kind == "error":
+                raise StreamError("Worker %d failed: %s" % (index, value))
+            elif kind == "finish":
+                self._finished.add(index)
+                self._results[index] = value
+
+            return (index, kind, value)
+
+    def terminate(self):
+        """Stop all workers. Unfinished work is discarded."""
+
+        for (index, handle) in enumerate(self._handles):
+            if not self._is_alive(index):
+                continue
+            if self.processes:
+                handle.terminate()
+            else:
+                try:
+                    self._inboxes[index].put_nowait(None)
+                except Queue.Full:
+                    pass
+
+        # Only the process that started the workers can wait for them
+        if self.processes and self._owner_pid == os.getpid():
+            for handle in self._handles:
+                handle.join()
+
+        self._inboxes = []
+        self._handles = []
+
+    def _check_alive(self):
+        """Raise `StreamError` if a worker terminated without finishing."""
+        for index in range(len(self._handles)):
+            if index not in self._finished and not self._is_alive(index):
+                # The worker might have reported a failure or result before it terminated
+                self._drain()
+                if not self._pending:
+                    raise StreamError("Worker %d terminated unexpectedly" % index)
+                return
+
+    def _is_alive(self, index):
+        """Return ``True`` if worker `index` is running. The pool might be used from a process
+        forked after the pool was started (such as with the ``process`` stream executor)."""
+        handle = self._handles[index]
+        if not self.processes or self._owner_pid == os.getpid():
+            return handle.is_alive()
+
+        try:
+            os.kill(handle.pid, 0)
+        except OSError as e:
+            return e.errno != errno.ESRCH
+        return True
+
+    def _drain(self):
+        """Move all messages from the output queue to the pending messages. Raise `StreamError`
+        if there is a failure report."""
+        while True:
+            try:
+                item = self._outbox.get_nowait()
+            except Queue.Empty:
+                return
+            if item[1] == "error":
+                raise StreamError("Worker %d failed: %s" % (item[0], item[2]))
+            self._pending.append(item)
+
+def _worker_loop(worker, index, inbox, outbox):
+    """Body of a worker process or thread."""
+
+    try:
+        while True:
+            message = inbox.get()
+            if message is None:
+                outbox.put((index, "finish", worker.finish()))
+                return
+
+            reply = worker.process(message)
+            if reply is not None:
+                outbox.put((index, "reply", reply))
+    except Exception as e:
+        message = "%s: %s\n%s" % (e.__class__.__name__, e, traceback.format_exc())
+        outbox.put((index, "error", message))
+
+class OrderedBatchMap(object):
+    """Passes batches of rows through :meth:`brewery.nodes.Node.process_batch` of a node in a
+    pool of workers. Batches are distributed among the workers round-robin and results are
+    re-sequenced by batch number, therefore order of output rows is the same as order of input
+    rows.
+
+    Worker processes have their own copies of the node cache (see
+    :meth:`brewery.nodes.Node.start_cache`), their hit and miss counters are added to the node's
+    cache when the workers are finished.
+
+    :Parameters:
+        * `node`: node which processes the batches, it should not keep any state between rows
+        * `workers`: number of workers
+        * `processes`: if ``True`` (default) then workers run in separate processes, otherwise in
+          threads
+    """
+
+    def __init__(self, node, workers, processes=True):
+        super(OrderedBatchMap, self).__init__()
+        self.node = node
+        self.processes = processes
+        self.pool = WorkerPool(_BatchWorker(node), workers, processes)
+
+    def start(self):
+        """Start the workers."""
+        self.pool.start()
+
+    def map(self, batches):
+        """Iterate over processed `batches` in their original order."""
+
+        pool = self.pool
+        # Keep every worker busy while the oldest batch is being processed
+        window = 2 * pool.count
+        done = {}
+        sent = 0
+        next_batch = 0
+
+        for batch in batches:
+            pool.send(sent % pool.count, (sent, batch))
+            sent += 1
+
+            while sent - next_batch >= window:
+                (number, rows) = pool.receive()[1]
+                done[number] = rows
+                while next_batch in done:
+                    yield done.pop(next_batch)
+                    next_batch += 1
+
+        while next_batch < sent:
+            (number, rows) = pool.receive()[1]
+            done[number] = rows
+            while next_batch in done:
+                yield done.pop(next_batch)
+                next_batch += 1
+
+        results = pool.finish()
+
+        cache = self.node._cache
+        if self.processes and cache is not None:
+            for (hits, misses) in results:
+                cache.hits += hits
+                cache.misses += misses
+
+    def terminate(self):
+        """Stop the workers."""
+        self.pool.terminate()
+
+class _BatchWorker(object):
+    """Worker of :class:`OrderedBatchMap`."""
+
+    def __init__(self, node):
+        self.node = node
+
+    def process(self, message):
+        (number, rows) = message
+        return (number, self.node.process_batch(rows))
+
+    def finish(self):
+        cache = self.node._cache
+        if cache is None:
+            return None
+        return (cache.hits, cache.misses)
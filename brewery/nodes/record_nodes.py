@@ -5,8 +5,19 @@ import base
 import brewery
 import brewery.ds as ds
 import brewery.dq as dq
+import brewery.aggregates
 import logging
 import itertools
+import operator
+import heapq
+import ast
+import inspect
+import os
+import tempfile
+import cPickle as pickle
+from parallel import WorkerPool
+from brewery.common import StreamError
+from brewery.utils import expression_names, row_function
 
 class SampleNode(base.Node):
     """Create a data sample from input stream. There are more sampling possibilities:
@@ -38,7 +49,9 @@ class SampleNode(base.Node):
             }
         ]
     }
-    
+
+    supports_checkpoints = True
+    _resume_count = 0
 
     def __init__(self, size = 1000, discard_sample = False, mode = None):
         """Creates and initializes sample node
@@ -54,15 +67,47 @@ class SampleNode(base.Node):
         self.size = size
         self.discard_sample = discard_sample
 
+    def initialize(self):
+        self._count = self._resume_count
+        self._resume_count = 0
+
+    def required_input_fields(self, output_names):
+        return output_names
+
+    def size_hint(self, input_hints):
+        if input_hints[0] is None:
+            return None
+        if self.discard_sample:
+            return max(input_hints[0] - self.size, 0)
+        return min(input_hints[0], self.size)
+
+    def checkpoint_state(self):
+        return self._count
+
+    def restore_state(self, state):
+        self._resume_count = state
+
+    def process_row(self, row):
+        if self._count >= self.size:
+            raise base.NodeFinished
+        self._count += 1
+        return row
+
+    def process_batch(self, rows):
+        if self._count >= self.size:
+            raise base.NodeFinished
+
+        count = self._count + len(rows)
+        if count > self.size:
+            rows = rows[:self.size - self._count]
+            count = self.size
+        self._count = count
+        return rows
+
     def run(self):
-        pipe = self.input
-        count = 0
-        
-        for row in pipe.rows():
-            logging.debug("sampling row %d" % count)
-            self.put(row)
-            count += 1
-            if count >= self.size:
+        for batch in self.input.batches():
+            self.put_batch(self.process_batch(batch))
+            if self._count >= self.size:
                 break
 
 class AppendNode(base.Node):
@@ -84,11 +129,391 @@ class AppendNode(base.Node):
 
         return self.inputs[0].fields
 
+    def required_input_fields(self, output_names):
+        return output_names
+
+    def size_hint(self, input_hints):
+        if None in input_hints:
+            return None
+        return sum(input_hints)
+
     def run(self):
         """Append data objects from inputs sequentially."""
         for pipe in self.inputs:
-            for row in pipe.rows():
-                self.put(row)
+            for batch in pipe.batches():
+                self.put_batch(batch)
+
+# Number of items pickled together in temporary files of spilled data
+SPILL_CHUNK_SIZE = 1000
+
+# Number of batches sent to parallel workers of distinct node before the first one is passed
+PARALLEL_BATCH_WINDOW = 4
+
+def _partition_keys(rows, key_getter, index, count):
+    """Return list of tuples (`offset`, `key`) of `rows` with keys in hash partition `index` of
+    `count` partitions. Keys are extracted by item getter `key_getter`. Parallel workers get
+    whole batches and select rows of their partition themselves."""
+    keys = map(key_getter, rows)
+    return [(offset, key) for (offset, key) in enumerate(keys) if hash(key) % count == index]
+
+def _key_getter(key_selectors):
+    """Return item getter of key fields selected by `key_selectors`: a value for single field
+    keys, a tuple for compound keys."""
+    indexes = [index for (index, selected) in enumerate(key_selectors) if selected]
+    if not indexes:
+        return _empty_key
+    return operator.itemgetter(*indexes)
+
+def _empty_key(row):
+    return ()
+
+class _SpillFile(object):
+    """Temporary file of items which do not fit into memory. Items are pickled in chunks of
+    `SPILL_CHUNK_SIZE`. The file is removed when closed.
+
+    A `named` file can be passed to another process: :meth:`detach` closes the file and returns
+    its path, :meth:`reopen` opens it in the other process."""
+
+    def __init__(self, temp_dir=None, named=False):
+        if named:
+            self.handle = tempfile.NamedTemporaryFile(dir=temp_dir, delete=False)
+        else:
+            self.handle = tempfile.TemporaryFile(dir=temp_dir)
+        self.path = self.handle.name if named else None
+        self.buffer = []
+
+    @classmethod
+    def reopen(cls, path):
+        """Return named spill file at `path` returned by :meth:`detach`."""
+        spill_file = cls.__new__(cls)
+        spill_file.handle = open(path, "r+b")
+        spill_file.path = path
+        spill_file.buffer = []
+        return spill_file
+
+    def detach(self):
+        """Write all items, close the named file without removing it and return its path."""
+        self.flush()
+        self.handle.close()
+        return self.path
+
+    def append(self, item):
+        self.buffer.append(item)
+        if len(self.buffer) >= SPILL_CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            pickle.dump(self.buffer, self.handle, pickle.HIGHEST_PROTOCOL)
+            self.buffer = []
+
+    def __iter__(self):
+        """Iterate over all items in order they were appended."""
+        self.flush()
+        self.handle.seek(0)
+        while True:
+            try:
+                chunk = pickle.load(self.handle)
+            except EOFError:
+                return
+            for item in chunk:
+                yield item
+
+    def close(self):
+        self.handle.close()
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+class _SpillPartitions(object):
+    """Temporary files of hash partitions of items. Items with equal keys are in the same
+    partition, in order they were added."""
+
+    def __init__(self, count, temp_dir=None):
+        self.files = [_SpillFile(temp_dir) for i in range(count)]
+
+    def add(self, key, item):
+        # Input of parallel workers is partitioned by hash(key) already
+        self.files[hash((key, )) % len(self.files)].append(item)
+
+    def close(self):
+        for spill_file in self.files:
+            spill_file.close()
+
+# Join types which pass master rows without matching detail rows
+_MASTER_OUTER_JOINS = ("left", "full")
+# Join types which pass detail rows without matching master rows
+_DETAIL_OUTER_JOINS = ("right", "full")
+
+class _MatchedRows(object):
+    """Detail rows matching master rows of :class:`MergeNode` which keeps master rows in memory,
+    by position of the master row. When there are `max_rows` rows in memory, they are sorted by
+    position and written to a temporary file. Sorted files are merged by :meth:`groups`."""
+
+    def __init__(self, max_rows, temp_dir=None):
+        self.max_rows = max_rows
+        self.temp_dir = temp_dir
+        # Items are tuples (position, sequence number, row), the sequence number keeps rows of
+        # a master row in order they were added
+        self.items = []
+        self.count = 0
+        self.spill_files = []
+
+    def add(self, position, row):
+        self.items.append((position, self.count, row))
+        self.count += 1
+        if len(self.items) >= self.max_rows:
+            self.spill()
+
+    def spill(self):
+        """Write rows in memory sorted by position to a temporary file."""
+        self.items.sort()
+        spill_file = _SpillFile(self.temp_dir)
+        for item in self.items:
+            spill_file.append(item)
+        spill_file.flush()
+        self.spill_files.append(spill_file)
+        self.items = []
+
+    def groups(self):
+        """Iterate over tuples (`position`, `rows`) ordered by position."""
+        self.items.sort()
+        items = heapq.merge(self.items, *self.spill_files)
+        for (position, group) in itertools.groupby(items, operator.itemgetter(0)):
+            yield (position, [item[2] for item in group])
+
+    def close(self):
+        for spill_file in self.spill_files:
+            spill_file.close()
+
+class _JoinDetail(object):
+    """Rows of a detail input of :class:`MergeNode` by key. Rows are kept in memory until there
+    are more than `max_rows` rows, then all rows are hash-partitioned by key into temporary files
+    and the join is done partition by partition (grace hash join).
+
+    :Parameters:
+        * `row_filter`: row filter of the field map of the input or ``None``
+        * `max_rows`: maximal number of rows in memory, ``None`` - no limit
+        * `partitions`: number of temporary files
+        * `temp_dir`: directory of temporary files
+        * `keep_order`: keep rows in input order as well, used to pass rows without matching
+          master rows in the input order
+    """
+
+    def __init__(self, row_filter=None, max_rows=None, partitions=16, temp_dir=None,
+                 keep_order=False):
+        self.row_filter = row_filter
+        self.max_rows = max_rows
+        self.partitions = partitions
+        self.temp_dir = temp_dir
+        self.keep_order = keep_order
+        self.rows = {}
+        if keep_order:
+            self.ordered_rows = []
+        else:
+            self.ordered_rows = None
+        self.spill_files = None
+        self.unmatched_files = []
+        self.row_count = 0
+
+    @property
+    def spilled(self):
+        """``True`` if the rows are in temporary files."""
+        return self.spill_files is not None
+
+    def read(self, rows, key_getter):
+        """Read detail `rows`, `key_getter` returns key of a row. All rows of a key are kept in
+        input order."""
+
+        max_rows = self.max_rows
+        detail = self.rows
+        ordered_rows = self.ordered_rows
+        count = 0
+
+        for (position, row) in enumerate(rows):
+            key = key_getter(row)
+            if self.row_filter:
+                row = self.row_filter.filter(row)
+            self.row_count += 1
+
+            if self.spill_files is not None:
+                self.spill_files.add(key, (key, position, row))
+                continue
+
+            matches = detail.get(key)
+            if matches is None:
+                detail[key] = [row]
+            else:
+                matches.append(row)
+            if ordered_rows is not None:
+                ordered_rows.append((key, row))
+
+            count += 1
+            if max_rows and count > max_rows:
+                self.spill()
+
+    def spill(self):
+        """Move rows from memory to temporary files."""
+        self.spill_files = _SpillPartitions(self.partitions, self.temp_dir)
+        if self.ordered_rows is not None:
+            for (position, (key, row)) in enumerate(self.ordered_rows):
+                self.spill_files.add(key, (key, position, row))
+        else:
+            # Positions are used only to order unmatched rows
+            for (key, rows) in self.rows.items():
+                for row in rows:
+                    self.spill_files.add(key, (key, None, row))
+        self.rows = {}
+        self.ordered_rows = None
+
+    def join(self, items, key_getter, index, join_type, empty_row, keep_failed=False):
+        """Join spilled rows to `items` - tuples (`position`, `master row`, `details`) ordered by
+        position, where `details` is list of lists of joined detail rows. Rows of this detail are
+        set at `index` of `details`, ``[empty_row]`` if there are none and the join is outer,
+        ``False`` otherwise. `key_getter` returns key of a master row. Items without matching
+        rows are discarded, unless `keep_failed` is ``True``. Returns iterator of joined items
+        ordered by position.
+
+        For right and full outer joins the rows without matching master rows are kept in
+        temporary files and returned by :meth:`unmatched_rows`."""
+
+        missing = [empty_row] if join_type in _MASTER_OUTER_JOINS else False
+        track_unmatched = join_type in _DETAIL_OUTER_JOINS
+
+        master_files = _SpillPartitions(self.partitions, self.temp_dir)
+        result_files = []
+
+        try:
+            for item in items:
+                master_files.add(key_getter(item[1]), item)
+
+            # Partitions are joined one by one, only rows of one partition are in memory
+            for (detail_file, master_file) in zip(self.spill_files.files, master_files.files):
+                detail = {}
+                for (key, position, row) in detail_file:
+                    matches = detail.get(key)
+                    if matches is None:
+                        detail[key] = [row]
+                    else:
+                        matches.append(row)
+
+                if track_unmatched:
+                    matched = set()
+                else:
+                    matched = None
+
+                result_file = _SpillFile(self.temp_dir)
+                result_files.append(result_file)
+                for item in master_file:
+                    key = key_getter(item[1])
+                    if matched is not None:
+                        matched.add(key)
+                    matches = detail.get(key, missing)
+                    if matches is False and not keep_failed:
+                        continue
+                    item[2][index] = matches
+                    result_file.append(item)
+                master_file.close()
+
+                if matched is not None:
+                    self._spill_unmatched(detail_file, matched)
+                detail_file.close()
+
+            for item in heapq.merge(*result_files):
+                yield item
+        finally:
+            self.spill_files.close()
+            master_files.close()
+            for result_file in result_files:
+                result_file.close()
+
+    def _spill_unmatched(self, detail_file, matched):
+        """Write rows of `detail_file` partition with keys not in `matched` to a temporary
+        file."""
+        unmatched_file = _SpillFile(self.temp_dir)
+        self.unmatched_files.append(unmatched_file)
+        for (key, position, row) in detail_file:
+            if key not in matched:
+                unmatched_file.append((position, row))
+
+    def unmatched_rows(self):
+        """Iterate over spilled rows without matching master rows in input order."""
+        try:
+            for (position, row) in heapq.merge(*self.unmatched_files):
+                yield row
+        finally:
+            for unmatched_file in self.unmatched_files:
+                unmatched_file.close()
+
+class _SortedJoinDetail(object):
+    """Detail input of :class:`MergeNode` sorted by key, read together with master input sorted by
+    the same key. Only rows of the current key are kept.
+
+    :Parameters:
+        * `rows`: iterator of detail rows
+        * `key_getter`: function returning key of a detail row
+        * `row_filter`: row filter of the field map of the input or ``None``
+        * `keep_unmatched`: collect rows without matching master rows in `unmatched`
+    """
+
+    def __init__(self, rows, key_getter, row_filter=None, keep_unmatched=False):
+        self.rows = iter(rows)
+        self.key_getter = key_getter
+        self.row_filter = row_filter
+        self.key = None
+        self.matches = None
+        if keep_unmatched:
+            self.unmatched = []
+        else:
+            self.unmatched = None
+        self._next = None
+        self._advance()
+
+    def _advance(self):
+        """Read next row into `_next` as (`key`, `row`), ``None`` at the end of input."""
+        previous = self._next
+        try:
+            row = self.rows.next()
+        except StopIteration:
+            self._next = None
+            return
+
+        key = self.key_getter(row)
+        if previous is not None and key < previous[0]:
+            raise StreamError("Detail input of merge node is not sorted by key: %s after %s"
+                              % (key, previous[0]))
+        if self.row_filter:
+            row = self.row_filter.filter(row)
+        self._next = (key, row)
+
+    def lookup(self, key):
+        """Return list of detail rows with `key` or ``None``. Keys have to be looked up in
+        ascending order. Skipped rows are collected in `unmatched`, if requested."""
+
+        if self.matches is not None and key == self.key:
+            return self.matches
+
+        while self._next is not None and self._next[0] < key:
+            if self.unmatched is not None:
+                self.unmatched.append(self._next[1])
+            self._advance()
+
+        if self._next is None or self._next[0] != key:
+            return None
+
+        self.key = key
+        self.matches = []
+        while self._next is not None and self._next[0] == key:
+            self.matches.append(self._next[1])
+            self._advance()
+
+        return self.matches
+
+    def remaining_rows(self):
+        """Iterate over rows that were not read yet."""
+        while self._next is not None:
+            row = self._next[1]
+            self._advance()
+            yield row
 
 class MergeNode(base.Node):
     """Merge two or more streams (join).
@@ -152,19 +577,64 @@ class MergeNode(base.Node):
     The first option is preferred, the dicitonary based option is provided for convenience
     in cases nodes are being constructed from external description (such as JSON dictionary).
 
-    .. note::
-    
-        Limitations of current implementation (might be improved in the future):
-    
-        * only inner join between datasets: that means that only those input records are joined
-          that will have matching keys
-        * "detail" datasets should have unique keys, otherwise the behaviour is undefined
-        * master is considered as the largest dataset
+    Types of joins are specified in `join_types` - a dictionary where keys are tags of detail
+    inputs and values are:
+
+    * ``inner`` (default) - only master rows with matching detail rows are passed
+    * ``left`` - master rows without matching detail rows are passed too, detail fields are empty
+    * ``right`` - detail rows without matching master rows are passed too, fields of master and
+      other details are empty
+    * ``full`` - both ``left`` and ``right``
+
+    .. code-block:: python
+
+        node.join_types = { 1: "left", 2: "full" }
+
+    A master row is joined with every matching detail row, in order of the detail input. If there
+    are matching rows in more detail inputs, all their combinations are passed. Detail rows without
+    matching master rows (``right`` and ``full`` joins) are passed after all joined rows, in order
+    of the detail input. A master row matches detail rows if keys are equal, regardless of the
+    other detail inputs.
 
     How does it work: all records from detail inputs are read first. Then records from master
     input are read and joined with cached input records. It is recommended that the master dataset
     set is the largest from all inputs.
 
+    When there is only one detail input, the node can keep the master input in memory instead, if
+    it is smaller - `build_side` is ``auto``. Size of inputs is estimated by their data sources,
+    such as number of rows of a SQL table (see :meth:`brewery.nodes.Node.size_hint`). When the
+    estimates are not known, up to `size_sample_rows` rows are read from both inputs: an input
+    that ends sooner is the smaller one. Output is the same regardless of the input kept in
+    memory. The chosen input - ``master`` or ``detail`` - is in `chosen_build_side` after the
+    node is run. When the master input is kept in memory, detail rows matching master rows are
+    collected until all detail rows are read. Up to `max_matched_rows` of them are kept in
+    memory, more are sorted by master row and spilled to temporary files, so the node needs
+    memory for the master rows and `max_matched_rows` detail rows (more only if a single master
+    row has more matching rows).
+
+    Detail inputs that do not fit into memory can be joined in partitions: when a detail input
+    has more than `max_detail_rows` rows, its rows are hash-partitioned by key into
+    `spill_partitions` temporary files. Master rows are partitioned in the same way and each pair
+    of partitions is joined separately. Joined rows are passed in the same order as without the
+    limit, after all master rows were read.
+
+    Master rows without a matching row of an inner joined detail input are dropped. Therefore,
+    when `semi_join` is ``True`` (default), keys of such details are passed to the source node of
+    the master input as soon as the details are read: up to
+    :attr:`brewery.nodes.KeyFilter.max_exact_keys` keys are passed to the data source as an
+    ``in`` filter (such as SQL ``IN``), more keys are passed as a Bloom filter and the source
+    node drops rows with other keys. The master rows are dropped before they are processed by
+    nodes between the source and the merge node. The source node has to be connected directly or
+    through filtering nodes, without any other outputs, and it waits until the details are read.
+    It is used only by streams run by threads, when the detail inputs are kept in memory - not
+    with `max_detail_rows`.
+
+    If all inputs are sorted by their join keys in ascending order, set `method` to
+    ``sort_merge``: master and detail inputs are read together and only the detail rows of the
+    current key are kept for each detail input. Joined rows are passed as soon as they are joined
+    and detail rows without matching master rows are passed as soon as they are skipped, so the
+    output is ordered by key. Input that is not sorted raises :class:`brewery.StreamError`.
+
     """
     
     node_info = {
@@ -186,13 +656,50 @@ class MergeNode(base.Node):
             {
                 "name": "join_types",
                 "description": "Dictionary where keys are stream tags (indexes) and values are "
-                               "types of join for the stream. Default is 'inner'. "
-                               "-- **Not implemented**"
+                               "types of join for the stream: 'inner' (default), 'left', 'right' "
+                               "or 'full'"
+            },
+            {
+                "name": "build_side",
+                "description": "Input kept in memory by hash join: 'auto' (default) - the "
+                               "smaller one, 'detail' or 'master'"
+            },
+            {
+                "name": "method",
+                "description": "Join method: 'hash' (default) reads detail inputs first, "
+                               "'sort_merge' reads inputs sorted by keys together"
+            },
+            {
+                "name": "semi_join",
+                "description": "Filter master source rows by keys of inner joined details. "
+                               "Default is True"
+            },
+            {
+                "name": "max_detail_rows",
+                "description": "Maximal number of rows of a detail input kept in memory. Rows "
+                               "are partitioned into temporary files when exceeded. Default is "
+                               "no limit."
+            },
+            {
+                "name": "spill_partitions",
+                "description": "Number of temporary files of partitioned inputs. Default is 16"
+            },
+            {
+                "name": "temp_dir",
+                "description": "Directory for temporary files of partitioned inputs"
             }
         ]
     }
     
-    def __init__(self, joins = None, master = None, maps = None):
+    # Maximal number of rows read from each input to find the smaller input
+    size_sample_rows = 10000
+    # Maximal number of detail rows matching master rows kept in memory, more are spilled to
+    # temporary files
+    max_matched_rows = 100000
+
+    def __init__(self, joins = None, master = None, maps = None, join_types = None,
+                 method = "hash", build_side = "auto", max_detail_rows = None,
+                 spill_partitions = 16, temp_dir = None, semi_join = True):
         super(MergeNode, self).__init__()
         if joins:
             self.joins = joins
@@ -205,14 +712,33 @@ class MergeNode(base.Node):
             self.master = 0
             
         self.maps = maps
+        self.join_types = join_types
+        self.method = method
+        self.build_side = build_side
+        self.max_detail_rows = max_detail_rows
+        self.spill_partitions = spill_partitions
+        self.temp_dir = temp_dir
+        self.semi_join = semi_join
             
         self._output_fields = []
+        self.chosen_build_side = None
+        self._key_filters = []
+
+    @property
+    def uses_size_hints(self):
+        return self.method == "hash" and self.build_side == "auto"
     
     def initialize(self):
-        pass
+        if self.method not in ("hash", "sort_merge"):
+            raise ValueError("Unknown join method '%s'" % self.method)
+        if self.build_side not in ("auto", "detail", "master"):
+            raise ValueError("Unknown build side '%s'" % self.build_side)
+
+        self._key_filters = []
+
         # Check joins and normalize them first
         self._keys = {}
-        self._kindexes = {}
+        self._key_getters = {}
         
         self.master_input = self.inputs[self.master]
         self.detail_inputs = []
@@ -244,15 +770,25 @@ class MergeNode(base.Node):
             
             detail_input = self.inputs[detail_tag]
             
-            # Get field indexes
+            # Keys are extracted by item getters: a value for single field keys, a tuple for
+            # compound keys
             detail_indexes = detail_input.fields.indexes(detail_key)
             master_indexes = self.master_input.fields.indexes(master_key)
-            self._kindexes[detail_tag] = (detail_indexes, master_indexes)
+            self._key_getters[detail_tag] = (operator.itemgetter(*detail_indexes),
+                                             operator.itemgetter(*master_indexes))
 
-        # Prepare storage for input data
-        self._input_rows = {}
-        for (tag, pipe) in enumerate(self.inputs):
-            self._input_rows[tag] = {}
+        self._join_types = {}
+        join_types = self.join_types or {}
+        for (tag, pipe) in self.detail_inputs:
+            join_type = join_types.get(tag, "inner")
+            if join_type not in ("inner", "left", "right", "full"):
+                raise ValueError("Unknown join type '%s' of input %s" % (join_type, tag))
+            self._join_types[tag] = join_type
+
+        if self.build_side == "master" and (len(self.detail_inputs) != 1
+                                            or self.max_detail_rows):
+            raise ValueError("Master input can be kept in memory only with one detail input "
+                             "and without max_detail_rows")
 
         # Create map filters
         
@@ -270,12 +806,15 @@ class MergeNode(base.Node):
 
         # Construct output fields
         fields = []
+        self._empty_rows = {}
         for (tag, pipe) in enumerate(self.inputs):
             fmap = self._maps.get(tag, None)
             if fmap:
-                fields += fmap.map(pipe.fields)
+                input_fields = fmap.map(pipe.fields)
             else:
-                fields += pipe.fields
+                input_fields = pipe.fields
+            fields += input_fields
+            self._empty_rows[tag] = [None] * len(input_fields)
 
         self._output_fields = brewery.FieldList(fields)
 
@@ -285,56 +824,364 @@ class MergeNode(base.Node):
     def output_fields(self):
         return self._output_fields
         
+    def input_key_filters(self):
+        """Return filters of master rows by keys of inner joined details, if the details will be
+        kept in memory - not when they might be partitioned into temporary files."""
+
+        self._key_filters = []
+        if not self.semi_join or self.method != "hash" or self.max_detail_rows \
+                or self._planned_build_side() != "detail":
+            return []
+
+        for (tag, pipe) in self.detail_inputs:
+            if self._join_types[tag] not in _MASTER_OUTER_JOINS:
+                master_key = self._keys[tag][1]
+                self._key_filters.append((tag, base.KeyFilter(master_key)))
+
+        return [(self.master, key_filter) for (tag, key_filter) in self._key_filters]
+
     def run(self):
-        """Only inner join is implemented"""
+        try:
+            if self.method == "sort_merge":
+                self._run_sort_merge()
+            else:
+                self._run_hash()
+        finally:
+            # Source nodes waiting for keys continue without them
+            for (tag, key_filter) in self._key_filters:
+                key_filter.cancel()
+
+    def _planned_build_side(self):
+        """Return input that will be kept in memory by hash join: ``master``, ``detail`` or
+        ``None`` if it will be chosen by sampling of the inputs."""
+
+        if self.build_side != "auto":
+            return self.build_side
+        if len(self.detail_inputs) != 1 or self.max_detail_rows:
+            return "detail"
+
+        hints = self.input_size_hints
+        if hints:
+            master_size = hints[self.master]
+            detail_size = hints[self.detail_inputs[0][0]]
+            if master_size is not None and detail_size is not None:
+                if master_size < detail_size:
+                    return "master"
+                return "detail"
+
+        return None
+
+    def _run_hash(self):
+        master_rows = self.master_input.rows()
+        detail_rows = [pipe.rows() for (tag, pipe) in self.detail_inputs]
+
+        self.chosen_build_side = self._planned_build_side()
+        if self.chosen_build_side is None:
+            (master_rows, detail_rows[0]) = self._sample_build_side(master_rows, detail_rows[0])
+
+        if self.chosen_build_side == "master":
+            self._run_master_build(master_rows, detail_rows[0])
+            return
+
         # First, read details, then master. )
-        for (tag, pipe) in self.detail_inputs:
-            detail = self._input_rows[tag]
+        details = []
+        for ((tag, pipe), rows) in zip(self.detail_inputs, detail_rows):
+            detail = _JoinDetail(self._filters.get(tag), self.max_detail_rows,
+                                 self.spill_partitions, self.temp_dir,
+                                 self._join_types[tag] in _DETAIL_OUTER_JOINS)
+            detail.read(rows, self._key_getters[tag][0])
+            details.append((tag, detail))
+
+        for (tag, key_filter) in self._key_filters:
+            if not key_filter.finished:
+                detail = dict(details)[tag]
+                key_filter.set_keys(detail.rows.iterkeys(), len(detail.rows))
+
+        if any(detail.spilled for (tag, detail) in details):
+            self._run_partitioned(details, master_rows)
+            return
 
-            key_indexes = self._kindexes[tag][0]
-            self._read_input(tag, pipe, key_indexes, detail)
+        lookups = [self._detail_lookup(tag, detail.rows) for (tag, detail) in details]
+        for (row, joined) in self._join_rows(master_rows, lookups):
+            self._put_joined(row, joined)
+
+        for (index, (tag, detail)) in enumerate(details):
+            matched = lookups[index][3]
+            if matched is not None:
+                for (key, row) in detail.ordered_rows:
+                    if key not in matched:
+                        self._put_unmatched(index, row)
+
+    def _sample_build_side(self, master_rows, detail_rows):
+        """Set `chosen_build_side` to the input with less rows by reading rows of both inputs,
+        the master input only if it is known to be smaller. Returns tuple of master and detail
+        rows iterators - including rows read by the sampling."""
+
+        self.chosen_build_side = "detail"
+
+        # Inputs are read alternately, as they might be passed by the same source
+        iterators = [iter(master_rows), iter(detail_rows)]
+        samples = [[], []]
+        ended = [False, False]
+        for i in range(self.size_sample_rows):
+            for (index, iterator) in enumerate(iterators):
+                if ended[index]:
+                    continue
+                try:
+                    samples[index].append(iterator.next())
+                except StopIteration:
+                    ended[index] = True
+            if all(ended):
+                break
 
-        rfilter = self._filters.get(self.master)
+        if ended[0] and (not ended[1] or len(samples[0]) < len(samples[1])):
+            self.chosen_build_side = "master"
 
-        for row in self.master_input.rows():
-            if rfilter:
-                joined_row = rfilter.filter(row[:])
+        return (itertools.chain(samples[0], iterators[0]),
+                itertools.chain(samples[1], iterators[1]))
+
+    def _run_master_build(self, master_rows, detail_rows):
+        """Join the only detail input with master rows kept in memory. Matching detail rows are
+        collected for every master row (see :class:`_MatchedRows`), master rows are passed in
+        their order after all detail rows were read."""
+
+        (tag, pipe) = self.detail_inputs[0]
+        (detail_getter, master_getter) = self._key_getters[tag]
+        join_type = self._join_types[tag]
+        rfilter = self._filters.get(tag)
+
+        master = []
+        positions_by_key = {}
+        for (position, row) in enumerate(master_rows):
+            master.append(row)
+            key = master_getter(row)
+            positions = positions_by_key.get(key)
+            if positions is None:
+                positions_by_key[key] = [position]
             else:
-                joined_row = row[:]
-                
-            joined = False
-            for (tag, pipe) in self.detail_inputs:
-                detail_data = self._input_rows[tag]
-
-                # Create key from master
-                key = []
-                for i in self._kindexes[tag][1]:
-                    key.append(row[i])
-                key = tuple(key)
-                
-                detail = detail_data.get(tuple(key))
+                positions.append(position)
 
-                if not detail:
-                    joined = False
-                    break
+        # Unmatched detail rows are kept in a temporary file, there might be many of them
+        if join_type in _DETAIL_OUTER_JOINS:
+            unmatched = _SpillFile(self.temp_dir)
+        else:
+            unmatched = None
+
+        matches = _MatchedRows(self.max_matched_rows, self.temp_dir)
+        try:
+            for row in detail_rows:
+                key = detail_getter(row)
+                if rfilter:
+                    row = rfilter.filter(row)
+
+                positions = positions_by_key.get(key)
+                if positions is None:
+                    if unmatched is not None:
+                        unmatched.append(row)
+                    continue
+
+                for position in positions:
+                    matches.add(position, row)
+
+            if join_type in _MASTER_OUTER_JOINS:
+                missing = [self._empty_rows[tag]]
+            else:
+                missing = None
+
+            groups = matches.groups()
+            next_group = next(groups, None)
+            for (position, row) in enumerate(master):
+                if next_group is not None and next_group[0] == position:
+                    rows = next_group[1]
+                    next_group = next(groups, None)
                 else:
-                    joined = True
-                    joined_row += detail
-                    
-            if joined:
+                    rows = missing
+                if rows is not None:
+                    self._put_joined(row, [rows])
+
+            if unmatched is not None:
+                for row in unmatched:
+                    self._put_unmatched(0, row)
+        finally:
+            matches.close()
+            if unmatched is not None:
+                unmatched.close()
+
+    def _detail_lookup(self, tag, rows):
+        """Return tuple (`master key getter`, `rows by key`, `missing`, `matched`) used to join
+        detail input `tag` with `rows` by key. `missing` is value used for master rows without
+        matching detail rows, ``None`` for inner join. `matched` is set of matched keys for right
+        and full outer joins, otherwise ``None``."""
+
+        join_type = self._join_types[tag]
+        if join_type in _MASTER_OUTER_JOINS:
+            missing = [self._empty_rows[tag]]
+        else:
+            missing = None
+        if join_type in _DETAIL_OUTER_JOINS:
+            matched = set()
+        else:
+            matched = None
+        return (self._key_getters[tag][1], rows, missing, matched)
+
+    def _join_rows(self, rows, lookups, keep_failed=False):
+        """Join master `rows` with details in memory described by `lookups` (see
+        :meth:`_detail_lookup`), yield tuples (`row`, `joined`) where `joined` is list of lists of
+        matching rows for every detail. Rows without matching inner join details are not passed,
+        unless `keep_failed` is ``True`` - then they have ``False`` instead of a list."""
+
+        # Rows without a match are looked up in the other details too when matched keys are
+        # collected
+        lookup_all = keep_failed or any(lookup[3] is not None for lookup in lookups)
+
+        for row in rows:
+            joined = []
+            failed = False
+            for (key_getter, detail, missing, matched) in lookups:
+                key = key_getter(row)
+                matches = detail.get(key)
+                if matches is None:
+                    if missing is None:
+                        failed = True
+                        if not lookup_all:
+                            break
+                        joined.append(False)
+                        continue
+                    matches = missing
+                elif matched is not None:
+                    matched.add(key)
+                joined.append(matches)
+
+            if not failed or keep_failed:
+                yield (row, joined)
+
+    def _put_joined(self, row, joined):
+        """Pass master `row` joined with all combinations of detail rows in `joined`."""
+        rfilter = self._filters.get(self.master)
+        if rfilter:
+            master_row = rfilter.filter(row[:])
+        else:
+            master_row = row[:]
+
+        if len(joined) == 1:
+            for detail_row in joined[0]:
+                self.put(master_row + detail_row)
+        else:
+            for detail_rows in itertools.product(*joined):
+                joined_row = master_row[:]
+                for detail_row in detail_rows:
+                    joined_row += detail_row
                 self.put(joined_row)
-                
-    def _read_input(self, tag, pipe, key_indexes, detail):
-        rfilter = self._filters.get(tag)
-        for row in pipe.rows():
-            key = []
-            for i in key_indexes:
-                key.append(row[i])
 
-            if rfilter:
-                detail[tuple(key)] = rfilter.filter(row)
+    def _put_unmatched(self, index, row):
+        """Pass `row` of detail input at `index` of `detail_inputs` without matching master rows,
+        fields of other inputs are empty."""
+        joined_row = self._empty_rows[self.master][:]
+        for (i, (tag, pipe)) in enumerate(self.detail_inputs):
+            if i == index:
+                joined_row += row
+            else:
+                joined_row += self._empty_rows[tag]
+        self.put(joined_row)
+
+    def _run_sort_merge(self):
+        """Join inputs sorted by keys, reading master and detail inputs together."""
+
+        details = []
+        for (tag, pipe) in self.detail_inputs:
+            (detail_getter, master_getter) = self._key_getters[tag]
+            join_type = self._join_types[tag]
+            detail = _SortedJoinDetail(pipe.rows(), detail_getter, self._filters.get(tag),
+                                       join_type in _DETAIL_OUTER_JOINS)
+            if join_type in _MASTER_OUTER_JOINS:
+                missing = [self._empty_rows[tag]]
+            else:
+                missing = None
+            details.append((master_getter, detail, missing))
+
+        lookup_all = any(detail.unmatched is not None for (getter, detail, missing) in details)
+        last_keys = [None] * len(details)
+
+        for row in self.master_input.rows():
+            joined = []
+            failed = False
+            for (index, (key_getter, detail, missing)) in enumerate(details):
+                key = key_getter(row)
+                if last_keys[index] is not None and key < last_keys[index]:
+                    raise StreamError("Master input of merge node is not sorted by key: "
+                                      "%s after %s" % (key, last_keys[index]))
+                last_keys[index] = key
+
+                matches = detail.lookup(key) or missing
+                if matches is None:
+                    failed = True
+                    if not lookup_all:
+                        break
+                joined.append(matches)
+
+            # Unmatched rows skipped by the lookup have lower keys than the current row
+            if lookup_all:
+                for (index, (key_getter, detail, missing)) in enumerate(details):
+                    if detail.unmatched:
+                        for detail_row in detail.unmatched:
+                            self._put_unmatched(index, detail_row)
+                        del detail.unmatched[:]
+
+            if not failed:
+                self._put_joined(row, joined)
+
+        for (index, (key_getter, detail, missing)) in enumerate(details):
+            if detail.unmatched is not None:
+                for detail_row in detail.unmatched:
+                    self._put_unmatched(index, detail_row)
+                for detail_row in detail.remaining_rows():
+                    self._put_unmatched(index, detail_row)
+
+    def _run_partitioned(self, details, master_rows):
+        """Join `master_rows` with `details` - list of (`tag`, :class:`_JoinDetail`) - when some
+        of them were spilled. Master rows are joined with details in memory first and then with each
+        spilled detail, partition by partition."""
+
+        # Master rows without a match go through all joins when unmatched rows of a spilled
+        # detail are collected
+        keep_failed = any(detail.spilled and self._join_types[tag] in _DETAIL_OUTER_JOINS
+                          for (tag, detail) in details)
+
+        in_memory = []
+        lookups = []
+        for (index, (tag, detail)) in enumerate(details):
+            if not detail.spilled:
+                in_memory.append(index)
+                lookups.append(self._detail_lookup(tag, detail.rows))
+
+        def join_in_memory():
+            rows = self._join_rows(master_rows, lookups, keep_failed)
+            for (position, (row, matches)) in enumerate(rows):
+                joined = [None] * len(details)
+                for (index, detail_rows) in zip(in_memory, matches):
+                    joined[index] = detail_rows
+                yield (position, row, joined)
+
+        items = join_in_memory()
+        for (index, (tag, detail)) in enumerate(details):
+            if detail.spilled:
+                items = detail.join(items, self._key_getters[tag][1], index,
+                                    self._join_types[tag], self._empty_rows[tag], keep_failed)
+
+        for (position, row, joined) in items:
+            if False not in joined:
+                self._put_joined(row, joined)
+
+        for (index, (tag, detail)) in enumerate(details):
+            if self._join_types[tag] not in _DETAIL_OUTER_JOINS:
+                continue
+            if detail.spilled:
+                rows = detail.unmatched_rows()
             else:
-                detail[tuple(key)] = row
+                matched = lookups[in_memory.index(index)][3]
+                rows = (row for (key, row) in detail.ordered_rows if key not in matched)
+            for row in rows:
+                self._put_unmatched(index, row)
 
 class DistinctNode(base.Node):
     """Node will pass distinct records with given distinct fields.
@@ -363,16 +1210,25 @@ class DistinctNode(base.Node):
                 "label": "derived field",
                 "description": "Field where substition result will be stored. If not set, then "
                                "original field will be replaced with new value."
+            },
+            {
+                "name": "parallelism",
+                "label": "parallelism",
+                "description": "Number of worker processes. Input is partitioned among the "
+                               "workers by distinct fields. Default is 1 - no workers."
             }
         ]
     }
 
-    def __init__(self, distinct_fields = None, discard = False):
+    def __init__(self, distinct_fields = None, discard = False, parallelism = 1):
         """Creates a node that will pass distinct records with given distinct fields.
         
         :Parameters:
             * `distinct_fields` - list of names of key fields
             * `discard` - whether the distinct fields are discarded or kept. By default False.
+            * `parallelism` - number of worker processes. If greater than 1, rows are
+              hash-partitioned by distinct fields among the workers, each worker keeps distinct
+              values of its partition. Order of rows is preserved.
             
         If `discard` is ``False`` then first record with distinct keys is passed to the output. This is
         used to find all distinct key values.
@@ -392,64 +1248,386 @@ class DistinctNode(base.Node):
             self.distinct_fields = []
             
         self.discard = discard
+        self.parallelism = parallelism
+        self._pool = None
+        self._resume_values = None
+
+    @property
+    def supports_checkpoints(self):
+        # Distinct values of parallel workers are not available
+        return self.parallelism <= 1
+
+    def checkpoint_state(self):
+        return set(self.distinct_values)
+
+    def restore_state(self, state):
+        self._resume_values = state
+
+    def required_input_fields(self, output_names):
+        # Without distinct fields whole rows are compared
+        if output_names is None or not self.distinct_fields:
+            return None
+        return output_names | set(self.distinct_fields)
+
+    def size_hint(self, input_hints):
+        # Number of distinct keys is not known
+        return None
         
     def initialize(self):
         field_map = brewery.FieldMap(keep=self.distinct_fields)
         self.row_filter = field_map.row_filter(self.input_fields)
 
+        self.distinct_values = self._resume_values or set()
+        self._resume_values = None
+
+        self._terminate_pool()
+        if self.parallelism > 1 and self.distinct_fields:
+            key_getter = _key_getter(self.row_filter.selectors)
+            workers = [_DistinctPartition(self.discard, key_getter, index, self.parallelism)
+                            for index in range(self.parallelism)]
+            self._pool = WorkerPool(workers)
+            self._pool.start()
+
+    def finalize(self):
+        self._terminate_pool()
+
+    def _terminate_pool(self):
+        if self._pool:
+            self._pool.terminate()
+            self._pool = None
+
     def run(self):
-        pipe = self.input
-        self.distinct_values = set()
+        if not self._pool:
+            super(DistinctNode, self).run()
+            return
 
+        try:
+            self._run_parallel()
+        finally:
+            self._terminate_pool()
+
+    def _run_parallel(self):
+        """Send each input batch to all workers and pass rows selected by the workers in the
+        original order. Workers extract the keys and select rows of their own partitions, so the
+        node only pickles the batches."""
+
+        pool = self._pool
+        # Batch number -> [rows, number of replies, selected indexes]
+        pending = {}
+        sent = 0
+        next_batch = 0
+
+        for batch in self.input.batches():
+            data = pickle.dumps(batch, pickle.HIGHEST_PROTOCOL)
+            for worker in range(pool.count):
+                pool.send(worker, (sent, data))
+            pending[sent] = [batch, 0, []]
+            sent += 1
+
+            # Workers select rows of next batches while the oldest one is being passed
+            while sent - next_batch > PARALLEL_BATCH_WINDOW:
+                next_batch = self._receive_selected(pending, next_batch)
+
+        while next_batch < sent:
+            next_batch = self._receive_selected(pending, next_batch)
+
+        pool.finish()
+
+    def _receive_selected(self, pending, next_batch):
+        """Receive a reply from one of the workers and pass selected rows of batches replied by
+        all workers, starting with `next_batch`. Returns number of the next batch to be
+        passed."""
+
+        (number, selected) = self._pool.receive()[1]
+        state = pending[number]
+        state[1] += 1
+        state[2] += selected
+
+        while next_batch in pending and pending[next_batch][1] == self._pool.count:
+            (rows, replies, selected) = pending.pop(next_batch)
+            if selected:
+                selected.sort()
+                self.put_batch(map(rows.__getitem__, selected))
+            next_batch += 1
+
+        return next_batch
+
+    def process_row(self, row):
         # Just copy input to output if there are no distinct keys
         # FIXME: should issue a warning?
         if not self.distinct_fields:
-            for row in pipe.rows():
-                self.put(row)
-            return
+            return row
+
+        # Construct key tuple from distinct fields
+        key_tuple = tuple(self.row_filter(row))
+
+        if key_tuple not in self.distinct_values:
+            self.distinct_values.add(key_tuple)
+            if not self.discard:
+                return row
+        elif self.discard:
+            # We already have one found record, which was discarded (because discard is true),
+            # now we pass duplicates
+            return row
 
-        for row in pipe.rows():
-            pass_flag = True
-            # Construct key tuple from distinct fields
-            key_tuple = tuple(self.row_filter(row))
+        return None
 
+class _DistinctPartition(object):
+    """Worker of parallel `DistinctNode` - keeps distinct values of partition `index` of
+    `count` partitions."""
+
+    def __init__(self, discard, key_getter, index, count):
+        self.discard = discard
+        self.key_getter = key_getter
+        self.index = index
+        self.count = count
+        self.distinct_values = set()
+
+    def process(self, message):
+        """Return tuple (`number`, `indexes`) with indexes of selected rows of the worker's
+        partition. `message` is a tuple (`number`, `data`) where `data` is a pickled batch."""
+        (number, data) = message
+        rows = pickle.loads(data)
+        selected = []
+        for (index, key_tuple) in _partition_keys(rows, self.key_getter, self.index,
+                                                  self.count):
             if key_tuple not in self.distinct_values:
                 self.distinct_values.add(key_tuple)
                 if not self.discard:
-                    self.put(row)
-            else:
-                if self.discard:
-                    # We already have one found record, which was discarded (because discard is true),
-                    # now we pass duplicates
-                    self.put(row)
+                    selected.append(index)
+            elif self.discard:
+                selected.append(index)
+        return (number, selected)
+
+    def finish(self):
+        return None
+
+# Version of aggregate node state files
+AGGREGATE_STATE_VERSION = 1
+
+class _AggregateTable(object):
+    """Aggregates of rows grouped by key. Keys are kept in order of their first occurence.
+    Aggregate of a key is a list: number of rows followed by states of aggregate functions.
+
+    If there are more than `max_groups` keys, the aggregates are spilled: hash-partitioned by key
+    into temporary files and removed from memory. Spilled aggregates of each partition are
+    merged by :meth:`results`.
+
+    :Parameters:
+        * `key_selectors`: selectors of key fields in input rows
+        * `measures`: list of tuples (`index`, `functions`) where `index` is index of aggregated
+          field in input rows and `functions` is list of
+          :class:`brewery.aggregates.AggregateFunction` objects
+        * `max_groups`: maximal number of keys kept in memory, ``None`` - no limit
+        * `spill_partitions`: number of temporary files of spilled aggregates
+        * `temp_dir`: directory of temporary files, default is system temporary directory
+    """
+
+    def __init__(self, key_selectors, measures, max_groups=None, spill_partitions=16,
+                 temp_dir=None):
+        self.key_selectors = key_selectors
+        self.functions = [function for (index, functions) in measures for function in functions]
+        self.function_indexes = [index for (index, functions) in measures for f in functions]
+        self.max_groups = max_groups
+        self.spill_partitions = spill_partitions
+        self.temp_dir = temp_dir
+        self.keys = []
+        self.aggregates = {}
+        self.positions = {}
+        self.row_count = 0
+        self.spill_count = 0
+        self._spill_files = None
+
+    def aggregate_rows(self, rows, positions=None):
+        """Aggregate `rows`. `positions` is an optional list of positions of the rows in the
+        whole input, default is the number of rows aggregated before. Position of first row of
+        each key is remembered."""
+
+        if positions is None:
+            positions = xrange(self.row_count, self.row_count + len(rows))
+
+        key_selectors = self.key_selectors
+        aggregates = self.aggregates
+        functions = self.functions
+        # State of n-th function is at position n + 1 of key aggregate
+        slots = [(slot + 1, index, function.aggregate) for (slot, (index, function))
+                        in enumerate(zip(self.function_indexes, functions))]
+
+        for (row_index, row) in enumerate(rows):
+            key = tuple(itertools.compress(row, key_selectors))
+            aggregate = aggregates.get(key)
+            if aggregate is None:
+                aggregate = [0] + [function.initial_state() for function in functions]
+                aggregates[key] = aggregate
+                self.keys.append(key)
+                self.positions[key] = positions[row_index]
+
+            aggregate[0] += 1
+            for (slot, index, function) in slots:
+                value = row[index]
+                if value is not None:
+                    aggregate[slot] = function(aggregate[slot], value)
+
+        self.row_count += len(rows)
+
+        if self.max_groups and len(self.keys) > self.max_groups:
+            self.spill()
+
+    def groups(self):
+        """Return list of tuples (`key`, `aggregate`) of keys in memory."""
+        return [(key, self.aggregates[key]) for key in self.keys]
+
+    def restore_groups(self, groups):
+        """Add aggregates of keys from list of tuples (`key`, `aggregate`), as returned by
+        :meth:`groups`. Should be called before any rows are aggregated."""
+        for (key, aggregate) in groups:
+            self.keys.append(key)
+            self.aggregates[key] = aggregate
+            self.positions[key] = self.row_count
+            self.row_count += 1
+
+    def rows(self):
+        """Return list of result rows of keys in memory: key fields followed by aggregations and
+        record count."""
+        return [self.result_row(key, self.aggregates[key]) for key in self.keys]
+
+    def result_row(self, key, aggregate):
+        """Return result row of `key` with `aggregate`: key fields followed by aggregations and
+        record count."""
+        row = list(key)
+        for (slot, function) in enumerate(self.functions, 1):
+            row.append(function.result(aggregate[slot]))
+        row.append(aggregate[0])
+        return row
+
+    @property
+    def spilled(self):
+        """``True`` if some aggregates were spilled to temporary files."""
+        return self._spill_files is not None
+
+    def spill(self):
+        """Write aggregates of all keys in memory to temporary files of their partitions and
+        remove them from memory."""
+
+        if self._spill_files is None:
+            self._spill_files = _SpillPartitions(self.spill_partitions, self.temp_dir)
+
+        for key in self.keys:
+            self._spill_files.add(key, (self.positions[key], key, self.aggregates[key]))
+
+        self.keys = []
+        self.aggregates = {}
+        self.positions = {}
+        self.spill_count += 1
+
+    def results(self):
+        """Iterate over tuples (`position`, `row`) of all keys ordered by position of the first
+        row of the key. Temporary files are removed afterwards."""
+
+        if self._spill_files is None:
+            for key in self.keys:
+                yield (self.positions[key], self.result_row(key, self.aggregates[key]))
+            return
+
+        self.spill()
+        partitions = self._spill_files
+        self._spill_files = None
+        result_files = []
+
+        try:
+            # Merge partitions one by one, so there are keys of only one partition in memory
+            for spill_file in partitions.files:
+                result_files.append(self._merge_partition(spill_file))
+                spill_file.close()
+
+            for item in heapq.merge(*result_files):
+                yield item
+        finally:
+            partitions.close()
+            for result_file in result_files:
+                result_file.close()
+
+    def _merge_partition(self, spill_file):
+        """Merge spilled aggregates from `spill_file` and return :class:`_SpillFile` with result
+        rows of the partition ordered by position."""
+
+        functions = list(enumerate(self.functions, 1))
+        merged = {}
+        for (position, key, aggregate) in spill_file:
+            current = merged.get(key)
+            if current is None:
+                merged[key] = (position, aggregate)
+                continue
+
+            # Aggregates were spilled in order of input, position of the first one is kept
+            current = current[1]
+            current[0] += aggregate[0]
+            for (slot, function) in functions:
+                current[slot] = function.merge(current[slot], aggregate[slot])
+
+        results = sorted((position, key) for (key, (position, aggregate)) in merged.items())
+        result_file = _SpillFile(self.temp_dir)
+        for (position, key) in results:
+            result_file.append((position, self.result_row(key, merged[key][1])))
+
+        return result_file
+
+class _AggregatePartition(object):
+    """Worker of parallel `AggregateNode` - aggregates partition `index` of `count` partitions
+    of input."""
+
+    def __init__(self, table, index, count):
+        self.table = table
+        self.key_getter = _key_getter(table.key_selectors)
+        self.index = index
+        self.count = count
+
+    def process(self, message):
+        """Aggregate rows of the worker's partition. `message` is a tuple (`position`, `data`)
+        where `data` is a pickled batch starting at `position` of the input."""
+        (position, data) = message
+        rows = pickle.loads(data)
+        selected = _partition_keys(rows, self.key_getter, self.index, self.count)
+        self.table.aggregate_rows([rows[offset] for (offset, key) in selected],
+                                  [position + offset for (offset, key) in selected])
+        return None
+
+    def finish(self):
+        """Return list of tuples (`position`, `row`) sorted by position of first row of the
+        key in the input. If the number of groups is limited, the tuples are written to a named
+        :class:`_SpillFile` and its path is returned instead, so the results do not have to fit
+        into memory."""
+
+        if not self.table.max_groups:
+            return list(self.table.results())
+
+        result_file = _SpillFile(self.table.temp_dir, named=True)
+        try:
+            for item in self.table.results():
+                result_file.append(item)
+        except:
+            result_file.close()
+            raise
+        return result_file.detach()
 
-class Aggregate(object):
-    """Structure holding aggregate information (should be replaced by named tuples in Python 3)"""
-    def __init__(self):
-        self.count = 0
-        self.sum = 0
-        self.min = 0
-        self.max = 0
-        self.average = None
-    
-    def aggregate_value(self, value):
-        self.count += 1
-        self.sum += value
-        self.min = min(self.min, value)
-        self.max = max(self.max, value)
-        
-    def finalize(self):
-        if self.count:
-            self.average = self.sum / self.count
-        else:
-            self.average = None
-class KeyAggregate(object):
-    def __init__(self):
-        self.count = 0
-        self.field_aggregates = {}
-        
 class AggregateNode(base.Node):
-    """Aggregate"""
+    """Aggregate values of measure fields grouping by key fields. Rows are grouped in a hash
+    table, output contains one row for each key in order of first occurence of the key.
+
+    Aggregations of a measure are names of aggregate functions (see
+    :mod:`brewery.aggregates`): ``count``, ``sum``, ``min``, ``max``, ``average`` (or ``avg``),
+    ``count_distinct``, ``first``, ``last`` and ``variance``. Only requested aggregations are
+    computed. Empty values are not aggregated:
+
+    .. code-block:: python
+
+        node = AggregateNode(keys=["year"], default_aggregations=["sum"])
+        node.add_measure("amount")
+        node.add_measure("receiver", ["count_distinct"])
+
+    Output fields are ``year``, ``amount_sum``, ``receiver_count_distinct`` and
+    ``record_count``.
+    """
     
     node_info = {
         "label" : "Aggregate Node",
@@ -468,15 +1646,86 @@ class AggregateNode(base.Node):
             },
             {
                 "name": "measures",
-                "description": "List of fields to be aggregated."
+                "description": "List of fields to be aggregated or (field, aggregations) "
+                               "tuples."
+            },
+            {
+                "name": "default_aggregations",
+                "description": "Aggregations of measures without listed aggregations. Default "
+                               "is sum, min, max and average"
+            },
+            {
+                "name": "parallelism",
+                "description": "Number of worker processes. Input is partitioned among the "
+                               "workers by key fields. Default is 1 - no workers."
+            },
+            {
+                "name": "max_groups",
+                "description": "Maximal number of groups kept in memory (by each worker). "
+                               "Partial aggregates are spilled to temporary files when exceeded. "
+                               "Default is no limit."
+            },
+            {
+                "name": "spill_partitions",
+                "description": "Number of temporary files of spilled aggregates. Default is 16"
+            },
+            {
+                "name": "temp_dir",
+                "description": "Directory for temporary files of spilled aggregates"
+            },
+            {
+                "name": "state_path",
+                "description": "Path of a file with aggregates of previous runs. Input rows are "
+                               "added to the aggregates and the file is updated."
+            },
+            {
+                "name": "changed_only",
+                "description": "Pass only groups changed by input rows to the output, if there "
+                               "is a state file. Default is False"
             }
-            
         ]
     }
     
-    def __init__(self, keys=None, measures=None, default_aggregations=["sum"], 
-                 record_count_field="record_count"):
-        """Creates a new node for aggregations. Supported aggregations: sum, avg, min, max""" 
+    def __init__(self, keys=None, measures=None, default_aggregations=None,
+                 record_count_field="record_count", parallelism=1, max_groups=None,
+                 spill_partitions=16, temp_dir=None, state_path=None, changed_only=False):
+        """Creates a new node for aggregations.
+
+        :Parameters:
+            * `keys`: list of fields according to which rows are grouped
+            * `measures`: list of fields to be aggregated or tuples (`field`, `aggregations`)
+            * `default_aggregations`: list of aggregations of measures, which were given without
+              aggregations. Default is ``sum``, ``min``, ``max`` and ``average``.
+            * `record_count_field`: name of field with number of rows of a group
+            * `parallelism`: number of worker processes
+            * `max_groups`: maximal number of groups kept in memory, ``None`` (default) - no
+              limit
+            * `spill_partitions`: number of temporary files of spilled aggregates, default is 16
+            * `temp_dir`: directory of temporary files, default is system temporary directory
+            * `state_path`: path of file with aggregates of previous runs
+            * `changed_only`: if ``True`` then only groups changed by input rows are passed to
+              the output when there is a state file
+
+        If `parallelism` is greater than 1, input rows are hash-partitioned by key fields among
+        `parallelism` worker processes, each aggregating its partition. Partial results are merged
+        into output of the same structure and order as without parallelism.
+
+        If there are more than `max_groups` groups, partial aggregates are hash-partitioned by key
+        fields into `spill_partitions` temporary files and removed from memory. At the end
+        partial aggregates of each file are merged, one file at a time, therefore the node needs
+        memory for about ``number of groups / spill_partitions`` groups. Output is the same as
+        without the limit. All aggregate functions have to be mergeable. Parallel workers spill
+        each its own partition and write their results to temporary files, which are merged
+        while output rows are passed.
+
+        If `state_path` is set, aggregates of all groups are loaded from the file (if it exists),
+        input rows are added to them and the file is replaced with the updated aggregates when
+        the node is finalized after the stream succeeded. If the stream fails, the file is not
+        changed. Each run should get only rows which were not aggregated
+        before, such as rows of one day. Keys and measures of the node have to be the same as
+        when the file was written. State file can not be used with `parallelism` or
+        `max_groups`, as all groups have to be in memory of the node.
+        """
                 
         super(AggregateNode, self).__init__()
         if keys:
@@ -485,82 +1734,250 @@ class AggregateNode(base.Node):
             self.key_fields = []
             
         self.aggregations = {}
+        self.default_aggregations = default_aggregations
         self.record_count_field = record_count_field
         self.measures = measures or []
+        self.parallelism = parallelism
+        self.max_groups = max_groups
+        self.spill_partitions = spill_partitions
+        self.temp_dir = temp_dir
+        self.state_path = state_path
+        self.changed_only = changed_only
+        self.spill_count = 0
+        self._pool = None
+        self._table = None
+        self._loaded_counts = None
+
+    @property
+    def supports_checkpoints(self):
+        # Partial aggregates of parallel workers and spilled aggregates are not available
+        return self.parallelism <= 1 and not self.max_groups
+
+    def checkpoint_state(self):
+        # Record counts of groups loaded from the state file are needed to find changed groups
+        # of a resumed run
+        return (self._table, self._loaded_counts)
+
+    def restore_state(self, state):
+        (self._table, self._loaded_counts) = state
+
+    def required_input_fields(self, output_names):
+        measures = [field for (field, aggregations) in self.measure_aggregations()]
+        return set(self.key_fields) | set(measures)
+
+    def size_hint(self, input_hints):
+        # Number of groups is not known
+        return None
+
+    def aggregation(self):
+        if self.state_path:
+            # Aggregates of input rows are needed for the state file
+            return None
+        return (self.key_fields, self.measure_aggregations(), self.record_count_field)
             
     def add_measure(self, field, aggregations = None):
-        """Add aggregation for `field` """
+        """Add measure `field` aggregated by list of `aggregations`. If no aggregations are
+        given, then `default_aggregations` are used."""
         self.aggregations[field] = aggregations
         self.measures.append(field)
+
+    def measure_aggregations(self):
+        """Return list of tuples (`field`, `aggregations`) of all measures."""
+        default = self.default_aggregations or brewery.aggregates.DEFAULT_AGGREGATIONS
+
+        result = []
+        for measure in self.measures:
+            if isinstance(measure, basestring):
+                aggregations = self.aggregations.get(measure) or default
+                result.append((measure, list(aggregations)))
+            else:
+                (field, aggregations) = measure
+                result.append((field, list(aggregations)))
+        return result
+
+    def _create_table(self):
+        """Return new `_AggregateTable` for the input rows."""
+        key_selectors = self.input_fields.selectors(self.key_fields)
+        measures = [(self.input_fields.index(field),
+                     [brewery.aggregates.aggregate_function(name) for name in aggregations])
+                            for (field, aggregations) in self.measure_aggregations()]
+        return _AggregateTable(key_selectors, measures, self.max_groups, self.spill_partitions,
+                               self.temp_dir)
     
     @property
     def output_fields(self):
-        # FIXME: use storage types based on aggregated field type
-        fields = brewery.FieldList()
+        if self.aggregation_pushed_down:
+            # Input rows are aggregated already
+            return self.input_fields
+        return ds.aggregated_fields(self.input_fields, self.key_fields,
+                                    self.measure_aggregations(), self.record_count_field)
+
+    def initialize(self):
+        self._terminate_pool()
 
-        if self.key_fields:
-            for field in  self.input_fields.fields(self.key_fields):
-                fields.append(field)
+        if self.state_path and (self.parallelism > 1 or self.max_groups):
+            raise ValueError("Aggregate node state file can not be used with parallelism or "
+                             "max_groups")
 
-        for field in self.measures:
-            fields.append(brewery.Field(field + "_sum", storage_type = "float", analytical_type = "range"))
-            fields.append(brewery.Field(field + "_min", storage_type = "float", analytical_type = "range"))
-            fields.append(brewery.Field(field + "_max", storage_type = "float", analytical_type = "range"))
-            fields.append(brewery.Field(field + "_average", storage_type = "float", analytical_type = "range"))
-        fields.append(brewery.Field(self.record_count_field, storage_type = "integer", analytical_type = "range"))
+        # Remove state written by a run that was not finished
+        if self.state_path and os.path.exists(self._temp_state_path()):
+            os.remove(self._temp_state_path())
+
+        if self.parallelism > 1 and not self.aggregation_pushed_down:
+            workers = [_AggregatePartition(self._create_table(), index, self.parallelism)
+                            for index in range(self.parallelism)]
+            self._pool = WorkerPool(workers)
+            self._pool.start()
+
+    def finalize(self):
+        self._terminate_pool()
+
+        # State written by run() replaces the state file only if the whole stream succeeded,
+        # otherwise the stream aborted the node and the state was removed
+        if self.state_path and os.path.exists(self._temp_state_path()):
+            os.rename(self._temp_state_path(), self.state_path)
+
+    def abort(self):
+        if self.state_path and os.path.exists(self._temp_state_path()):
+            os.remove(self._temp_state_path())
+
+    def _terminate_pool(self):
+        if self._pool:
+            self._pool.terminate()
+            self._pool = None
 
-        return fields
-        
     def run(self):
-        pipe = self.input
-        self.aggregates = {}
-        self.keys = []
-        self.counts = {}
-        
-        key_selectors = self.input_fields.selectors(self.key_fields)
-        measure_indexes = self.input_fields.indexes(self.measures)
-        
-        for row in pipe.rows():
-            # Create aggregation key
-            key = tuple(itertools.compress(row, key_selectors))
-            # Create new aggregate record for key if it does not exist
-            #
-            if key not in self.keys:
-                self.keys.append(key)
-                key_aggregate = KeyAggregate()
-                self.aggregates[key] = key_aggregate
-            else:
-                key_aggregate = self.aggregates[key]
-
-            # Create aggregations for each field to be aggregated
-            #
-            key_aggregate.count += 1
-            for i in measure_indexes:
-                if i not in key_aggregate.field_aggregates:
-                    aggregate = Aggregate()
-                    key_aggregate.field_aggregates[i] = aggregate
-                else:
-                    aggregate = key_aggregate.field_aggregates[i]
-                value = row[i]
+        if self.aggregation_pushed_down:
+            # Rows were aggregated by the data source
+            for batch in self.input.batches():
+                self.put_batch(batch)
+            return
 
-                aggregate.aggregate_value(value)
-            
-        # Pass results to output
-        for key in self.keys:
-            row = list(key[:])
+        if self._pool:
+            self._put_results(self._run_parallel())
+            return
 
-            key_aggregate = self.aggregates[key]
-            for i in measure_indexes:
-                aggregate = key_aggregate.field_aggregates[i]
-                aggregate.finalize()
-                row.append(aggregate.sum)
-                row.append(aggregate.min)
-                row.append(aggregate.max)
-                row.append(aggregate.average)
+        # Table might be restored from a checkpoint
+        if not self._table:
+            self._table = self._create_table()
+            self._loaded_counts = None
+            if self.state_path:
+                groups = self._load_state()
+                if self.changed_only:
+                    self._loaded_counts = dict((key, aggregate[0])
+                                                    for (key, aggregate) in groups)
+                self._table.restore_groups(groups)
+        table = self._table
+        loaded_counts = self._loaded_counts
+        for batch in self.input.batches():
+            table.aggregate_rows(batch)
+        self._table = None
+        self._loaded_counts = None
+
+        self.spill_count = table.spill_count
+        if table.spilled:
+            self._put_results(table.results())
+            return
 
-            row.append(key_aggregate.count)
+        self.aggregates = table.aggregates
+        self.keys = table.keys
+        if loaded_counts is None:
+            rows = table.rows()
+        else:
+            rows = [table.result_row(key, aggregate) for (key, aggregate) in table.groups()
+                        if loaded_counts.get(key) != aggregate[0]]
 
-            self.put(row)
+        # Pass results to output
+        if rows:
+            self.put_batch(rows)
+
+        if self.state_path:
+            self._write_state(table)
+
+    def _state_header(self):
+        """Return description of aggregates which has to match between state file and the
+        node."""
+        return {
+            "version": AGGREGATE_STATE_VERSION,
+            "keys": list(self.key_fields),
+            "measures": self.measure_aggregations()
+        }
+
+    def _load_state(self):
+        """Return list of (`key`, `aggregate`) from the state file or empty list if the file does
+        not exist."""
+
+        if not os.path.exists(self.state_path):
+            return []
+
+        with open(self.state_path, "rb") as handle:
+            header = pickle.load(handle)
+            if header != self._state_header():
+                raise StreamError("Aggregate state file %s was written with different version, "
+                                  "keys or measures" % self.state_path)
+            return pickle.load(handle)
+
+    def _temp_state_path(self):
+        return self.state_path + ".tmp"
+
+    def _write_state(self, table):
+        """Write aggregates of `table` to a temporary file, which replaces the state file
+        atomically in :meth:`finalize`."""
+
+        with open(self._temp_state_path(), "wb") as handle:
+            pickle.dump(self._state_header(), handle, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(table.groups(), handle, pickle.HIGHEST_PROTOCOL)
+            handle.flush()
+            os.fsync(handle.fileno())
+
+    def _run_parallel(self):
+        """Send each input batch to all workers, which aggregate rows of their partitions, and
+        return iterator of their results (`position`, `row`) merged in order of first occurence
+        of the keys. Keys are extracted by the workers, the node only pickles the batches."""
+
+        pool = self._pool
+        position = 0
+
+        try:
+            for batch in self.input.batches():
+                data = pickle.dumps(batch, pickle.HIGHEST_PROTOCOL)
+                for worker in range(pool.count):
+                    pool.send(worker, (position, data))
+                position += len(batch)
+
+            results = pool.finish()
+        finally:
+            self._terminate_pool()
+
+        if not self.max_groups:
+            return heapq.merge(*results)
+        return self._merge_result_files(results)
+
+    def _merge_result_files(self, paths):
+        """Iterate over results of workers with limited number of groups from files at `paths`,
+        reading them lazily. The files are removed afterwards."""
+
+        result_files = []
+        try:
+            for path in paths:
+                result_files.append(_SpillFile.reopen(path))
+            for item in heapq.merge(*result_files):
+                yield item
+        finally:
+            for result_file in result_files:
+                result_file.close()
+
+    def _put_results(self, results):
+        """Pass rows from iterable of (`position`, `row`) `results` to the output in
+        batches."""
+        batch = []
+        for (position, row) in results:
+            batch.append(row)
+            if len(batch) >= SPILL_CHUNK_SIZE:
+                self.put_batch(batch)
+                batch = []
+        if batch:
+            self.put_batch(batch)
 
 class SelectNode(base.Node):
     """Select or discard records from the stream according to a predicate.
@@ -611,6 +2028,8 @@ class SelectNode(base.Node):
         ]
     }
 
+    supports_checkpoints = True
+
 
     def __init__(self, condition = None, discard = False):
         """Creates and initializes selection node
@@ -620,19 +2039,153 @@ class SelectNode(base.Node):
         self.discard = discard
 
     def initialize(self):
-        if isinstance(self.condition, basestring):
-            self._expression = compile(self.condition, "SelectNode condition", "eval")
-            self._condition_callable = self._eval_expression
+        # Condition is evaluated directly on rows, without creating records
+        self._row_condition = row_function(self.condition, self.input_fields.names(),
+                                           globals(), "SelectNode condition")
+
+    def required_input_fields(self, output_names):
+        if output_names is None or not isinstance(self.condition, basestring):
+            return None
+        names = expression_names(self.condition)
+        if names is None:
+            return None
+        return output_names | names
+
+    def filter_conditions(self):
+        """Return conditions of a string condition: comparisons of a field with a literal value
+        joined with ``and``, such as ``year >= 2010 and region in ("north", "south")``."""
+        if self.discard or not isinstance(self.condition, basestring):
+            return None
+
+        (conditions, exact) = _expression_conditions(self.condition)
+        if not conditions:
+            return None
+        return (conditions, exact)
+
+    def process_row(self, row):
+        if self.filter_pushed_down or self._row_condition(row):
+            return row
+        return None
+
+    def process_batch(self, rows):
+        if self.filter_pushed_down:
+            return rows
+        condition = self._row_condition
+        return [row for row in rows if condition(row)]
+
+# Operators of comparisons that can be pushed into data sources
+_CONDITION_OPERATORS = {
+    ast.Eq: "==",
+    ast.NotEq: "!=",
+    ast.Lt: "<",
+    ast.LtE: "<=",
+    ast.Gt: ">",
+    ast.GtE: ">=",
+    ast.In: "in",
+    ast.NotIn: "not in"
+}
+
+# Operators for comparisons written as `value op field`
+_REVERSED_OPERATORS = {
+    "==": "==",
+    "!=": "!=",
+    "<": ">",
+    "<=": ">=",
+    ">": "<",
+    ">=": "<="
+}
+
+_CONSTANT_NAMES = ("None", "True", "False")
+
+def _expression_conditions(expression):
+    """Return tuple (`conditions`, `exact`) with filter conditions of a python `expression`.
+    Comparisons of a field with a literal value joined with ``and`` are translated into
+    conditions, `exact` is ``False`` if the expression contains anything else."""
+
+    try:
+        tree = ast.parse(expression.strip(), mode="eval")
+    except SyntaxError:
+        return ([], False)
+
+    conditions = []
+    exact = True
+
+    for term in _conjunction_terms(tree.body):
+        term_conditions = _comparison_conditions(term)
+        if term_conditions is None:
+            exact = False
         else:
-            self._condition_callable = self.condition
-
-    def _eval_expression(self, **record):
-        return eval(self._expression, None, record)
-
-    def run(self):
-        for record in self.input.records():
-            if self._condition_callable(**record):
-                self.put_record(record)
+            conditions += term_conditions
+
+    return (conditions, exact)
+
+def _conjunction_terms(node):
+    """Return list of expression nodes joined with ``and``."""
+    if isinstance(node, ast.BoolOp) and isinstance(node.op, ast.And):
+        terms = []
+        for value in node.values:
+            terms += _conjunction_terms(value)
+        return terms
+    else:
+        return [node]
+
+def _comparison_conditions(node):
+    """Return list of conditions of a (chained) comparison or ``None`` if the comparison can
+    not be translated."""
+
+    if not isinstance(node, ast.Compare):
+        return None
+
+    operands = [node.left] + node.comparators
+    conditions = []
+    for (i, op) in enumerate(node.ops):
+        condition = _field_condition(operands[i], op, operands[i + 1])
+        if condition is None:
+            return None
+        conditions.append(condition)
+
+    return conditions
+
+def _field_condition(left, op, right):
+    """Return condition (`field`, `operator`, `value`) for comparison of a field with a literal
+    or ``None`` if it can not be translated."""
+
+    operator = _CONDITION_OPERATORS.get(op.__class__)
+    if not operator:
+        return None
+
+    if _is_field(left) and not _is_field(right):
+        field = left.id
+        value_node = right
+    elif _is_field(right) and not _is_field(left) and operator in _REVERSED_OPERATORS:
+        field = right.id
+        value_node = left
+        operator = _REVERSED_OPERATORS[operator]
+    else:
+        return None
+
+    try:
+        value = ast.literal_eval(value_node)
+    except ValueError:
+        return None
+
+    if operator in ("in", "not in"):
+        # Strings would be tested for substrings
+        if not isinstance(value, (list, tuple)):
+            return None
+        value = list(value)
+    elif operator in ("==", "!="):
+        if isinstance(value, (list, tuple, dict)):
+            return None
+    else:
+        # Data stores order strings by collation and None differently than python
+        if not isinstance(value, (int, long, float)):
+            return None
+
+    return (field, operator, value)
+
+def _is_field(node):
+    return isinstance(node, ast.Name) and node.id not in _CONSTANT_NAMES
 
 class FunctionSelectNode(base.Node):
     """Select records that will be selected by a predicate function.
@@ -676,9 +2229,31 @@ class FunctionSelectNode(base.Node):
                  "name": "kwargs",
                  "description": "Keyword arguments passed to the predicate function"
             },
+            {
+                "name": "workers",
+                "description": "Number of workers processing batches in parallel. Default is 1"
+            },
+            {
+                "name": "worker_type",
+                "description": "Type of workers: process (default) or thread"
+            },
+            {
+                "name": "pure",
+                "description": "Flag whether the function depends only on values of the fields, "
+                               "results are then cached. Default is False"
+            },
+            {
+                "name": "cache_size",
+                "description": "Maximal number of cached results. Default is 10000"
+            }
         ]
     }
 
+    supports_checkpoints = True
+
+    # Keyword arguments of the constructor which are options of the node, not of the function
+    node_options = ("workers", "worker_type", "pure", "cache_size")
+
     def __init__(self, function = None, fields = None, discard = False, **kwargs):
         """Creates a node that will select records based on condition `function`. 
         
@@ -689,23 +2264,65 @@ class FunctionSelectNode(base.Node):
               evaluates as ``True`` are discarded. Default is False - selected records are passed
               to the output.
             * `kwargs`: additional arguments passed to the function
-        
+
+        Following keyword arguments are options of the node and they are not passed to the
+        function:
+
+            * `workers`: number of workers evaluating the function on batches of rows in
+              parallel, see :meth:`brewery.nodes.Node.start_workers`. Default is 1 - no workers.
+            * `worker_type`: ``process`` (default) or ``thread``
+            * `pure`: if ``True``, then the function depends only on values of `fields` and
+              `kwargs`, its results for recently seen values are cached, see
+              :meth:`brewery.nodes.Node.start_cache`. Default is ``False``.
+            * `cache_size`: maximal number of cached results. Default is 10000.
+
+        Function arguments with these names should be set in the `kwargs` attribute of the node.
+        Raises `ValueError` if the function has an argument with such name and it is passed to
+        the constructor, as it is not clear to whom it belongs.
         """
         super(FunctionSelectNode, self).__init__()
+
+        try:
+            arguments = inspect.getargspec(function).args
+        except TypeError:
+            arguments = []
+        for name in self.node_options:
+            if name in kwargs and name in arguments:
+                raise ValueError("Argument '%s' of function select node is an option of the "
+                                 "node, set function argument in the node kwargs instead" % name)
+
         self.function = function
         self.fields = fields
         self.discard = discard
+        self.workers = kwargs.pop("workers", 1)
+        self.worker_type = kwargs.pop("worker_type", "process")
+        self.pure = kwargs.pop("pure", False)
+        self.cache_size = kwargs.pop("cache_size", 10000)
         self.kwargs = kwargs
     
     def initialize(self):
         self.indexes = self.input_fields.indexes(self.fields)
+        self.start_cache()
+        self.start_workers()
+
+    def required_input_fields(self, output_names):
+        if output_names is None:
+            return None
+        return output_names | set(self.fields)
     
-    def run(self):
-        for row in self.input.rows():
-            values = [row[index] for index in self.indexes]
+    def evaluate(self, values):
+        """Return result of the predicate function for tuple of field `values`."""
+        return self.function(*values, **self.kwargs)
+
+    def process_row(self, row):
+        values = tuple([row[index] for index in self.indexes])
+        if self._cache is None:
             flag = self.function(*values, **self.kwargs)
-            if (flag and not self.discard) or (not flag and self.discard):
-                self.put(row)
+        else:
+            flag = self._cache.get(values, self.evaluate, values)
+        if (flag and not self.discard) or (not flag and self.discard):
+            return row
+        return None
 
 class SetSelectNode(base.Node):
     """Select records where field value is from predefined set of values.
@@ -739,6 +2356,8 @@ class SetSelectNode(base.Node):
         ]
     }
 
+    supports_checkpoints = True
+
     def __init__(self, field = None, value_set = None, discard = False):
         """Creates a node that will select records where `field` contains value from `value_set`.
 
@@ -756,13 +2375,39 @@ class SetSelectNode(base.Node):
         self.discard = discard
 
     def initialize(self):
-        self.field_index = self.input_fields.index(self.field)
-
-    def run(self):
-        for row in self.input.rows():
-            flag = row[self.field_index] in self.value_set
-            if (flag and not self.discard) or (not flag and self.discard):
-                self.put(row)
+        # Rows might be aggregated by the source, if the filter was pushed down too
+        if not self.filter_pushed_down:
+            self.field_index = self.input_fields.index(self.field)
+
+    def required_input_fields(self, output_names):
+        if output_names is None:
+            return None
+        return output_names | set([self.field])
+
+    def filter_conditions(self):
+        if self.discard:
+            operator = "not in"
+        else:
+            operator = "in"
+        return ([(self.field, operator, list(self.value_set))], True)
+
+    def process_row(self, row):
+        if self.filter_pushed_down:
+            return row
+        flag = row[self.field_index] in self.value_set
+        if (flag and not self.discard) or (not flag and self.discard):
+            return row
+        return None
+
+    def process_batch(self, rows):
+        if self.filter_pushed_down:
+            return rows
+        index = self.field_index
+        value_set = self.value_set
+        if self.discard:
+            return [row for row in rows if row[index] not in value_set]
+        else:
+            return [row for row in rows if row[index] in value_set]
 
 class AuditNode(base.Node):
     """Node chcecks stream for empty strings, not filled values, number distinct values.
@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 
 import base
+import itertools
 import brewery.ds as ds
 
 # data_sources = {
@@ -31,6 +32,12 @@ class RowListSourceNode(base.SourceNode):
             }
         ]
     }
+
+    # Rows put to the output and rows to be skipped when resumed from a checkpoint
+    supports_checkpoints = True
+    _position = 0
+    _resume_position = 0
+
     def __init__(self, a_list = None, fields = None):
         if a_list:
             self.list = a_list
@@ -44,10 +51,26 @@ class RowListSourceNode(base.SourceNode):
             raise ValueError("Fields are not initialized")
         return self.fields
 
+    def size_hint(self, input_hints):
+        if hasattr(self.list, "__len__"):
+            return len(self.list)
+        return None
+
     def run(self):
-        for row in self.list:
+        rows = itertools.islice(self.list, self._resume_position, None)
+        self._position = self._resume_position
+        self._resume_position = 0
+
+        for row in rows:
+            self._position += 1
             self.put(row)
 
+    def checkpoint_state(self):
+        return self._position
+
+    def restore_state(self, state):
+        self._resume_position = state
+
 class RecordListSourceNode(base.SourceNode):
     """Source node that feeds records (dictionary objects) from a list (or any other iterable)
     object."""
@@ -68,6 +91,10 @@ class RecordListSourceNode(base.SourceNode):
         ]
     }
 
+    supports_checkpoints = True
+    _position = 0
+    _resume_position = 0
+
     def __init__(self, a_list = None, fields = None):
         if a_list:
             self.list = a_list
@@ -81,11 +108,109 @@ class RecordListSourceNode(base.SourceNode):
             raise ValueError("Fields are not initialized")
         return self.fields
 
+    def size_hint(self, input_hints):
+        if hasattr(self.list, "__len__"):
+            return len(self.list)
+        return None
+
     def run(self):
-        for record in self.list:
+        records = itertools.islice(self.list, self._resume_position, None)
+        self._position = self._resume_position
+        self._resume_position = 0
+
+        for record in records:
+            self._position += 1
             self.put(record)
+
+    def checkpoint_state(self):
+        return self._position
+
+    def restore_state(self, state):
+        self._resume_position = state
             
-class StreamSourceNode(base.SourceNode):
+class _DataSourceNode(base.SourceNode):
+    """Abstract class for source nodes reading from a :mod:`brewery.ds` data source `stream`.
+    Read position of the data source is stored in stream checkpoints, if the data source provides
+    it. Filters of following nodes are pushed into the data source, if it can filter, and only
+    fields used by the following nodes are read."""
+
+    _resume_position = None
+
+    @property
+    def supports_checkpoints(self):
+        return _overrides(self.stream, ds.DataSource, "position")
+
+    def checkpoint_state(self):
+        return self.stream.position()
+
+    def restore_state(self, state):
+        self._resume_position = state
+
+    def _seek_restored(self):
+        """Continue reading from position restored from a checkpoint. Should be called after the
+        data source is initialized."""
+        if self._resume_position is not None:
+            self.stream.seek(self._resume_position)
+            self._resume_position = None
+
+    def _order_for_checkpoints(self):
+        """Ask data source for repeatable read positions if the stream is checkpointed. Should be
+        called in :meth:`run`, checkpoints might be disabled after the node is initialized."""
+        if self._checkpointer and hasattr(self.stream, "ordered"):
+            self.stream.ordered = True
+
+    def size_hint(self, input_hints):
+        """Return estimated number of rows of the data source, see
+        :meth:`brewery.ds.DataSource.size_hint`."""
+        return self.stream.size_hint()
+
+    def push_filter(self, conditions):
+        """Pass filter `conditions` to the data source, see
+        :meth:`brewery.ds.DataSource.push_filter`. Called by the stream after the node is
+        initialized. Returns ``True`` if the data source filters the rows."""
+
+        if not _overrides(self.stream, ds.DataSource, "push_filter"):
+            return False
+
+        names = self.output_fields.names()
+        for condition in conditions:
+            if condition[0] not in names:
+                return False
+
+        return self.stream.push_filter(conditions)
+
+    def prune_fields(self, names):
+        """Read only fields with `names` from the data source, see
+        :meth:`brewery.ds.DataSource.prune_fields`. Called by the stream after the node is
+        initialized. Returns ``True`` if output fields were reduced."""
+
+        if not _overrides(self.stream, ds.DataSource, "prune_fields"):
+            return False
+        return self.stream.prune_fields(names)
+
+    def push_aggregation(self, keys, measures, count_field):
+        """Read rows aggregated by the data source, see
+        :meth:`brewery.ds.DataSource.push_aggregation`. Called by the stream after the node is
+        initialized. Returns ``True`` if the data source aggregates the rows."""
+
+        if not _overrides(self.stream, ds.DataSource, "push_aggregation"):
+            return False
+
+        names = self.output_fields.names()
+        measure_names = [field for (field, aggregations) in ds.measure_aggregations(measures)]
+        for name in list(keys) + measure_names:
+            if name not in names:
+                return False
+
+        return self.stream.push_aggregation(keys, measures, count_field)
+
+def _overrides(obj, base_class, method):
+    """Return ``True`` if `obj` implements `method` of `base_class`."""
+    function = getattr(type(obj), method, None)
+    return function is not None \
+                and function.im_func is not getattr(base_class, method).im_func
+
+class StreamSourceNode(_DataSourceNode):
     """Generic data stream source. Wraps a :mod:`brewery.ds` data source and feeds data to the 
     output.
 
@@ -122,19 +247,21 @@ class StreamSourceNode(base.SourceNode):
         # self.stream = stream_class(**kwargs)
         # self.stream.fields = 
         self.stream.initialize()
+        self._seek_restored()
 
     @property
     def output_fields(self):
         return self.stream.fields
         
     def run(self):
+        self._order_for_checkpoints()
         for row in self.stream.rows():
             self.put(row)
         
     def finalize(self):
         self.stream.finalize()
 
-class CSVSourceNode(base.SourceNode):
+class CSVSourceNode(_DataSourceNode):
     """Source node that reads comma separated file from a filesystem or a remote URL.
 
     It is recommended to configure node fields before running. If you do not do so, fields are
@@ -207,10 +334,23 @@ class CSVSourceNode(base.SourceNode):
             self.stream.fields = self.fields
         
         self.stream.initialize()
+        self._seek_restored()
         
+        self._retype_output_fields()
+
+    def _retype_output_fields(self):
         # FIXME: this is experimental form of usage
         self._output_fields = self.stream.fields.copy()
-        self._output_fields.retype(self._retype_dictionary)
+        retype = dict((name, attributes) for (name, attributes)
+                            in self._retype_dictionary.items()
+                            if name in self._output_fields.names())
+        self._output_fields.retype(retype)
+
+    def prune_fields(self, names):
+        if not super(CSVSourceNode, self).prune_fields(names):
+            return False
+        self._retype_output_fields()
+        return True
 
     def run(self):
         for row in self.stream.rows():
@@ -295,6 +435,9 @@ class XLSSourceNode(base.SourceNode):
         self.stream.initialize()
         self._fields = self.stream.fields
 
+    def size_hint(self, input_hints):
+        return self.stream.size_hint()
+
     def run(self):
         for row in self.stream.rows():
             self.put(row)
@@ -303,7 +446,7 @@ class XLSSourceNode(base.SourceNode):
         self.stream.finalize()
 
 
-class YamlDirectorySourceNode(base.SourceNode):
+class YamlDirectorySourceNode(_DataSourceNode):
     """Source node that reads data from a directory containing YAML files.
     
     The data source reads files from a directory and treats each file as single record. For example,
@@ -361,6 +504,7 @@ class YamlDirectorySourceNode(base.SourceNode):
 
         self.stream.fields = self.fields
         self.stream.initialize()
+        self._seek_restored()
 
     def run(self):
         for row in self.stream.rows():
@@ -468,7 +612,7 @@ class GoogleSpreadsheetSourceNode(base.SourceNode):
         self.stream.finalize()
 
 
-class SQLSourceNode(base.SourceNode):
+class SQLSourceNode(_DataSourceNode):
     """Source node that reads from a sql table.
     """
     node_info = {
@@ -516,9 +660,23 @@ class SQLSourceNode(base.SourceNode):
     def initialize(self):
         self.stream = ds.SQLDataSource(*self.args, **self.kwargs)
         self.stream.initialize()
+        self._seek_restored()
+        self._fields = self.stream.fields
+
+    def prune_fields(self, names):
+        if not super(SQLSourceNode, self).prune_fields(names):
+            return False
+        self._fields = self.stream.fields
+        return True
+
+    def push_aggregation(self, keys, measures, count_field):
+        if not super(SQLSourceNode, self).push_aggregation(keys, measures, count_field):
+            return False
         self._fields = self.stream.fields
+        return True
 
     def run(self):
+        self._order_for_checkpoints()
         for row in self.stream.rows():
             self.put(row)
             
@@ -5,7 +5,37 @@ import base
 import brewery.ds as ds
 import sys
 
-class StreamTargetNode(base.TargetNode):
+class _DataTargetNode(base.TargetNode):
+    """Abstract class for target nodes writing to a :mod:`brewery.ds` data target `stream`.
+    Output is committed on stream checkpoints and position of the committed output is stored in
+    the checkpoint, if the data target supports it."""
+
+    _resume_position = None
+
+    @property
+    def supports_checkpoints(self):
+        function = getattr(type(self.stream), "commit", None)
+        return function is not None and function.im_func is not ds.DataTarget.commit.im_func
+
+    def checkpoint_state(self):
+        return self.stream.commit()
+
+    def restore_state(self, state):
+        self._resume_position = state
+
+    def abort(self):
+        """Roll back output appended after the last commit."""
+        if self.stream is not None:
+            self.stream.rollback()
+
+    def _resume_restored(self):
+        """Continue output committed at position restored from a checkpoint. Should be called
+        before the data target is initialized."""
+        if self._resume_position is not None:
+            self.stream.resume(self._resume_position)
+            self._resume_position = None
+
+class StreamTargetNode(_DataTargetNode):
     """Generic data stream target. Wraps a :mod:`brewery.ds` data target and feeds data from the 
     input to the target stream.
 
@@ -40,6 +70,7 @@ class StreamTargetNode(base.TargetNode):
 
         # self.stream = stream_class(**kwargs)
         # self.stream.fields = 
+        self._resume_restored()
         self.stream.initialize()
             
     def run(self):
@@ -66,6 +97,9 @@ class RowListTargetNode(base.TargetNode):
         ]
     }
 
+    supports_checkpoints = True
+    _resume_length = None
+
     def __init__(self, a_list = None):
         super(RowListTargetNode, self).__init__()
         if a_list:
@@ -74,9 +108,21 @@ class RowListTargetNode(base.TargetNode):
             self.list = []
 
     def run(self):
-        self.list = []
+        # Resumed node keeps rows collected before the checkpoint
+        if self._resume_length is not None:
+            del self.list[self._resume_length:]
+            self._resume_length = None
+        else:
+            self.list = []
         for row in self.input.rows():
             self.list.append(row)
+
+    def checkpoint_state(self):
+        return len(self.list)
+
+    def restore_state(self, state):
+        self._resume_length = state
+
     @property
     def rows(self):
         return self.list        
@@ -99,6 +145,9 @@ class RecordListTargetNode(base.TargetNode):
             }
         ]
     }
+
+    supports_checkpoints = True
+    _resume_length = None
     def __init__(self, a_list = None):
         super(RecordListTargetNode, self).__init__()
         if a_list:
@@ -107,15 +156,26 @@ class RecordListTargetNode(base.TargetNode):
             self.list = []
 
     def run(self):
-        self.list = []
+        # Resumed node keeps records collected before the checkpoint
+        if self._resume_length is not None:
+            del self.list[self._resume_length:]
+            self._resume_length = None
+        else:
+            self.list = []
         for record in self.input.records():
             self.list.append(record)
 
+    def checkpoint_state(self):
+        return len(self.list)
+
+    def restore_state(self, state):
+        self._resume_length = state
+
     @property
     def records(self):
         return self.list
 
-class CSVTargetNode(base.TargetNode):
+class CSVTargetNode(_DataTargetNode):
     """Node that writes rows into a comma separated values (CSV) file.
     
     :Attributes:
@@ -154,6 +214,7 @@ class CSVTargetNode(base.TargetNode):
         self.stream = ds.CSVDataTarget(self.resource, *self.args, **self.kwargs)
 
         self.stream.fields = self.input_fields
+        self._resume_restored()
         self.stream.initialize()
 
     def run(self):
@@ -418,7 +479,7 @@ class PrettyPrinterNode(base.TargetNode):
             if self.close_handle:
                 self.handle.close()
 
-class SQLTableTargetNode(base.TargetNode):
+class SQLTableTargetNode(_DataTargetNode):
     """Feed data rows into a relational database table.
     """
     node_info = {
@@ -491,9 +552,13 @@ class SQLTableTargetNode(base.TargetNode):
 
         self.stream.fields = self.input_fields
         self.stream.concrete_type_map = self.concrete_type_map
+        self._resume_restored()
         self.stream.initialize()
 
     def run(self):
+        # Records inserted after the last checkpoint are rolled back on failure. Checkpoints
+        # might be disabled after the node is initialized.
+        self.stream.transactional = self._checkpointer is not None
         for row in self.input.rows():
             self.stream.append(row)
 
@@ -2,21 +2,43 @@
 
 import logging
 import threading
+import collections
+import multiprocessing
+import Queue
+import pickle
 import traceback
 import sys
-from brewery.utils import get_logger
+import time
+import os
+from brewery.utils import get_logger, thread_cpu_time
 from brewery.nodes import *
 from brewery.common import *
+from brewery.metrics import *
 
 __all__ = [
     "Stream",
     "Pipe",
+    "ProcessPipe",
     "stream_from_dict",
-    "create_builder"
+    "create_builder",
+    "load_checkpoint"
 ]
 
 JOIN_TIMEOUT = None
 
+# Interval (in seconds) in which blocked process pipe operations and process executor check for
+# closed pipes and for finished worker processes
+PROCESS_POLL_INTERVAL = 0.1
+
+# Adaptive pipes: batch that is filled faster than ADAPTIVE_MIN_FILL_TIME seconds is too small -
+# the per-batch overhead dominates. Batch that is filled slower than ADAPTIVE_MAX_FILL_TIME seconds
+# while the receiving node waits for it is too large - it delays the receiving node.
+ADAPTIVE_MIN_FILL_TIME = 0.01
+ADAPTIVE_MAX_FILL_TIME = 0.5
+
+# Version of the checkpoint file format
+CHECKPOINT_VERSION = 1
+
 def stream_from_dict(desc):
     """Create a stream from dictionary `desc`."""
     stream = Stream()
@@ -30,12 +52,35 @@ class SimpleDataPipe(object):
         self.fields = None
         self._closed = False
 
+        # Function called with the pipe as argument when receiving side closes the pipe, used by
+        # the stream to propagate cancellation upstream
+        self.on_done_receiving = None
+
+        # Function called with checkpoint number when the receiving side reaches a checkpoint
+        # barrier, see put_barrier()
+        self.on_barrier = None
+
+        # Runtime metrics. Sending side counters are updated in the process of the sending node,
+        # receiving side counters in the process of the receiving node.
+        self.batches_sent = 0
+        self.rows_sent = 0
+        self.rows_received = 0
+        self.peak_buffered_rows = None
+        self.producer_wait_time = 0.0
+        self.consumer_wait_time = 0.0
+
     def closed(self):
         return self._closed
 
     def rows(self):
         return self.buffer
 
+    def batches(self):
+        """Get data objects from pipe in batches - lists of data objects. Receiving node owns the
+        batch: it might modify or pass the list further."""
+        if self.buffer:
+            yield self.buffer
+
     def records(self):
         """Get data objects from pipe as records (dict objects). This is convenience method with
         performance costs. Nodes are recommended to process rows instead."""
@@ -54,9 +99,23 @@ class SimpleDataPipe(object):
     def put(self, obj):
         self.buffer.append(obj)
 
+    def put_batch(self, rows):
+        """Put list of data objects `rows` into the pipe. Pipe takes ownership of the list - sender
+        should not modify it afterwards."""
+        self.buffer.extend(rows)
+
+    def put_barrier(self, number):
+        """Pass checkpoint barrier `number` to the receiving side after all data objects that were
+        put into the pipe so far. Dummy pipe ignores barriers."""
+        pass
+
     def done_receiving(self):
         self._closed = True
-        pass
+        self._notify_done_receiving()
+
+    def _notify_done_receiving(self):
+        if self.on_done_receiving:
+            self.on_done_receiving(self)
 
     def done_sending(self):
         pass
@@ -71,12 +130,30 @@ class Pipe(SimpleDataPipe):
     one thread is sending data to another thread. There is only one backward signalling: closing 
     the pipe from remote object.
 
-
+    Pipe is a ring of up to `depth` batches ready to be received, so the sending node can work
+    ahead of the receiving node. Lists of batches drained by ``rows()`` are reused by the
+    sending side.
+
+    :Attributes:
+        * `batches_sent`, `rows_sent`: number of batches and data objects sent
+        * `rows_received`: number of data objects received
+        * `peak_buffered_rows`: maximal number of data objects waiting for the receiving node
+        * `producer_wait_time`: total time in seconds the sending node was blocked by full pipe
+        * `consumer_wait_time`: total time in seconds the receiving node waited for data
+        * `row_size`: estimated size of a data object in bytes (set by adaptive pipes)
     """
 
-    def __init__(self, buffer_size=1000):
+    def __init__(self, buffer_size=1000, depth=2, adaptive=False, min_buffer_size=100,
+                 max_buffer_size=100000, max_memory=64*1024*1024):
         """Creates uni-drectional data pipe for passing data between two threads in batches of size
-        `buffer_size`.
+        `buffer_size`. At most `depth` batches might be waiting for the receiving node, the
+        sending node is blocked when there are more.
+
+        If `adaptive` is ``True``, then `buffer_size` is only the initial batch size. The batch
+        size is doubled when batches are filled too quickly and halved when the receiving node
+        waits for slowly filled batches. The size is kept between `min_buffer_size` and
+        `max_buffer_size` and estimated size of all batches of the pipe should not exceed
+        `max_memory` bytes.
 
         If receiving node is finished with source data and does not want anything any more, it
         should send ``done_receiving()`` to the pipe. In most cases, stream runner will send
@@ -89,10 +166,24 @@ class Pipe(SimpleDataPipe):
 
         super(Pipe, self).__init__()
         self.buffer_size = buffer_size
+        self.depth = depth
+
+        self.adaptive = adaptive
+        self.min_buffer_size = min_buffer_size
+        self.max_buffer_size = max_buffer_size
+        self.max_memory = max_memory
+
+        self.peak_buffered_rows = 0
+        self.row_size = None
+        self._consumer_waiting = False
+        self._last_flush = time.time()
 
-        # Should it be deque or array?
         self.staging_buffer = []
-        self._ready_buffer = None
+        # Batches ready to be received
+        self._ready = collections.deque()
+        self._ready_rows = 0
+        # Drained batch lists to be reused as staging buffers
+        self._free = []
 
         self._done_sending = False
         self._done_receiving = False
@@ -116,7 +207,7 @@ class Pipe(SimpleDataPipe):
         return len(self.staging_buffer) >= self.buffer_size
 
     def is_consumed(self):
-        return self._ready_buffer is None
+        return not self._ready
 
     def put(self, obj):
         """Put data object into the pipe buffer. When buffer is full it is enqueued and receiving node
@@ -128,6 +219,48 @@ class Pipe(SimpleDataPipe):
 
         if self.is_full():
             self._flush()
+
+    def put_batch(self, rows):
+        """Put list of data objects `rows` into the pipe. Small batches are merged with pending
+        data objects, lists of at least `buffer_size` objects are passed to the receiving node as
+        they are. Pipe takes ownership of the list - sender should not modify it afterwards."""
+        if not rows:
+            return
+
+        if len(self.staging_buffer) + len(rows) < self.buffer_size:
+            self.staging_buffer.extend(rows)
+            return
+
+        if self.staging_buffer:
+            self._flush()
+
+        self.staging_buffer = rows
+        self._flush()
+
+    def put_barrier(self, number):
+        """Pass checkpoint barrier `number` to the receiving node after all data objects that were
+        put into the pipe so far. The receiving node calls `on_barrier` when it reaches the
+        barrier."""
+
+        if self.staging_buffer:
+            self._flush()
+
+        self.not_full.acquire()
+        try:
+            if len(self._ready) >= self.depth and not self._closed:
+                start = time.time()
+                while len(self._ready) >= self.depth and not self._closed:
+                    self.not_full.wait()
+                self.producer_wait_time += time.time() - start
+
+            if self._closed:
+                return
+
+            self._ready.append(_Barrier(number))
+            self.not_empty.notify()
+        finally:
+            self.not_full.release()
+
     def _note(self, note):
         # print note
         pass
@@ -136,66 +269,137 @@ class Pipe(SimpleDataPipe):
         self._note("P flushing: close? %s closed? %s" % (close, self._closed))
         self._note("P _nf acq?")
         self.not_full.acquire()
-        if self._closed:
-            self._note("P _not_full rel!")
-            self.not_full.release()
-            return
-        elif len(self.staging_buffer) == 0:
-            try:
-                self._closed = close
-                self.not_empty.notify()
-            finally:
-                self._note("P _not_full rel!")
-                self.not_full.release()
-            return
-
         try:
-            self._note("P _not_full wait ...")
-            while not self.is_consumed() and not self._closed:
-                self.not_full.wait()
-            self._note("P _not_full got <")
-            if not self._closed:
-                self._ready_buffer = self.staging_buffer
-                self.staging_buffer = []
-                self._closed = close
-                self._note("P _not_empty notify >")
-                self.not_empty.notify()
+            if self._closed:
+                return
+
+            if self.staging_buffer:
+                if self.adaptive:
+                    self._adapt()
+
+                self._note("P _not_full wait ...")
+                if len(self._ready) >= self.depth and not self._closed:
+                    start = time.time()
+                    while len(self._ready) >= self.depth and not self._closed:
+                        self.not_full.wait()
+                    self.producer_wait_time += time.time() - start
+                self._last_flush = time.time()
+                self._note("P _not_full got <")
+
+                if self._closed:
+                    return
+
+                batch_size = len(self.staging_buffer)
+                self._ready.append(self.staging_buffer)
+                self.batches_sent += 1
+                self.rows_sent += batch_size
+                self._ready_rows += batch_size
+                if self._ready_rows > self.peak_buffered_rows:
+                    self.peak_buffered_rows = self._ready_rows
+
+                if self._free:
+                    self.staging_buffer = self._free.pop()
+                else:
+                    self.staging_buffer = []
+
+            if close:
+                self._done_sending = True
+                self._closed = True
 
+            self._note("P _not_empty notify >")
+            self.not_empty.notify()
         finally:
             self._note("P _not_full rel!")
             self.not_full.release()
 
+    def _adapt(self):
+        """Adjust `buffer_size` according to the time the staging buffer was filled in. Called
+        with the pipe lock held."""
+
+        fill_time = time.time() - self._last_flush
+
+        if len(self.staging_buffer) < self.buffer_size:
+            # Flushed on close or a small batch, no information about the rate
+            return
+
+        self.row_size = _estimate_row_size(self.staging_buffer[0])
+
+        size = self.buffer_size
+        if fill_time < ADAPTIVE_MIN_FILL_TIME:
+            size = size * 2
+        elif fill_time > ADAPTIVE_MAX_FILL_TIME and self._consumer_waiting:
+            size = size / 2
+
+        # Staging buffer, ready batches and a batch being processed by the receiving node
+        memory_limit = self.max_memory / (self.row_size * (self.depth + 2))
+
+        size = min(size, self.max_buffer_size, memory_limit)
+        self.buffer_size = max(size, self.min_buffer_size)
+
     def rows(self):
         """Get data object from pipe. If there is no buffer ready, wait until source object sends
         some data."""
 
-        done_sending = False
-        while(not done_sending):
+        for batch in self.batches():
+            for row in batch:
+                yield row
+            self._recycle(batch)
+
+    def _recycle(self, batch):
+        """Return drained `batch` list to be reused as a staging buffer."""
+        del batch[:]
+        self.mutex.acquire()
+        try:
+            if len(self._free) < self.depth:
+                self._free.append(batch)
+        finally:
+            self.mutex.release()
+
+    def batches(self):
+        """Get data objects from pipe in batches - lists of data objects as they were sent by the
+        source node. If there is no batch ready, wait until source object sends some data. The
+        pipe is not locked while the receiving node processes the batch, so the source node can
+        prepare the next batch in the meantime."""
+
+        while True:
             self._note("C _not_empty acq?")
             self.not_empty.acquire()
             try:
                 self._note("C _not_empty wait ...")
-                while not self._ready_buffer and not self._closed:
-                    self.not_empty.wait()
+                if not self._ready and not self._closed:
+                    start = time.time()
+                    self._consumer_waiting = True
+                    while not self._ready and not self._closed:
+                        self.not_empty.wait()
+                    self._consumer_waiting = False
+                    self.consumer_wait_time += time.time() - start
                 self._note("C _not_empty got <")
 
-                if self._ready_buffer:
-                    rows = self._ready_buffer
-                    self._ready_buffer = None
+                if self._ready and not self._done_receiving:
+                    batch = self._ready.popleft()
+                    if batch.__class__ is not _Barrier:
+                        self._ready_rows -= len(batch)
+                        self.rows_received += len(batch)
                     self._note("C _not_full notify >")
                     self.not_full.notify()
-
-                    for row in rows:
-                        yield row
                 else:
                     self._note("C no buffer")
-
-
-                done_sending = self._closed
+                    batch = None
             finally:
                 self._note("_not_empty rel!")
                 self.not_empty.release()
 
+            if batch is None:
+                break
+
+            if batch.__class__ is _Barrier:
+                # All batches before the barrier were processed by the receiving node
+                if self.on_barrier:
+                    self.on_barrier(batch.number)
+                continue
+
+            yield batch
+
     def closed(self):
         """Return ``True`` if pipe is closed - not sending or not receiving data any more."""
         return self._closed
@@ -209,13 +413,253 @@ class Pipe(SimpleDataPipe):
         self._note("C not_empty acq? r")
         self.not_empty.acquire()
         self._note("C closing")
+        was_receiving = not self._done_receiving
+        self._done_receiving = True
         self._closed = True
+        self._ready.clear()
+        self._ready_rows = 0
         self._note("C notif close")
-        self.not_full.notify()
+        self.not_full.notify_all()
+        self.not_empty.notify_all()
         self.not_empty.release()
 
         self._note("C not_empty rel! r")
 
+        if was_receiving:
+            self._notify_done_receiving()
+
+class _Barrier(object):
+    """Checkpoint barrier passed through a pipe between batches."""
+    def __init__(self, number):
+        self.number = number
+
+def _estimate_row_size(row):
+    """Estimate memory size of a data object `row` in bytes."""
+    size = sys.getsizeof(row)
+    if isinstance(row, (list, tuple)):
+        size += sum(sys.getsizeof(value) for value in row)
+    elif isinstance(row, dict):
+        size += sum(sys.getsizeof(value) for value in row.values())
+    return size
+
+class ProcessPipe(SimpleDataPipe):
+    """Data pipe between two processes. Data objects are sent in batches of `buffer_size` the same
+    way as in the :class:`Pipe`, however the batches are passed through a
+    ``multiprocessing.Queue``, therefore the data objects should be picklable.
+
+    The pipe has to be created before the sending and receiving processes are forked.
+    """
+
+    def __init__(self, buffer_size=1000, depth=2):
+        """Creates uni-directional data pipe for passing data between two processes in batches of
+        size `buffer_size`. At most `depth` batches might be in flight, sending side is blocked
+        when there are more batches that were not received yet.
+
+        Receiving side can close the pipe with ``done_receiving()``, sending side should send
+        ``done_sending()`` when there are no more data to be sent.
+        """
+
+        super(ProcessPipe, self).__init__()
+        self.buffer_size = buffer_size
+
+        self.staging_buffer = []
+        self.queue = multiprocessing.Queue(depth)
+
+        # Set by the receiving side - pipe does not want any more data
+        self._stopped = multiprocessing.Event()
+        # Local to the sending process
+        self._done_sending = False
+
+    def put(self, obj):
+        """Put data object into the pipe buffer. When buffer is full it is sent to the receiving
+        process."""
+        self.staging_buffer.append(obj)
+
+        if len(self.staging_buffer) >= self.buffer_size:
+            self._flush()
+
+    def put_batch(self, rows):
+        """Put list of data objects `rows` into the pipe. Small batches are merged with pending
+        data objects, larger are sent as they are."""
+        if not rows:
+            return
+
+        if len(self.staging_buffer) + len(rows) < self.buffer_size:
+            self.staging_buffer.extend(rows)
+            return
+
+        self._flush()
+        self._send(rows)
+
+    def _flush(self, close=False):
+        if self.staging_buffer:
+            self._send(self.staging_buffer)
+            self.staging_buffer = []
+
+        if close:
+            self._done_sending = True
+            self._send(None)
+
+    def _send(self, batch):
+        start = time.time()
+        try:
+            while True:
+                if self._stopped.is_set():
+                    # Nobody is going to read the data, do not wait for them to be written on exit
+                    self.queue.cancel_join_thread()
+                    return
+                try:
+                    self.queue.put(batch, True, PROCESS_POLL_INTERVAL)
+                    break
+                except Queue.Full:
+                    pass
+        finally:
+            self.producer_wait_time += time.time() - start
+
+        if batch is not None:
+            self.batches_sent += 1
+            self.rows_sent += len(batch)
+
+    def rows(self):
+        """Get data objects from the pipe. Waits until the sending process sends some data."""
+        for batch in self.batches():
+            for row in batch:
+                yield row
+
+    def batches(self):
+        """Get data objects from the pipe in batches as they were sent. Waits until the sending
+        process sends some data."""
+        start = time.time()
+        while not self._stopped.is_set():
+            try:
+                batch = self.queue.get(True, PROCESS_POLL_INTERVAL)
+            except Queue.Empty:
+                continue
+            finally:
+                now = time.time()
+                self.consumer_wait_time += now - start
+                start = now
+
+            if batch is None:
+                break
+
+            self.rows_received += len(batch)
+            yield batch
+            start = time.time()
+
+    def closed(self):
+        """Return ``True`` if pipe is closed - not sending or not receiving data any more."""
+        return self._done_sending or self._stopped.is_set()
+
+    def done_sending(self):
+        """Close pipe from sender side"""
+        self._flush(True)
+
+    def done_receiving(self):
+        """Close pipe from receiver side"""
+        if not self._stopped.is_set():
+            self._stopped.set()
+            self._notify_done_receiving()
+
+class _FusedPipe(SimpleDataPipe):
+    """Pipe that passes data objects directly to the ``process_batch()`` method of the `target`
+    node in the thread of the sending node. Data objects are collected into batches of
+    `buffer_size`. Used by the stream to fuse linear chains of row processing nodes."""
+
+    def __init__(self, target, buffer_size=1000):
+        super(_FusedPipe, self).__init__()
+        self.target = target
+        self.buffer_size = buffer_size
+
+    def rows(self):
+        raise StreamError("Rows can not be read from a fused pipe")
+
+    def batches(self):
+        raise StreamError("Rows can not be read from a fused pipe")
+
+    def put(self, obj):
+        self.buffer.append(obj)
+        if len(self.buffer) >= self.buffer_size:
+            self._flush()
+
+    def put_batch(self, rows):
+        if self.buffer:
+            self._flush()
+        self._process(rows)
+
+    def _flush(self):
+        batch = self.buffer
+        self.buffer = []
+        self._process(batch)
+
+    def put_barrier(self, number):
+        """Process pending data objects and pass checkpoint barrier `number` to the target
+        node."""
+        if self.buffer:
+            self._flush()
+        if self._closed:
+            return
+
+        try:
+            self.target._pass_barrier(number)
+        except _FusedNodeError:
+            raise
+        except Exception as e:
+            raise _FusedNodeError(self.target, e, sys.exc_info()[2])
+
+    def _process(self, batch):
+        if self._closed or not batch:
+            return
+
+        self.batches_sent += 1
+        self.rows_sent += len(batch)
+        self.rows_received += len(batch)
+
+        try:
+            batch = self.target.process_batch(batch)
+            if batch:
+                self.target.put_batch(batch)
+        except NodeFinished:
+            self._finish()
+            self._notify_done_receiving()
+        except _FusedNodeError:
+            raise
+        except Exception as e:
+            raise _FusedNodeError(self.target, e, sys.exc_info()[2])
+
+    def done_sending(self):
+        """Process remaining data objects and finish the fused target node: flush its
+        outputs."""
+        try:
+            self._flush()
+        finally:
+            self._finish()
+
+    def _finish(self):
+        if self._closed:
+            return
+        self._closed = True
+        self.buffer = []
+        for pipe in self.target.outputs:
+            if not pipe.closed():
+                pipe.done_sending()
+
+    def done_receiving(self):
+        """Stop passing data to the target node."""
+        if not self._closed:
+            self._closed = True
+            self.buffer = []
+            self._notify_done_receiving()
+
+class _FusedNodeError(Exception):
+    """Wraps an exception raised by a fused node, so the stream can report the node that failed
+    instead of the node that owns the thread."""
+    def __init__(self, node, exception, traceback):
+        super(_FusedNodeError, self).__init__(str(exception))
+        self.node = node
+        self.exception = exception
+        self.traceback = traceback
+
 class Stream(object):
     """Data processing stream"""
     def __init__(self, nodes=None, connections=None):
@@ -224,16 +668,39 @@ class Stream(object):
         :Parameters:
             * `nodes` - dictionary with keys as node names and values as nodes
             * `connections` - list of two-item tuples. Each tuple contains source and target node
-              or source and target node name.
+              or source and target node name. Optional third item is a dictionary with options of
+              the pipe between the nodes, see :meth:`connect`.
             * `stream` - another stream or 
         """
         super(Stream, self).__init__()
         self.nodes = []
         self.node_dict = {}
         self.connections = set()
+        self.connection_options = {}
+
+        # Adjacency indexes maintained by add(), remove(), connect() and remove_connection(),
+        # connections should not be changed directly
+        self._targets = {}
+        self._sources = {}
+        self._node_names = {}
+        self._sorted_nodes = None
 
         self.logger = get_logger()
 
+        self.executor = "thread"
+        self.groups = None
+        self.fusion = True
+        self._fused_nodes = set()
+        self.pushdown = True
+        self.pruning = True
+        self.adaptive_pipes = False
+        self._edge_pipes = {}
+        self.metrics = None
+
+        self.checkpoint_path = None
+        self.checkpoint_interval = 60
+        self._checkpointer = None
+
         if nodes:
             try:
                 for name, node in nodes.items():
@@ -242,8 +709,7 @@ class Stream(object):
                 raise StreamError("Nodes should be a dictionary, is %s" % type(nodes))
 
         if connections:
-            for connection in connections:
-                self.connect(connection[0], connection[1])
+            self._connect_all(connections)
 
         self.exceptions = []
 
@@ -269,9 +735,13 @@ class Stream(object):
             if name in self.node_dict:
                 raise KeyError("Node with name %s already exists" % name)
             self.node_dict[name] = node
+            self._node_names.setdefault(node, name)
 
-        if node not in self.nodes:
+        if node not in self._targets:
             self.nodes.append(node)
+            self._targets[node] = []
+            self._sources[node] = []
+            self._sorted_nodes = None
 
     def set_node_name(self, node, name):
         """Sets a name for `node`. If `name` is ``None`` then node name will be removed.
@@ -279,7 +749,7 @@ class Stream(object):
         Raises an exception if the `node` is not part of the stream or there is already node with
         same name.
         """
-        if node not in self.nodes:
+        if node not in self._targets:
             raise KeyError("Node %s does not belong to stream" % node)
 
         if name:
@@ -287,8 +757,12 @@ class Stream(object):
                 raise KeyError("Node with name %s already exists" % name)
 
             self.node_dict[name] = node
+            self._node_names.setdefault(node, name)
         else:
-            del self.node_dict[name]
+            for (current_name, current_node) in self.node_dict.items():
+                if current_node == node:
+                    del self.node_dict[current_name]
+            self._node_names.pop(node, None)
 
     def remove(self, node):
         """Remove a `node` from the stream. Also all connections will be removed."""
@@ -299,28 +773,64 @@ class Stream(object):
         for (name, current_node) in self.node_dict.items():
             if current_node == node:
                 del self.node_dict[name]
+        self._node_names.pop(node, None)
 
-        to_be_removed = set()
-        for connection in self.connections:
-            if connection[0] == node or connection[1] == node:
-                to_be_removed.add(connection)
+        for target in list(self._targets[node]):
+            self.remove_connection(node, target)
+        for source in list(self._sources[node]):
+            self.remove_connection(source, node)
 
-        for connection in to_be_removed:
-            self.connections.remove(connection)
+        del self._targets[node]
+        del self._sources[node]
+        self._sorted_nodes = None
 
-    def connect(self, source, target):
-        """Connects source node and target node. Nodes can be provided as objects or names."""
+    def connect(self, source, target, **pipe_options):
+        """Connects source node and target node. Nodes can be provided as objects or names.
+
+        `pipe_options` are passed to the pipe created between the nodes when the stream is run,
+        for example ``buffer_size`` or ``depth`` - number of batches that might be waiting for
+        the target node. Set larger `depth` for bursty sources, such as remote data sources. Nodes
+        connected with explicit pipe options are not fused.
+        """
 
         source_node = self.node(source)
         target_node = self.node(target)
-        self.connections.add((source_node, target_node))
+        connection = (source_node, target_node)
+
+        if connection not in self.connections:
+            self.connections.add(connection)
+            self._targets.setdefault(source_node, []).append(target_node)
+            self._sources.setdefault(target_node, []).append(source_node)
+            self._sorted_nodes = None
+
+        if pipe_options:
+            self.connection_options[connection] = pipe_options
+        else:
+            self.connection_options.pop(connection, None)
+
+    def _connect_all(self, connections):
+        """Connect nodes from list of tuples ``(source, target)`` or ``(source, target,
+        pipe_options)``."""
+        for connection in connections:
+            if len(connection) > 2 and connection[2]:
+                options = dict((str(key), value) for key, value in connection[2].items())
+            else:
+                options = {}
+            self.connect(connection[0], connection[1], **options)
 
     def remove_connection(self, source, target):
         """Remove connection between source and target nodes, if exists."""
         source_node = self.node(source)
         target_node = self.node(target)
+        connection = (source_node, target_node)
 
-        self.connections.discard((source_node, target_node))
+        if connection in self.connections:
+            self.connections.remove(connection)
+            self._targets[source_node].remove(target_node)
+            self._sources[target_node].remove(source_node)
+            self._sorted_nodes = None
+
+        self.connection_options.pop(connection, None)
 
     def sorted_nodes(self):
         """
@@ -342,54 +852,45 @@ class Stream(object):
             else 
                 return proposed topologically sorted order: L
         """
-        def is_source(node, connections):
-            for connection in connections:
-                if node == connection[1]:
-                    return False
-            return True
-
-        def source_connections(node, connections):
-            conns = set()
-            for connection in connections:
-                if node == connection[0]:
-                    conns.add(connection)
-            return conns
-
-        nodes = set(self.nodes)
-        connections = self.connections.copy()
-        sorted_nodes = []
-        source_nodes = set()
+        if self._sorted_nodes is None:
+            self._sorted_nodes = self._sort_nodes()
+
+        return list(self._sorted_nodes)
+
+    def _sort_nodes(self):
+        """Sort nodes using the adjacency indexes in O(V+E). Nodes without dependencies keep the
+        order in which they were added."""
+
+        # Number of incoming edges of each node
+        incoming = dict((node, len(self._sources[node])) for node in self.nodes)
 
         # Find source nodes:
-        for node in nodes:
-            if is_source(node, connections):
-                source_nodes.add(node)
+        source_nodes = collections.deque(node for node in self.nodes if not incoming[node])
+        sorted_nodes = []
 
         # while S is non-empty do
         while source_nodes:
             # remove a node n from S
-            node = source_nodes.pop()
+            node = source_nodes.popleft()
             # insert n into L
             sorted_nodes.append(node)
 
             # for each node m with an edge e from n to m do
-            s_connections = source_connections(node, connections)
-            for connection in s_connections:
+            for target in self._targets[node]:
                 #     remove edge e from the graph
-                m = connection[1]
-                connections.remove(connection)
+                incoming[target] -= 1
                 #     if m has no other incoming edges then
                 #         insert m into S
-                if is_source(m, connections):
-                    source_nodes.add(m)
+                if not incoming[target]:
+                    source_nodes.append(target)
 
         # if graph has edges then
         #     output error message (graph has at least one cycle)
         # else 
         #     output message (proposed topologically sorted order: L)
 
-        if connections:
-            raise Exception("Steram has at least one cycle")
+        if len(sorted_nodes) != len(self.nodes):
+            raise Exception("Stream has at least one cycle")
 
         return sorted_nodes
         
@@ -433,6 +934,9 @@ class Stream(object):
         """Adds nodes and connections specified in the dictionary. Dictionary might contain
         node names instead of real classes. You can use this method for creating stream
         from a dictionary that was created from a JSON file, for example.
+
+        `connections` is a list of ``(source, target)`` tuples. Optional third item of a connection
+        is a dictionary with pipe options, for example ``["source", "clean", {"depth": 8}]``.
         """
 
         node_dict = node_dictionary()
@@ -466,8 +970,7 @@ class Stream(object):
             self.add(node_instance, name)
 
         if connections:
-            for connection in connections:
-                self.connect(connection[0], connection[1])
+            self._connect_all(connections)
 
     def configure(self, config = {}):
         """Configure node properties based on configuration. Only named nodes can be configured at the
@@ -517,20 +1020,277 @@ class Stream(object):
     def node_targets(self, node):
         """Return nodes that `node` passes data into."""
         node = self.node(node)
-        nodes =[conn[1] for conn in self.connections if conn[0] == node]
-        return nodes
+        return list(self._targets.get(node, []))
 
     def node_sources(self, node):
         """Return nodes that provide data for `node`."""
         node = self.node(node)
-        nodes =[conn[0] for conn in self.connections if conn[1] == node]
-        return nodes
+        return list(self._sources.get(node, []))
+
+    def _assign_node_groups(self, sorted_nodes):
+        """Assign nodes to execution groups. Group ``None`` is the stream (main) process, other
+        groups are worker processes of the ``process`` executor. Nodes from `groups` (list of
+        lists of nodes or node names) share one worker process, other non-target nodes get a
+        worker process each."""
+
+        self._node_groups = {}
+
+        if self.executor == "thread":
+            for node in sorted_nodes:
+                self._node_groups[node] = None
+            return
+        elif self.executor != "process":
+            raise StreamError("Unknown stream executor '%s'" % self.executor)
+
+        for i, group in enumerate(self.groups or []):
+            for node in group:
+                self._node_groups[self.node(node)] = i
+
+        group_id = len(self.groups or [])
+        for node in sorted_nodes:
+            if node in self._node_groups:
+                continue
+            # Target nodes are run in the stream process, so the data they collect (such as
+            # RowListTargetNode) are available after the run
+            if isinstance(node, TargetNode):
+                self._node_groups[node] = None
+            else:
+                self._node_groups[node] = group_id
+                group_id += 1
+
+    def _plan_fusion(self, sorted_nodes):
+        """Find nodes that will be fused with their source node. A node is fused when it
+        implements ``process_row()``, it does not use parallel workers, it has only one source
+        node, the source node passes data only to the node and both nodes are in the same
+        execution group. Fused nodes are not run in their own thread, their source node calls
+        ``process_row()`` directly."""
+
+        self._fused_nodes = set()
+
+        if not self.fusion:
+            return
+
+        for node in sorted_nodes:
+            if not _implements_process_row(node):
+                continue
+            if getattr(node, "workers", 1) > 1 or getattr(node, "parallelism", 1) > 1:
+                continue
+
+            sources = self.node_sources(node)
+            if len(sources) != 1:
+                continue
+            source = sources[0]
+            if len(self.node_targets(source)) != 1:
+                continue
+            if self._node_groups[source] != self._node_groups[node]:
+                continue
+            if (source, node) in self.connection_options:
+                continue
+
+            self._fused_nodes.add(node)
+
+    def _plan_pruning(self, sorted_nodes):
+        """Find fields that are used by nodes following each source node. Requirements are
+        propagated from target nodes backwards with :meth:`brewery.nodes.Node.required_input_fields`.
+        Returns dictionary where keys are source nodes that can read only some fields (implement
+        ``prune_fields()``) and values are sets of names of required fields."""
 
-    def _initialize(self):
+        if not self.pruning:
+            return {}
+
+        required_inputs = {}
+        required_fields = {}
+
+        for node in reversed(sorted_nodes):
+            targets = self.node_targets(node)
+            if targets:
+                names = set()
+                for target in targets:
+                    if required_inputs[target] is None:
+                        names = None
+                        break
+                    names |= required_inputs[target]
+            else:
+                names = None
+
+            required_inputs[node] = node.required_input_fields(names)
+
+            if names is not None and not self.node_sources(node) \
+                    and hasattr(node, "prune_fields"):
+                required_fields[node] = names
+
+        return required_fields
+
+    def _plan_pushdown(self, source):
+        """Push filters and aggregation into the data source of `source` node. Nodes that follow
+        the source node in a chain - each node passes data only to the next one - are examined:
+
+        * conditions of filtering nodes (see :meth:`brewery.nodes.Node.filter_conditions`) are
+          passed to the source node's ``push_filter()``. Nodes with exact conditions accepted by
+          the source pass all rows, other nodes keep filtering in python.
+        * aggregation of an aggregating node (see :meth:`brewery.nodes.Node.aggregation`)
+          preceded only by filters evaluated by the source is passed to the source node's
+          ``push_aggregation()``, the node then passes the aggregated rows.
+
+        Called after the source node is initialized and before the following nodes are
+        initialized."""
+
+        if not self.pushdown:
+            return
+
+        source_label = self.node_name(source) or node_label(source)
+        # Aggregation is valid only if all rows before it are filtered by the source
+        filtered_by_source = True
+
+        node = source
+        while True:
+            targets = self.node_targets(node)
+            if len(targets) != 1:
+                break
+            node = targets[0]
+            if len(self.node_sources(node)) != 1:
+                break
+
+            aggregation = node.aggregation()
+            if aggregation is not None:
+                if filtered_by_source and hasattr(source, "push_aggregation") \
+                        and source.push_aggregation(*aggregation):
+                    self.logger.info("aggregation of node %s pushed into source %s"
+                                        % (self.node_name(node) or node_label(node), source_label))
+                    node.aggregation_pushed_down = True
+                break
+
+            # Filters commute, therefore the chain continues after a partial filter
+            result = node.filter_conditions()
+            if result is None:
+                break
+            (conditions, exact) = result
+
+            if not hasattr(source, "push_filter") or not source.push_filter(conditions):
+                filtered_by_source = False
+                continue
+
+            self.logger.info("filter of node %s pushed into source %s%s"
+                                % (self.node_name(node) or node_label(node), source_label,
+                                   "" if exact else " (partially)"))
+            if exact:
+                node.filter_pushed_down = True
+            else:
+                filtered_by_source = False
+
+    def _plan_size_hints(self, sorted_nodes):
+        """Set `input_size_hints` of nodes that use them to estimated numbers of rows of their
+        inputs, see :meth:`brewery.nodes.Node.size_hint`. Estimates are computed only for nodes
+        preceding such nodes, as data sources might have to query a database for them. Called
+        after all nodes are initialized."""
+
+        pipe_sources = {}
+        for ((source, target), pipe) in self._edge_pipes.items():
+            pipe_sources[pipe] = source
+
+        hints = {}
+        def size_hint(node):
+            if node not in hints:
+                input_hints = [size_hint(pipe_sources[pipe]) for pipe in node.inputs]
+                try:
+                    hints[node] = node.size_hint(input_hints)
+                except Exception as e:
+                    self.logger.warn("size of output of node %s can not be estimated: %s"
+                                        % (self.node_name(node) or node_label(node), e))
+                    hints[node] = None
+            return hints[node]
+
+        for node in sorted_nodes:
+            if node.uses_size_hints:
+                node.input_size_hints = [size_hint(pipe_sources[pipe]) for pipe in node.inputs]
+                self.logger.debug("input size hints of node %s: %s"
+                                    % (self.node_name(node) or node_label(node),
+                                       node.input_size_hints))
+
+    def _plan_key_filters(self, sorted_nodes):
+        """Pass key filters of nodes (see :meth:`brewery.nodes.Node.input_key_filters`) to the
+        source nodes of their inputs. The source node might be followed by filtering nodes, which
+        pass rows unchanged. Filters are not used when the source node passes data to other nodes
+        as well - their rows would be filtered too - or to other inputs of the node - it would
+        wait for the node which waits for the source node.
+        Filters are planned only with the ``thread`` executor and when pushdown is enabled.
+        Filters that are not used are cancelled."""
+
+        if not self.pushdown or self.executor != "thread":
+            return
+
+        pipe_sources = {}
+        for ((source, target), pipe) in self._edge_pipes.items():
+            pipe_sources[pipe] = source
+
+        def ancestors(node):
+            result = set()
+            nodes = [node]
+            while nodes:
+                node = nodes.pop()
+                if node not in result:
+                    result.add(node)
+                    nodes += self.node_sources(node)
+            return result
+
+        for node in sorted_nodes:
+            for (index, key_filter) in node.input_key_filters():
+                pipe = node.inputs[index]
+                source = pipe_sources[pipe]
+                while len(self.node_sources(source)) == 1 \
+                        and len(self.node_targets(source)) == 1 \
+                        and source.filter_conditions() is not None:
+                    source = self.node_sources(source)[0]
+
+                if not isinstance(source, SourceNode) or self.node_sources(source):
+                    key_filter.cancel()
+                    continue
+
+                # Filtered source would drop rows of its other outputs
+                if len(self.node_targets(source)) != 1:
+                    key_filter.cancel()
+                    continue
+
+                other_inputs = set()
+                for other in node.inputs:
+                    if other is not pipe:
+                        other_inputs |= ancestors(pipe_sources[other])
+                if source in other_inputs:
+                    key_filter.cancel()
+                    continue
+
+                if not set(key_filter.fields) <= set(source.output_fields.names()):
+                    key_filter.cancel()
+                    continue
+
+                self.logger.info("key filter of node %s passed to source %s"
+                                    % (self.node_name(node) or node_label(node),
+                                       self.node_name(source) or node_label(source)))
+                source.output_key_filters = tuple(source.output_key_filters) + (key_filter, )
+
+    def _create_pipe(self, source, target):
+        """Create a pipe between `source` and `target` nodes. Nodes in different execution groups
+        are connected with a :class:`ProcessPipe`, fused nodes with a direct call pipe. Pipe
+        options specified with :meth:`connect` are passed to the pipe."""
+        if target in self._fused_nodes:
+            return _FusedPipe(target)
+
+        options = self.connection_options.get((source, target), {})
+        if self._node_groups[source] == self._node_groups[target]:
+            # Explicit buffer size is pinned
+            if self.adaptive_pipes and "buffer_size" not in options:
+                options = dict(options)
+                options.setdefault("adaptive", True)
+            return Pipe(**options)
+        else:
+            return ProcessPipe(**options)
+
+    def _initialize(self, states=None):
         """Initializes the data processing stream:
         
         * sorts nodes based on connection dependencies
         * creates pipes between nodes
+        * restores node `states` from a checkpoint, if provided
         * initializes each node
         * initializes pipe fields
         
@@ -540,6 +1300,10 @@ class Stream(object):
         self.logger.debug("sorting nodes")
         sorted_nodes = self.sorted_nodes()
         self.pipes = []
+        self._edge_pipes = {}
+
+        self._assign_node_groups(sorted_nodes)
+        self._plan_fusion(sorted_nodes)
 
         self.logger.debug("flushing pipes")
         for node in sorted_nodes:
@@ -553,10 +1317,39 @@ class Stream(object):
             targets = self.node_targets(node)
             for target in targets:
                 self.logger.debug("  connecting with %s" % (target))
-                pipe = Pipe()
+                pipe = self._create_pipe(node, target)
+                pipe.on_done_receiving = self._make_cancel_callback(node)
+                pipe.on_barrier = target._pass_barrier
                 node.add_output(pipe)
                 target.add_input(pipe)
                 self.pipes.append(pipe)
+                self._edge_pipes[(node, target)] = pipe
+
+        keys = self._checkpoint_keys(sorted_nodes)
+        if states is not None:
+            if set(states.keys()) != set(keys.values()):
+                raise StreamError("Checkpoint does not match nodes of the stream")
+            for node in sorted_nodes:
+                node.restore_state(states[keys[node]])
+
+        if self.checkpoint_path and self.executor != "process":
+            self._checkpointer = _Checkpointer(self.checkpoint_path, keys)
+        else:
+            if self.checkpoint_path:
+                self.logger.warn("checkpoints are not taken with the process executor")
+            self._checkpointer = None
+
+        # Nodes should know whether they are checkpointed before they are initialized
+        for node in sorted_nodes:
+            node._checkpointer = self._checkpointer
+            node._barrier_request = None
+            node.filter_pushed_down = False
+            node.aggregation_pushed_down = False
+            node.input_size_hints = None
+            if isinstance(node, SourceNode):
+                node.output_key_filters = ()
+
+        required_fields = self._plan_pruning(sorted_nodes)
 
         # Initialize fields
         for node in sorted_nodes:
@@ -565,6 +1358,13 @@ class Stream(object):
                                 % (len(node.inputs), len(node.outputs)))
             node.initialize()
 
+            # Following nodes are initialized with pruned fields and know what the source does
+            # for them
+            if node in required_fields and node.prune_fields(required_fields[node]):
+                self.logger.debug("  node output fields pruned")
+            if not self.node_sources(node):
+                self._plan_pushdown(node)
+
             # Ignore target nodes
             if isinstance(node, TargetNode):
                 self.logger.debug("  node is target, ignoring creation of output pipes")
@@ -575,22 +1375,212 @@ class Stream(object):
             for output_pipe in node.outputs:
                 output_pipe.fields = fields
 
-    def run(self):
+        self._plan_size_hints(sorted_nodes)
+        self._plan_key_filters(sorted_nodes)
+
+        if self._checkpointer:
+            unsupported = [node for node in sorted_nodes if not _supports_checkpoints(node)]
+            if unsupported:
+                labels = [self.node_name(node) or node_label(node) for node in unsupported]
+                self.logger.warn("stream is run without checkpoints, not supported by nodes: %s"
+                                    % ", ".join(labels))
+                self._checkpointer = None
+                for node in sorted_nodes:
+                    node._checkpointer = None
+
+    def _checkpoint_keys(self, sorted_nodes):
+        """Return dictionary of keys of nodes in checkpoints: node name or position of unnamed
+        node in the sorted node list."""
+        keys = {}
+        for (index, node) in enumerate(sorted_nodes):
+            keys[node] = self.node_name(node) or "#%d" % index
+        return keys
+
+    def run(self, executor="thread", groups=None, resume=False):
         """Run all nodes in the stream.
         
-        Each node is being wrapped and run in a separate thread.
-        
+        Each node is being wrapped and run in a separate thread. Linear chains of nodes that
+        process rows one by one (implement ``process_row()``) are fused: such node is run in the
+        thread of its source node without an intermediate pipe. Set stream attribute `fusion` to
+        ``False`` to run each node in its own thread.
+
+        If stream attribute `adaptive_pipes` is ``True``, then batch sizes of pipes between
+        threads, which have no explicit ``buffer_size``, are adjusted during the run. Chosen sizes
+        are logged at the end of the run and are available through :meth:`pipe_sizes`.
+
+        If `executor` is ``process``, then nodes are placed in worker processes and they are
+        connected with inter-process pipes, so CPU intensive nodes are not competing for the
+        same interpreter lock. `groups` is a list of lists of nodes (or node names) that should
+        share one worker process. Nodes which are not in any group are placed each into its own
+        worker process, except target nodes, which are run in the stream process. Data passed
+        between processes should be picklable.
+
         When an exception occurs, the stream is stopped and all catched exceptions are stored in
         attribute `exceptions`.
+
+        After the run, attribute `metrics` contains :class:`brewery.metrics.StreamMetrics` with
+        row counts and timings of nodes and pipes.
+
+        If stream attribute `checkpoint_path` is set, then a checkpoint is written into that
+        file every `checkpoint_interval` seconds (60 by default): positions of source nodes,
+        positions of committed output of target nodes and states of other nodes, all taken when
+        the same data passed the nodes. The file is removed when the stream finishes
+        successfully. If `resume` is ``True``, then the stream continues from the checkpoint of
+        a failed run, or runs from the beginning if there is no checkpoint. Checkpoints are
+        taken only when all nodes support them (see
+        :meth:`brewery.nodes.Node.checkpoint_state`), nodes have at most one input and the
+        `executor` is ``thread``.
         
         """
-        self._initialize()
+        self.executor = executor
+        self.groups = groups
+        self.metrics = None
+
+        states = None
+        if resume:
+            if not self.checkpoint_path:
+                raise StreamError("Can not resume stream: no checkpoint_path")
+            states = load_checkpoint(self.checkpoint_path)
+            if states is None:
+                self.logger.info("no checkpoint found, running stream from the beginning")
+            else:
+                self.logger.info("resuming stream from checkpoint %s" % self.checkpoint_path)
+
+        self._initialize(states)
 
         # FIXME: do better exception handling here: what if both will raise exception?
+        failed = True
         try:
-            self._run()
+            if executor == "process":
+                self._run_processes()
+            else:
+                self._run()
+
+            if self.checkpoint_path and os.path.exists(self.checkpoint_path):
+                os.remove(self.checkpoint_path)
+            failed = False
         finally:
-            self._finalize()
+            if self.adaptive_pipes:
+                self._log_pipe_sizes()
+            self._finalize(failed)
+
+    def bottleneck_report(self):
+        """Return :class:`brewery.metrics.BottleneckReport` of the last run: the node that
+        limited throughput of the stream, the critical path through the stream graph and time
+        spent by nodes blocked by back-pressure. Raises `StreamError` if the stream was not run."""
+
+        if not self.metrics:
+            raise StreamError("No metrics for bottleneck report, stream was not run")
+
+        order = [self.node_name(node) or node_label(node) for node in self.sorted_nodes()]
+        return self.metrics.bottleneck_report(order)
+
+    def node_name(self, node):
+        """Return name of `node` or ``None`` if the node has no name."""
+        return self._node_names.get(node)
+
+    def pipe_sizes(self):
+        """Return batch sizes of pipes of the last run as a list of connections ``(source,
+        target, {"buffer_size": size})`` where source and target are node names (or nodes if
+        they have no name). The list can be used as `connections` in a stream description to
+        pin the sizes chosen by adaptive pipes. Fused connections are not included."""
+
+        sizes = []
+        for ((source, target), pipe) in self._edge_pipes.items():
+            if isinstance(pipe, _FusedPipe):
+                continue
+            source_name = self.node_name(source) or source
+            target_name = self.node_name(target) or target
+            sizes.append((source_name, target_name, {"buffer_size": pipe.buffer_size}))
+
+        return sizes
+
+    def _log_pipe_sizes(self):
+        self.logger.info("pipe batch sizes:")
+        for (source, target, options) in self.pipe_sizes():
+            pipe = self._edge_pipes[(self.node(source), self.node(target))]
+            self.logger.info("    %s -> %s: %d (row size: %s, producer wait: %.3fs, "
+                             "consumer wait: %.3fs)"
+                             % (source, target, options["buffer_size"],
+                                getattr(pipe, "row_size", None),
+                                getattr(pipe, "producer_wait_time", 0.0),
+                                getattr(pipe, "consumer_wait_time", 0.0)))
+
+    def _edges(self, sorted_nodes):
+        """Return list of pipes as tuples (`source index`, `target index`, `pipe`) where
+        indexes refer to `sorted_nodes`."""
+        index = dict((node, i) for (i, node) in enumerate(sorted_nodes))
+        return [(index[source], index[target], pipe)
+                    for ((source, target), pipe) in self._edge_pipes.items()]
+
+    def _thread_heads(self, sorted_nodes):
+        """Return dictionary where keys are nodes and values are nodes which run them in their
+        threads - the node itself or the first node of a fused chain."""
+        heads = {}
+        for node in sorted_nodes:
+            if node in self._fused_nodes:
+                heads[node] = heads[self.node_sources(node)[0]]
+            else:
+                heads[node] = node
+        return heads
+
+    def _build_metrics(self, reports, sorted_nodes, wall_time):
+        """Create :class:`StreamMetrics` from counter reports of stream and worker processes.
+        See :func:`_metrics_report` for report structure."""
+
+        metrics = StreamMetrics()
+        metrics.wall_time = wall_time
+
+        threads = {}
+        sent = {}
+        received = {}
+        caches = {}
+        for report in reports:
+            threads.update(report["threads"])
+            sent.update(report["sent"])
+            received.update(report["received"])
+            caches.update(report["caches"])
+
+        names = [self.node_name(node) or node_label(node) for node in sorted_nodes]
+        heads = self._thread_heads(sorted_nodes)
+        index = dict((node, i) for (i, node) in enumerate(sorted_nodes))
+
+        node_metrics = []
+        for (i, node) in enumerate(sorted_nodes):
+            node_metric = NodeMetrics(names[i])
+            head_index = index[heads[node]]
+            node_metric.thread = names[head_index]
+            if head_index in threads:
+                (node_metric.wall_time, node_metric.cpu_time) = threads[head_index]
+            if i in caches:
+                (node_metric.cache_hits, node_metric.cache_misses) = caches[i]
+            node_metrics.append(node_metric)
+            metrics.nodes[names[i]] = node_metric
+
+        for (source, target, pipe) in self._edges(sorted_nodes):
+            pipe_metric = PipeMetrics(names[source], names[target])
+            counters = sent.get((source, target))
+            if counters:
+                pipe_metric.batches = counters["batches"]
+                pipe_metric.rows = counters["rows"]
+                pipe_metric.peak_buffered_rows = counters["peak_buffered_rows"]
+                pipe_metric.producer_wait_time = counters["producer_wait_time"]
+
+                node_metric = node_metrics[source]
+                node_metric.rows_out = max(node_metric.rows_out, counters["rows"])
+                node_metric.output_wait_time += counters["producer_wait_time"]
+
+            counters = received.get((source, target))
+            if counters:
+                pipe_metric.consumer_wait_time = counters["consumer_wait_time"]
+
+                node_metric = node_metrics[target]
+                node_metric.rows_in += counters["rows"]
+                node_metric.input_wait_time += counters["consumer_wait_time"]
+
+            metrics.pipes.append(pipe_metric)
+
+        return metrics
 
     def _run(self):
 
@@ -599,32 +1589,147 @@ class Stream(object):
 
         threads = []
         sorted_nodes = self.sorted_nodes()
+        start = time.time()
+
+        # Threads report here when they are finished
+        finished = Queue.Queue()
+
+        self.exceptions = []
 
         self.logger.debug("launching threads")
         for node in sorted_nodes:
+            if node in self._fused_nodes:
+                self.logger.debug("node %s is fused" % node_label(node))
+                continue
             self.logger.debug("launching thread for node %s" % node_label(node))
-            thread = _StreamNodeThread(node)
+            thread = _StreamNodeThread(node, finished)
             thread.start()
-            threads.append((thread, node))
+            threads.append(thread)
+
+        # Join threads in order of completion, so the stream is stopped as soon as any node fails
+        if self._checkpointer:
+            self._wait_with_checkpoints(finished, len(threads), sorted_nodes)
+        else:
+            for i in range(len(threads)):
+                self._thread_finished(finished.get())
+
+        report = _metrics_report(sorted_nodes, threads, self._edges(sorted_nodes), sorted_nodes)
+        self.metrics = self._build_metrics([report], sorted_nodes, time.time() - start)
+
+        self._raise_exceptions()
+
+    def _wait_with_checkpoints(self, finished, count, sorted_nodes):
+        """Wait for `count` threads from the `finished` queue and request a checkpoint from the
+        source nodes every `checkpoint_interval` seconds."""
+
+        sources = [node for node in sorted_nodes if not self.node_sources(node)]
+        next_checkpoint = time.time() + self.checkpoint_interval
+
+        while count:
+            timeout = max(next_checkpoint - time.time(), 0)
+            try:
+                thread = finished.get(True, timeout)
+            except Queue.Empty:
+                self._checkpointer.request(sources)
+                next_checkpoint = time.time() + self.checkpoint_interval
+                continue
+
+            self._thread_finished(thread)
+            count -= 1
+
+    def _run_processes(self):
+        """Run the stream using worker processes. Worker processes are forked first, then the
+        nodes of the stream process are run in threads."""
+
+        self.logger.info("running stream in worker processes")
+
+        sorted_nodes = self.sorted_nodes()
+        start = time.time()
+        edges = self._edges(sorted_nodes)
+
+        group_nodes = {}
+        local_nodes = []
+        for node in sorted_nodes:
+            if node in self._fused_nodes:
+                continue
+            group = self._node_groups[node]
+            if group is None:
+                local_nodes.append(node)
+            else:
+                group_nodes.setdefault(group, []).append(node)
+
+        results = multiprocessing.Queue()
+        processes = {}
+
+        # Fork before any thread is started in this process
+        for (group, nodes) in group_nodes.items():
+            self.logger.debug("launching process for group %s (%s)"
+                                % (group, ", ".join(node_label(node) for node in nodes)))
+            process = multiprocessing.Process(target=_run_node_group,
+                                              args=(group, nodes, sorted_nodes, edges, results))
+            process.daemon = True
+            process.start()
+            processes[group] = process
 
         self.exceptions = []
-        for (thread, node) in threads:
-            self.logger.debug("joining thread for %s" % node_label(node))
-            while True:
-                thread.join(JOIN_TIMEOUT)
-                if thread.isAlive():
-                    pass
-                    # self.logger.debug("thread join timed out")
-                else:
-                    if thread.exception:
-                        self._add_thread_exception(thread)
-                    else:
-                        self.logger.debug("thread joined")
+
+        finished = Queue.Queue()
+        threads = []
+        for node in local_nodes:
+            self.logger.debug("launching thread for node %s" % node_label(node))
+            thread = _StreamNodeThread(node, finished)
+            thread.start()
+            threads.append(thread)
+        running_threads = len(threads)
+
+        # Collect results from the workers. A result contains list of tuples (`node index`,
+        # `exception`, `traceback string`) for each failed node and a metrics report.
+        reports = []
+        pending = set(processes.keys())
+        while pending:
+            # Local threads
+            while running_threads:
+                try:
+                    thread = finished.get_nowait()
+                except Queue.Empty:
                     break
-                if self.exceptions:
-                    self.logger.info("node exception occured, trying to kill threads")
-                    self.kill_threads()
+                running_threads -= 1
+                self._thread_finished(thread)
 
+            try:
+                (group, failures, report) = results.get(True, PROCESS_POLL_INTERVAL)
+            except Queue.Empty:
+                for group in list(pending):
+                    process = processes[group]
+                    if not process.is_alive() and results.empty():
+                        # Process died without reporting - no usable traceback
+                        pending.discard(group)
+                        exception = StreamError("Worker process of group %s terminated "
+                                                "unexpectedly (exit code %s)"
+                                                % (group, process.exitcode))
+                        self._add_failure(group_nodes[group][0], exception)
+                continue
+
+            pending.discard(group)
+            reports.append(report)
+            for (index, exception, tb) in failures:
+                self._add_failure(sorted_nodes[index], exception, tb)
+
+        for process in processes.values():
+            process.join()
+
+        for i in range(running_threads):
+            self._thread_finished(finished.get())
+
+        heads = self._thread_heads(sorted_nodes)
+        local_nodes = set(local_nodes)
+        nodes = [node for node in sorted_nodes if heads[node] in local_nodes]
+        reports.append(_metrics_report(nodes, threads, edges, sorted_nodes))
+        self.metrics = self._build_metrics(reports, sorted_nodes, time.time() - start)
+
+        self._raise_exceptions()
+
+    def _raise_exceptions(self):
         if self.exceptions:
             self.logger.info("run finished with exception")
             # Raising only first exception found
@@ -632,14 +1737,32 @@ class Stream(object):
         else:
             self.logger.info("run finished sucessfully")
 
+    def _thread_finished(self, thread):
+        """Join finished node `thread` and handle its exception."""
+        thread.join()
+        self.logger.debug("thread for %s joined" % node_label(thread.node))
+        if thread.exception:
+            self._add_failure(thread.failed_node, thread.exception, thread.traceback)
+
+    def _add_failure(self, node, exception, traceback=None):
+        """Record node failure. The whole stream is stopped on the first failure."""
+        first = not self.exceptions
+        self._add_node_exception(node, exception, traceback)
+        if first:
+            self.logger.info("node exception occured, killing threads")
+            self.kill_threads()
+
     def _add_thread_exception(self, thread):
+        """Create a StreamRuntimeError exception object for exception raised in `thread`."""
+        self._add_node_exception(thread.failed_node, thread.exception, thread.traceback)
+
+    def _add_node_exception(self, node, node_exception, traceback=None):
         """Create a StreamRuntimeError exception object and fill attributes with all necessary
         values.
         """
-        node = thread.node
-        exception = StreamRuntimeError(node=node, exception=thread.exception)
+        exception = StreamRuntimeError(node=node, exception=node_exception)
 
-        exception.traceback = thread.traceback
+        exception.traceback = traceback
         exception.inputs = [pipe.fields for pipe in node.inputs]
 
         if not isinstance(node, TargetNode):
@@ -668,65 +1791,304 @@ class Stream(object):
         self.exceptions.append(exception)
 
 
+    def _make_cancel_callback(self, node):
+        """Return function to be called when an output pipe of `node` is closed by its receiving
+        side. When all outputs of the node are closed, nobody wants data from the node, so the
+        node inputs are closed too - cancellation propagates upstream to the source nodes."""
+
+        def cancel(pipe):
+            if all(output.closed() for output in node.outputs):
+                self.logger.debug("all outputs of %s are closed, closing its inputs"
+                                    % node_label(node))
+                for input_pipe in node.inputs:
+                    if not input_pipe.closed():
+                        input_pipe.done_receiving()
+        return cancel
+
     def kill_threads(self):
+        """Stop all nodes of the stream: close all pipes, so the nodes stop receiving data and
+        raise `NodeFinished` on next ``put()``."""
         self.logger.info("killing threads")
+        for pipe in self.pipes:
+            pipe.on_done_receiving = None
+            pipe.done_receiving()
+
+    def _finalize(self, failed=False):
+        """Finalize all nodes. If the run `failed`, nodes are aborted first, so they can discard
+        uncommitted output (see :meth:`brewery.nodes.Node.abort`)."""
+
+        if failed:
+            self.logger.info("aborting nodes")
+            for node in self.sorted_nodes():
+                node.abort()
 
-    def _finalize(self):
         self.logger.info("finalizing nodes")
 
         # FIXME: encapsulate finalization in exception handler, collect exceptions
         for node in self.sorted_nodes():
             self.logger.debug("finalizing node %s" % node_label(node))
             node.finalize()
+
+def _supports_checkpoints(node):
+    """Return ``True`` if `node` can be checkpointed."""
+    return node.supports_checkpoints and node.workers <= 1 and len(node.inputs) <= 1
+
+def load_checkpoint(path):
+    """Return dictionary of node states from checkpoint file `path` or ``None`` if the file does
+    not exist. Keys are node names or positions of unnamed nodes in the sorted node list."""
+
+    if not os.path.exists(path):
+        return None
+
+    with open(path, "rb") as handle:
+        checkpoint = pickle.load(handle)
+
+    if checkpoint.get("version") != CHECKPOINT_VERSION:
+        raise StreamError("Unsupported version of checkpoint file %s" % path)
+
+    states = {}
+    for (key, state) in checkpoint["states"].items():
+        states[key] = pickle.loads(state)
+    return states
+
+class _Checkpointer(object):
+    """Collects states of nodes reached by checkpoint barriers and writes complete checkpoints
+    into a file. A checkpoint is complete when all nodes reached its barrier."""
+
+    def __init__(self, path, keys):
+        """Creates a checkpointer writing into file `path`. `keys` is a dictionary of node keys
+        used in the file."""
+        self.path = path
+        self.keys = keys
+        self.number = 0
+        self.completed = 0
+        self.states = {}
+        self.lock = threading.Lock()
+        self.logger = get_logger()
+
+    def request(self, sources):
+        """Request next checkpoint from `sources` - nodes without inputs. Nothing is requested
+        while the previous checkpoint is not complete."""
+        if self.completed < self.number:
+            self.logger.debug("checkpoint %d is not complete yet" % self.number)
+            return
+
+        self.number += 1
+        self.states = {}
+        self.logger.debug("requesting checkpoint %d" % self.number)
+        for node in sources:
+            node._barrier_request = self.number
+
+    def node_reached(self, node, number, state):
+        """Record `state` of `node` for checkpoint `number`. Called from the node's thread, the
+        state is pickled immediately."""
+
+        data = pickle.dumps(state, pickle.HIGHEST_PROTOCOL)
+
+        self.lock.acquire()
+        try:
+            if number != self.number:
+                return
+            self.states[self.keys[node]] = data
+            if len(self.states) == len(self.keys):
+                self._write()
+                self.completed = number
+        finally:
+            self.lock.release()
+
+    def _write(self):
+        checkpoint = {
+            "version": CHECKPOINT_VERSION,
+            "number": self.number,
+            "time": time.time(),
+            "states": self.states
+        }
+
+        # Replace the previous checkpoint atomically
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "wb") as handle:
+            pickle.dump(checkpoint, handle, pickle.HIGHEST_PROTOCOL)
+            handle.flush()
+            os.fsync(handle.fileno())
+        os.rename(temp_path, self.path)
+
+        self.logger.info("checkpoint %d written" % self.number)
+
+def _implements_process_row(node):
+    """Return ``True`` if `node` provides its own ``process_row()`` method."""
+    method = getattr(type(node), "process_row", None)
+    return method is not None and method.im_func is not Node.process_row.im_func
+
 def node_label(node):
     """Debug label for a node: node identifier with python object id."""
     return "%s(%s)" % (node.identifier() or str(type(node)), id(node))
     
 class _StreamNodeThread(threading.Thread):
-    def __init__(self, node):
-        """Creates a stream node thread.
+    def __init__(self, node, finished=None):
+        """Creates a stream node thread. If `finished` queue is specified, the thread puts itself
+        into the queue when it is finished.
         
         :Attributes:
             * `node`: a Node object
             * `exception`: attribute will contain exception if one occurs during run()
             * `traceback`: will contain traceback if exception occurs
+            * `failed_node`: node that raised the exception - either `node` or one of the nodes
+              fused with it
+            * `wall_time`, `cpu_time`: wall time and CPU time of the thread in seconds
         
         """
         super(_StreamNodeThread, self).__init__()
         self.node = node
         self.exception = None
         self.traceback = None
+        self.failed_node = None
+        self.wall_time = 0.0
+        self.cpu_time = None
+        self.finished = finished
         self.logger = get_logger()
 
     def run(self):
         """Wrapper method for running a node"""
-        
+
+        start = time.time()
+        cpu_start = thread_cpu_time()
+        try:
+            self._run_node()
+        finally:
+            self.wall_time = time.time() - start
+            if cpu_start is not None:
+                self.cpu_time = thread_cpu_time() - cpu_start
+            if self.finished is not None:
+                self.finished.put(self)
+
+    def _run_node(self):
         label = node_label(self.node)
         self.logger.debug("%s: start" % label)
         try:
+            if isinstance(self.node, SourceNode):
+                self.node.apply_key_filters()
             self.node.run()
         except NodeFinished as e:
             self.logger.info("node %s finished" % (label))
         except Exception as e:
-            tb = sys.exc_info()[2]
-            self.traceback = tb
+            self._set_exception(e)
 
-            self.logger.debug("node %s failed: %s" % (label, e.__class__.__name__), exc_info=sys.exc_info)
-            self.exception = e
-
-        # Flush pipes after node is finished
+        # Flush pipes after node is finished. Nodes fused with this node process rest of their
+        # data here.
         self.logger.debug("%s: finished" % label)
         self.logger.debug("%s: flushing outputs" % label)
         for pipe in self.node.outputs:
             if not pipe.closed():
-                pipe.done_sending()
+                try:
+                    pipe.done_sending()
+                except Exception as e:
+                    if not self.exception:
+                        self._set_exception(e)
         self.logger.debug("%s: flushed" % label)
         self.logger.debug("%s: stopping inputs" % label)
         for pipe in self.node.inputs:
             if not pipe.closed():
-                pipe.done_sending()
+                pipe.done_receiving()
         self.logger.debug("%s: stopped" % self)
 
+    def _set_exception(self, exception):
+        """Store `exception` raised in the node thread together with the node that failed."""
+        if isinstance(exception, _FusedNodeError):
+            self.logger.debug("fused node %s failed: %s"
+                                % (node_label(exception.node),
+                                   exception.exception.__class__.__name__))
+            self.failed_node = exception.node
+            self.exception = exception.exception
+            self.traceback = exception.traceback
+        else:
+            self.logger.debug("node %s failed: %s"
+                                % (node_label(self.node), exception.__class__.__name__),
+                              exc_info=True)
+            self.failed_node = self.node
+            self.exception = exception
+            self.traceback = sys.exc_info()[2]
+
+def _metrics_report(nodes, threads, edges, sorted_nodes):
+    """Collect metrics counters of `nodes` which were run in this process by `threads`. `edges`
+    is a list of (`source index`, `target index`, `pipe`). Report is a dictionary with keys:
+
+    * ``threads`` - dictionary of (`wall time`, `cpu time`) by thread node index
+    * ``sent`` - sending side counters of pipes by (`source index`, `target index`)
+    * ``received`` - receiving side counters of pipes by (`source index`, `target index`)
+    * ``caches`` - (`hits`, `misses`) of node caches by node index
+    """
+    index = dict((node, i) for (i, node) in enumerate(sorted_nodes))
+    indexes = set(index[node] for node in nodes)
+
+    report = {"threads": {}, "sent": {}, "received": {}, "caches": {}}
+    for thread in threads:
+        report["threads"][index[thread.node]] = (thread.wall_time, thread.cpu_time)
+
+    for node in nodes:
+        if node._cache is not None:
+            report["caches"][index[node]] = (node.cache_hits, node.cache_misses)
+
+    for (source, target, pipe) in edges:
+        if source in indexes:
+            report["sent"][(source, target)] = {
+                "batches": pipe.batches_sent,
+                "rows": pipe.rows_sent,
+                "peak_buffered_rows": pipe.peak_buffered_rows,
+                "producer_wait_time": pipe.producer_wait_time
+            }
+        if target in indexes:
+            report["received"][(source, target)] = {
+                "rows": pipe.rows_received,
+                "consumer_wait_time": pipe.consumer_wait_time
+            }
+
+    return report
+
+def _run_node_group(group, nodes, sorted_nodes, edges, results):
+    """Run `nodes` of a worker process `group`, each node in its own thread, and report failed
+    nodes and metrics counters to the `results` queue. Nodes are referenced by index in
+    `sorted_nodes`, `edges` are pipes as (`source index`, `target index`, `pipe`)."""
+
+    # Nodes fused with the group nodes are run in the group threads too
+    group_nodes = set(nodes)
+    for (source, target, pipe) in sorted(edges):
+        if isinstance(pipe, _FusedPipe) and sorted_nodes[source] in group_nodes:
+            group_nodes.add(sorted_nodes[target])
+
+    finished = Queue.Queue()
+    threads = []
+    for node in nodes:
+        thread = _StreamNodeThread(node, finished)
+        thread.start()
+        threads.append(thread)
+
+    failures = []
+    for i in range(len(threads)):
+        thread = finished.get()
+        thread.join()
+        if not thread.exception:
+            continue
+
+        if not failures:
+            # Stop the group on the first failure: close all pipes of the group nodes. Pipes
+            # shared with other processes are closed there as well.
+            for (source, target, pipe) in edges:
+                if sorted_nodes[source] in group_nodes or sorted_nodes[target] in group_nodes:
+                    pipe.on_done_receiving = None
+                    pipe.done_receiving()
+
+        exception = thread.exception
+        try:
+            pickle.dumps(exception)
+        except Exception:
+            exception = StreamError("%s: %s" % (exception.__class__.__name__, exception))
+
+        tb = "".join(traceback.format_tb(thread.traceback))
+        failures.append((sorted_nodes.index(thread.failed_node), exception, tb))
+
+    report = _metrics_report(group_nodes, threads, edges, sorted_nodes)
+    results.put((group, failures, report))
+
 class _StreamFork(object):
     """docstring for StreamFork"""
     def __init__(self, stream, node=None):
@@ -115,6 +115,16 @@ class DataSourceTestCase(unittest.TestCase):
         self.assertEqual(True, isinstance(self.rows[0][1], basestring))
         self.assertEqual(True, isinstance(self.rows[0][5], int))
     
+    def test_csv_prune_fields(self):
+        src = brewery.ds.CSVDataSource(self.data_file('test.csv'))
+        src.initialize()
+        self.assertTrue(src.prune_fields(set(["amount", "name", "unknown"])))
+        self.assertEqual(["name", "amount"], src.fields.names())
+
+        rows = list(src.rows())
+        self.assertEqual(8, len(rows))
+        self.assertEqual([u"apple", u"10"], rows[0])
+
     def test_xls_source(self):
         src = brewery.ds.XLSDataSource(self.data_file('test.xls'))
         src.initialize()
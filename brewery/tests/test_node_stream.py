@@ -7,6 +7,9 @@ import unittest
 import logging
 import time
 import StringIO
+import tempfile
+import os
+import shutil
 
 from brewery.streams import *
 from brewery.nodes import *
@@ -57,6 +60,27 @@ class StreamBuildingTestCase(unittest.TestCase):
         self.assertEqual(3, len(self.stream.nodes))
         self.assertEqual(1, len(self.stream.connections))
 
+    def test_adjacency(self):
+        self.assertEqual(set([self.node2, self.node3]), set(self.stream.node_targets("source")))
+        self.assertEqual([self.node1], self.stream.node_sources("sample"))
+        self.assertEqual([], self.stream.node_sources("source"))
+
+        sorted_nodes = self.stream.sorted_nodes()
+        # Cached order is not affected by changes of the returned list
+        sorted_nodes.reverse()
+        self.assertEqual(self.node1, self.stream.sorted_nodes()[0])
+
+        self.stream.remove_connection("source", "sample")
+        self.assertEqual([self.node2], self.stream.node_targets("source"))
+        self.assertEqual([], self.stream.node_sources("sample"))
+        self.assertEqual(2, len(self.stream.connections))
+
+        self.stream.remove("sample")
+        self.assertEqual([], self.stream.node_sources("html_target"))
+        self.assertEqual(3, len(self.stream.sorted_nodes()))
+        self.assertEqual(None, self.stream.node_name(self.node3))
+        self.assertEqual("source", self.stream.node_name(self.node1))
+
     def test_node_sort(self):
         # FIXME: This test is bugged
         sorted_nodes = self.stream.sorted_nodes()
@@ -94,6 +118,30 @@ class StreamBuildingTestCase(unittest.TestCase):
         node = stream.node("aggregate")
         self.assertEqual(["str"], node.keys)
 
+    def test_connection_options(self):
+        nodes = {
+                "source": {"type": "row_list_source"},
+                "target": {"type": "record_list_target"}
+            }
+        connections = [
+                ("source", "target", {"depth": 8, "buffer_size": 100})
+            ]
+
+        stream = Stream()
+        stream.update(nodes, connections)
+        source = stream.node("source")
+        target = stream.node("target")
+        self.assertEqual({"depth": 8, "buffer_size": 100},
+                         stream.connection_options[(source, target)])
+
+        source.fields = brewery.FieldList(["i"])
+        stream._initialize()
+        self.assertEqual(8, target.input.depth)
+        self.assertEqual(100, target.input.buffer_size)
+
+        stream.remove_connection("source", "target")
+        self.assertEqual({}, stream.connection_options)
+
 class FailNode(Node):
     node_info = {
         "attributes": [ {"name":"message"} ]
@@ -105,6 +153,20 @@ class FailNode(Node):
         logging.debug("intentionally failing a node")
         raise Exception(self.message)
 
+class FailRowNode(Node):
+    node_info = {}
+
+    def process_row(self, row):
+        raise Exception("This is fail row node")
+
+class SlowNode(Node):
+    node_info = {}
+
+    def run(self):
+        for row in self.input.rows():
+            time.sleep(0.002)
+            self.put(row)
+
 class SlowSourceNode(Node):
     node_info = {}
     @property
@@ -117,6 +179,146 @@ class SlowSourceNode(Node):
                 self.put([i])
             time.sleep(0.05)
         
+class CountingSourceNode(Node):
+    node_info = {}
+
+    def __init__(self, count=1000000, delay=0):
+        super(CountingSourceNode, self).__init__()
+        self.count = count
+        self.delay = delay
+        self.sent = 0
+
+    @property
+    def output_fields(self):
+        return brewery.FieldList(["i"])
+
+    def run(self):
+        for i in range(0, self.count):
+            if self.delay and not i % 100:
+                time.sleep(self.delay)
+            self.put([i])
+            self.sent += 1
+
+class HoldNode(Node):
+    """Passes nothing until the input is finished."""
+    node_info = {}
+
+    def run(self):
+        rows = list(self.input.rows())
+        for row in rows:
+            self.put(row)
+
+class StopTargetNode(TargetNode):
+    node_info = {}
+
+    def run(self):
+        pass
+
+class FlakyNode(Node):
+    """Slowly passes rows and fails at row `fail_at`."""
+    node_info = {}
+    supports_checkpoints = True
+
+    def __init__(self, fail_at=None):
+        super(FlakyNode, self).__init__()
+        self.fail_at = fail_at
+        self.passed = 0
+
+    def run(self):
+        self.passed = 0
+        for row in self.input.rows():
+            if row[0] == self.fail_at:
+                raise Exception("This is flaky node and it failed as expected")
+            time.sleep(0.0005)
+            self.put(row)
+            self.passed += 1
+
+class AbortTargetNode(RowListTargetNode):
+    """Row list target that records whether it was aborted."""
+    node_info = {}
+
+    def __init__(self):
+        super(AbortTargetNode, self).__init__()
+        self.aborted = False
+
+    def abort(self):
+        self.aborted = True
+
+class FilteringDataSource(ds.DataSource):
+    """Data source that filters rows by equality and ordering conditions."""
+
+    operators = {
+        "==": lambda a, b: a == b,
+        "<": lambda a, b: a < b,
+        ">": lambda a, b: a > b,
+        ">=": lambda a, b: a >= b,
+        "in": lambda a, b: a in b
+    }
+
+    def __init__(self, rows, fields):
+        super(FilteringDataSource, self).__init__()
+        self.data = rows
+        self.fields = fields
+        self.conditions = []
+        self.aggregation = None
+
+    def push_filter(self, conditions):
+        for condition in conditions:
+            if condition[1] not in self.operators:
+                return False
+        self.conditions += conditions
+        return True
+
+    def push_aggregation(self, keys, measures, count_field):
+        for (field, names) in ds.measure_aggregations(measures):
+            if not set(names) <= set(["sum", "min", "max", "average"]):
+                return False
+        self.aggregation = (keys, measures)
+        self.detail_fields = self.fields
+        self.fields = ds.aggregated_fields(self.fields, keys, measures, count_field)
+        return True
+
+    def rows(self):
+        if self.aggregation:
+            return self.aggregated_rows()
+        else:
+            return self.filtered_rows(self.fields)
+
+    def filtered_rows(self, fields):
+        names = fields.names()
+        for row in self.data:
+            record = dict(zip(names, row))
+            for (field, operator, value) in self.conditions:
+                if not self.operators[operator](record[field], value):
+                    break
+            else:
+                yield row
+
+    def aggregated_rows(self):
+        (keys, measures) = self.aggregation
+        key_indexes = self.detail_fields.indexes(keys)
+        measures = ds.measure_aggregations(measures)
+        measure_indexes = self.detail_fields.indexes([field for (field, names) in measures])
+        groups = {}
+        order = []
+        for row in self.filtered_rows(self.detail_fields):
+            key = tuple(row[i] for i in key_indexes)
+            if key not in groups:
+                groups[key] = []
+                order.append(key)
+            groups[key].append(row)
+
+        for key in order:
+            rows = groups[key]
+            result = list(key)
+            for (i, (field, names)) in zip(measure_indexes, measures):
+                values = [row[i] for row in rows]
+                functions = {"sum": sum, "min": min, "max": max,
+                             "average": lambda values: float(sum(values)) / len(values)}
+                result += [functions[name](values) for name in names]
+            result.append(len(rows))
+            yield result
+
 class StreamInitializationTestCase(unittest.TestCase):
     def setUp(self):
         # Stream we have here:
@@ -175,6 +377,127 @@ class StreamInitializationTestCase(unittest.TestCase):
         expected = [{'record_count': 2, 'str': 'a'}, {'record_count': 1, 'str': 'b'}]
         self.assertEqual(expected, data)
         
+    def test_run_processes(self):
+        self.stream.run(executor="process", groups=[["sample", "map"]])
+
+        target = self.stream.node("target")
+        expected = [{'a': 1, 'b': 2, 'str': 'a'},
+                    {'a': 4, 'b': 5, 'str': 'b'},
+                    {'a': 7, 'b': 8, 'str': 'a'}]
+        self.assertEqual(expected, target.list)
+
+        target = self.stream.node("aggtarget")
+        expected = [{'record_count': 2, 'str': 'a'}, {'record_count': 1, 'str': 'b'}]
+        self.assertEqual(expected, target.list)
+
+    def test_run_fused(self):
+        self.stream.run()
+
+        # map is the only target of sample, it is run in the sample's thread
+        map_node = self.stream.node("map")
+        sample = self.stream.node("sample")
+        self.assertEqual(set([map_node]), self.stream._fused_nodes)
+        self.assertIsInstance(map_node.input, brewery.streams._FusedPipe)
+        self.assertIsInstance(sample.input, Pipe)
+
+        self.stream.fusion = False
+        self.stream.node("target").list[:] = []
+        self.stream.run()
+
+        self.assertEqual(set(), self.stream._fused_nodes)
+        self.assertIsInstance(map_node.input, Pipe)
+        expected = [{'a': 1, 'b': 2, 'str': 'a'},
+                    {'a': 4, 'b': 5, 'str': 'b'},
+                    {'a': 7, 'b': 8, 'str': 'a'}]
+        self.assertEqual(expected, self.stream.node("target").list)
+
+    def test_metrics(self):
+        self.stream.run()
+        self.assert_metrics(self.stream.metrics)
+
+    def test_metrics_processes(self):
+        self.stream.run(executor="process", groups=[["sample", "map"]])
+        self.assert_metrics(self.stream.metrics)
+
+    def test_cache_metrics(self):
+        for (workers, executor) in [(1, "thread"), (2, "thread"), (2, "process")]:
+            nodes = {
+                "source": RowListSourceNode([[i % 3] for i in range(30)],
+                                           brewery.FieldList(["i"])),
+                "derive": DeriveNode("i * 2", "double", workers=workers, pure=True),
+                "target": RecordListTargetNode()
+            }
+            stream = Stream(nodes, [("source", "derive"), ("derive", "target")])
+            stream.run(executor=executor)
+
+            metrics = stream.metrics.node("derive")
+            self.assertEqual(30, metrics.cache_hits + metrics.cache_misses)
+            self.assertGreaterEqual(metrics.cache_misses, 3)
+            self.assertEqual(None, stream.metrics.node("source").cache_hits)
+            self.assertEqual(60, sum(r["double"] for r in stream.node("target").records))
+
+    def assert_metrics(self, metrics):
+        self.assertIsInstance(metrics, brewery.StreamMetrics)
+        self.assertGreater(metrics.wall_time, 0)
+
+        self.assertEqual(0, metrics.node("source").rows_in)
+        self.assertEqual(3, metrics.node("source").rows_out)
+        self.assertEqual(3, metrics.node("target").rows_in)
+        self.assertEqual(2, metrics.node("aggtarget").rows_in)
+        self.assertEqual(3, metrics.node("map").rows_in)
+        self.assertEqual(3, metrics.node("map").rows_out)
+
+        # map is fused with sample
+        self.assertEqual("sample", metrics.node("map").thread)
+        self.assertEqual("source", metrics.node("source").thread)
+        self.assertGreater(metrics.node("source").wall_time, 0)
+
+        pipe = metrics.pipe("source", "aggregate")
+        self.assertEqual(3, pipe.rows)
+        self.assertEqual(1, pipe.batches)
+        self.assertEqual(5, len(metrics.pipes))
+
+        self.assertEqual(6, len(metrics.as_dict()["nodes"]))
+
+    def test_bottleneck_report(self):
+        self.assertRaises(StreamError, self.stream.bottleneck_report)
+
+        nodes = {
+            "source": RowListSourceNode([[i] for i in range(100)], brewery.FieldList(["i"])),
+            "slow": SlowNode(),
+            "strip": StringStripNode(),
+            "target": RecordListTargetNode(self.target_list)
+        }
+        connections = [
+            ("source", "slow"),
+            ("slow", "strip"),
+            ("strip", "target")
+        ]
+        stream = Stream(nodes, connections)
+        stream.run()
+
+        report = stream.bottleneck_report()
+        self.assertEqual("slow", report.bottleneck)
+        self.assertEqual(["slow", "strip"], report.bottleneck_nodes)
+        self.assertEqual(["source", "slow", "strip", "target"], report.critical_path)
+        self.assertEqual(["source"], [node["name"] for node in report.upstream])
+        self.assertGreaterEqual(report.busy_time, 0.2)
+        self.assertIn("bottleneck: slow + strip", str(report))
+
+    def test_adaptive_pipes(self):
+        self.stream.adaptive_pipes = True
+        self.stream.run()
+
+        sizes = self.stream.pipe_sizes()
+        connections = set((source, target) for (source, target, options) in sizes)
+        # sample -> map is fused
+        self.assertEqual(set([("source", "sample"), ("source", "aggregate"),
+                              ("map", "target"), ("aggregate", "aggtarget")]), connections)
+        for (source, target, options) in sizes:
+            self.assertIn("buffer_size", options)
+
+        self.assertTrue(self.stream.node("sample").input.adaptive)
+
     def test_run_removed(self):
         self.stream.remove("aggregate")
         self.stream.remove("aggtarget")
@@ -204,6 +527,395 @@ class StreamInitializationTestCase(unittest.TestCase):
             e.print_exception(handle)
             handle.close()
             
+    def test_fail_fused(self):
+        nodes = {
+            "source": RowListSourceNode(self.src_list, self.fields),
+            "strip": StringStripNode(),
+            "fail": FailRowNode(),
+            "target": RecordListTargetNode(self.target_list)
+        }
+        connections = [
+            ("source", "strip"),
+            ("strip", "fail"),
+            ("fail", "target")
+        ]
+        stream = Stream(nodes, connections)
+
+        try:
+            stream.run()
+        except StreamRuntimeError, e:
+            self.assertIs(nodes["fail"], e.node)
+            self.assertIn("fail row node", str(e))
+        else:
+            self.fail("StreamRuntimeError expected")
+
+    def test_cancel_upstream(self):
+        nodes = {
+            "source": CountingSourceNode(),
+            "hold": HoldNode(),
+            "target": StopTargetNode()
+        }
+        connections = [
+            ("source", "hold"),
+            ("hold", "target")
+        ]
+        stream = Stream(nodes, connections)
+        stream.run()
+
+        # hold has no open output, its input was closed and source stopped
+        self.assertLess(nodes["source"].sent, 100000)
+
+    def test_fail_abort(self):
+        nodes = {
+            "source": CountingSourceNode(count=100000, delay=0.01),
+            "fail": FailNode(),
+            "target": RecordListTargetNode(self.target_list)
+        }
+        connections = [
+            ("source", "fail"),
+            ("source", "target")
+        ]
+        stream = Stream(nodes, connections)
+
+        start = time.time()
+        self.assertRaises(StreamRuntimeError, stream.run)
+        self.assertLess(time.time() - start, 2)
+        self.assertLess(nodes["source"].sent, 100000)
+
+    def test_derive_workers(self):
+        fields = brewery.FieldList(["i"])
+        rows = [[i] for i in range(1000)]
+        expected = [[i, i * 2] for i in range(1000) if i % 3]
+
+        for worker_type in ["process", "thread"]:
+            derive = DeriveNode("i * 2", "double", workers=3, worker_type=worker_type)
+            select = FunctionSelectNode(lambda value: value % 3, ["i"], workers=2,
+                                        worker_type=worker_type)
+            target = RowListTargetNode()
+            nodes = {
+                "source": RowListSourceNode(rows, fields),
+                "derive": derive,
+                "select": select,
+                "target": target
+            }
+            stream = Stream(nodes)
+            stream.connect("source", "derive", buffer_size=10)
+            stream.connect("derive", "select", buffer_size=10)
+            stream.connect("select", "target")
+            stream.run()
+
+            # Nodes with workers are not fused
+            self.assertEqual(set(), stream._fused_nodes)
+            self.assertEqual(expected, target.rows)
+
+    def test_checkpoint_resume(self):
+        fields = brewery.FieldList(["i", "group"])
+        rows = [[i, i % 3] for i in range(2000)]
+
+        def create_stream(flaky, path):
+            nodes = {
+                "source": RowListSourceNode(rows, fields),
+                "flaky": flaky,
+                "derive": DeriveNode("i * 2", "double"),
+                "target": RowListTargetNode(),
+                "aggregate": AggregateNode(keys=["group"]),
+                "aggtarget": RowListTargetNode()
+            }
+            stream = Stream(nodes)
+            stream.connect("source", "flaky", buffer_size=50)
+            stream.connect("flaky", "derive")
+            stream.connect("derive", "target")
+            stream.connect("source", "aggregate", buffer_size=50)
+            stream.connect("aggregate", "aggtarget")
+            stream.checkpoint_path = path
+            stream.checkpoint_interval = 0.05
+            return stream
+
+        expected = create_stream(FlakyNode(), None)
+        expected.run()
+
+        (handle, path) = tempfile.mkstemp()
+        os.close(handle)
+        os.remove(path)
+
+        flaky = FlakyNode(fail_at=1500)
+        stream = create_stream(flaky, path)
+        self.assertRaises(StreamRuntimeError, stream.run)
+        self.assertTrue(os.path.exists(path))
+
+        flaky.fail_at = None
+        stream.run(resume=True)
+
+        self.assertFalse(os.path.exists(path))
+        # Rows before the checkpoint were not passed again
+        self.assertLess(flaky.passed, 2000)
+        for name in ["target", "aggtarget"]:
+            self.assertEqual(expected.node(name).rows, stream.node(name).rows)
+
+    def test_checkpoint_resume_changed_only(self):
+        fields = brewery.FieldList(["i", "group"])
+        directory = tempfile.mkdtemp()
+        state_path = os.path.join(directory, "aggregate.state")
+
+        def create_stream(rows, flaky, path=None):
+            stream = Stream()
+            stream.add(RowListSourceNode(rows, fields), "source")
+            stream.add(flaky, "flaky")
+            stream.add(AggregateNode(keys=["group"], measures=[("i", ["sum"])],
+                                     state_path=state_path, changed_only=True), "aggregate")
+            stream.add(RowListTargetNode(), "target")
+            stream.connect("source", "flaky", buffer_size=50)
+            stream.connect("flaky", "aggregate")
+            stream.connect("aggregate", "target")
+            stream.checkpoint_path = path
+            stream.checkpoint_interval = 0.05
+            return stream
+
+        try:
+            create_stream([[i, i % 5] for i in range(10)], FlakyNode()).run()
+
+            # Group 0 is changed before the checkpoint, group 1 after it
+            rows = [[i, 0] for i in range(1000)] + [[i, 1] for i in range(1000, 2000)]
+            flaky = FlakyNode(fail_at=1900)
+            stream = create_stream(rows, flaky, os.path.join(directory, "checkpoint"))
+            self.assertRaises(StreamRuntimeError, stream.run)
+
+            flaky.fail_at = None
+            stream.run(resume=True)
+            self.assertLess(flaky.passed, 1000)
+            self.assertEqual([[0, 499500 + 5, 1002], [1, 1499500 + 7, 1002]],
+                             stream.node("target").rows)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_abort_on_failure(self):
+        fields = brewery.FieldList(["i"])
+        rows = [[i] for i in range(10)]
+
+        stream = Stream()
+        stream.add(RowListSourceNode(rows, fields), "source")
+        stream.add(FlakyNode(fail_at=5), "flaky")
+        stream.add(AbortTargetNode(), "target")
+        stream.connect("source", "flaky")
+        stream.connect("flaky", "target")
+
+        self.assertRaises(StreamRuntimeError, stream.run)
+        self.assertTrue(stream.node("target").aborted)
+
+        stream.node("target").aborted = False
+        stream.node("flaky").fail_at = None
+        stream.run()
+        self.assertFalse(stream.node("target").aborted)
+
+    def test_resume_without_checkpoint(self):
+        stream = self.stream
+        self.assertRaises(StreamError, stream.run, resume=True)
+
+        stream.checkpoint_path = os.path.join(tempfile.gettempdir(), "no_such_checkpoint")
+        stream.run(resume=True)
+        self.assertEqual(3, len(stream.node("target").list))
+
+    def test_filter_pushdown(self):
+        fields = brewery.FieldList(["i", "group"])
+        rows = [[i, i % 3] for i in range(20)]
+
+        source = FilteringDataSource(rows, fields)
+        select = SelectNode("i >= 5 and i < 15 and i % 2 == 0")
+        set_select = SetSelectNode("group", [0, 1])
+        target = RowListTargetNode()
+        stream = Stream()
+        stream.add(StreamSourceNode(source), "source")
+        stream.add(select, "select")
+        stream.add(set_select, "set_select")
+        stream.add(target, "target")
+        stream.connect("source", "select")
+        stream.connect("select", "set_select")
+        stream.connect("set_select", "target")
+        stream.run()
+
+        expected = [("i", ">=", 5), ("i", "<", 15), ("group", "in", [0, 1])]
+        self.assertEqual(expected, source.conditions)
+        self.assertFalse(select.filter_pushed_down)
+        self.assertTrue(set_select.filter_pushed_down)
+        expected = [row for row in rows if 5 <= row[0] < 15 and row[0] % 2 == 0 and row[1] < 2]
+        self.assertEqual(expected, target.rows)
+
+        # Source passing data to more nodes is not filtered
+        source = FilteringDataSource(rows, fields)
+        nodes = {
+            "source": StreamSourceNode(source),
+            "select": SelectNode("i >= 5"),
+            "target": RowListTargetNode(),
+            "all": RowListTargetNode()
+        }
+        stream = Stream(nodes, [("source", "select"), ("select", "target"), ("source", "all")])
+        stream.run()
+        self.assertEqual([], source.conditions)
+        self.assertEqual(15, len(nodes["target"].rows))
+
+    def test_aggregation_pushdown(self):
+        fields = brewery.FieldList(["i", "group", "amount"])
+        rows = [[i, i % 3, i * 10] for i in range(20)]
+        results = []
+
+        for pushdown in [False, True]:
+            source = FilteringDataSource(rows, fields)
+            nodes = {
+                "source": StreamSourceNode(source),
+                "select": SetSelectNode("group", [1, 2]),
+                "aggregate": AggregateNode(keys=["group"], measures=["amount"]),
+                "target": RowListTargetNode()
+            }
+            connections = [("source", "select"), ("select", "aggregate"), ("aggregate", "target")]
+            stream = Stream(nodes, connections)
+            stream.pushdown = pushdown
+            stream.run()
+
+            self.assertEqual(pushdown, nodes["aggregate"].aggregation_pushed_down)
+            self.assertEqual(pushdown, source.aggregation is not None)
+            results.append(nodes["target"].rows)
+
+        self.assertEqual([[1, 700, 10, 190, 100.0, 7], [2, 570, 20, 170, 95.0, 6]],
+                         results[0])
+        self.assertEqual(results[0], results[1])
+
+        # Aggregation with functions that the source can not compute
+        source = FilteringDataSource(rows, fields)
+        nodes = {
+            "source": StreamSourceNode(source),
+            "aggregate": AggregateNode(keys=["group"], measures=[("amount", ["sum", "variance"])]),
+            "target": RowListTargetNode()
+        }
+        Stream(nodes, [("source", "aggregate"), ("aggregate", "target")]).run()
+        self.assertEqual(None, source.aggregation)
+        self.assertEqual([0, 630, 4200.0, 7], nodes["target"].rows[0])
+
+        # Aggregation is not pushed after a filter that stays in python
+        source = FilteringDataSource(rows, fields)
+        nodes = {
+            "source": StreamSourceNode(source),
+            "select": SelectNode("i > 5 and i % 2 == 0"),
+            "aggregate": AggregateNode(keys=["group"], measures=["amount"]),
+            "target": RowListTargetNode()
+        }
+        connections = [("source", "select"), ("select", "aggregate"), ("aggregate", "target")]
+        Stream(nodes, connections).run()
+        self.assertEqual(None, source.aggregation)
+        self.assertEqual(3, len(nodes["target"].rows))
+
+    def test_field_pruning(self):
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "test.csv")
+
+        source = CSVSourceNode(path)
+        target = RowListTargetNode()
+        nodes = {
+            "source": source,
+            "select": SetSelectNode("type", [u"vegetable"]),
+            "map": FieldMapNode(keep_fields=["name"], map_fields={"name": "product"}),
+            "target": target
+        }
+        stream = Stream(nodes, [("source", "select"), ("select", "map"), ("map", "target")])
+        stream.run()
+
+        self.assertEqual(["name", "type"], source.output_fields.names())
+        self.assertEqual(["product"], nodes["map"].output_fields.names())
+        expected = [[u"carrot"], [u"potato"], [u"onion"], [u"garlic"], [u"orange"]]
+        self.assertEqual(expected, target.rows)
+
+        # Target nodes use all fields
+        stream.remove("map")
+        stream.connect("select", "target")
+        stream.run()
+        self.assertEqual(6, len(source.output_fields))
+
+    def test_merge_size_hints(self):
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "test.csv")
+
+        labels = [[unicode(i), "label-%d" % i] for i in range(20)]
+        nodes = {
+            "products": CSVSourceNode(path),
+            "labels": RowListSourceNode(labels, brewery.FieldList(["id", "label"])),
+            "merge": MergeNode(joins=[(1, "id")]),
+            "target": RowListTargetNode()
+        }
+        connections = [("products", "merge"), ("labels", "merge"), ("merge", "target")]
+        stream = Stream(nodes, connections)
+        stream.run()
+
+        # The smaller CSV file is kept in memory, regardless of which input is master
+        merge = nodes["merge"]
+        products = merge.inputs.index(stream._edge_pipes[(nodes["products"], merge)])
+        labels = merge.inputs.index(stream._edge_pipes[(nodes["labels"], merge)])
+        self.assertEqual(8, merge.input_size_hints[products])
+        self.assertEqual(20, merge.input_size_hints[labels])
+        if products == merge.master:
+            self.assertEqual("master", merge.chosen_build_side)
+        else:
+            self.assertEqual("detail", merge.chosen_build_side)
+        self.assertEqual(8, len(nodes["target"].rows))
+
+    def test_merge_key_filters(self):
+        fields = brewery.FieldList(["id", "name"])
+        rows = [[i, "name-%d" % i] for i in range(100)]
+        labels = [[i, "label-%d" % i] for i in [3, 5, 7, 500]]
+
+        def run(audit=False, **options):
+            source = FilteringDataSource(rows, fields)
+            stream = Stream()
+            stream.add(StreamSourceNode(source), "source")
+            stream.add(RowListSourceNode(labels, brewery.FieldList(["id", "label"])), "labels")
+            stream.add(SelectNode("id >= 0"), "select")
+            # Labels are connected first, they are the first input
+            stream.add(MergeNode(joins=[(0, "id")], master=1, build_side="detail", **options),
+                       "merge")
+            stream.add(RowListTargetNode(), "target")
+            stream.connect("source", "select")
+            stream.connect("select", "merge")
+            stream.connect("labels", "merge")
+            stream.connect("merge", "target")
+            if audit:
+                # Source passes rows to another branch too
+                stream.add(RowListTargetNode(), "audit")
+                stream.connect("source", "audit")
+            stream.run()
+
+            self.assertEqual(labels[:3], [row[2:] for row in stream.node("target").rows])
+            if audit:
+                self.assertEqual(rows, stream.node("audit").rows)
+            key_conditions = [condition for condition in source.conditions
+                                            if condition[1] == "in"]
+            return (key_conditions, stream.metrics.pipe("source", "select").rows)
+
+        # Few keys are passed to the data source
+        (conditions, count) = run()
+        self.assertEqual([("id", "in", [3, 5, 7, 500])],
+                         [(field, op, sorted(keys)) for (field, op, keys) in conditions])
+        self.assertEqual(3, count)
+
+        # Other keys are checked by the source node
+        max_exact_keys = KeyFilter.max_exact_keys
+        KeyFilter.max_exact_keys = 2
+        try:
+            (conditions, count) = run()
+        finally:
+            KeyFilter.max_exact_keys = max_exact_keys
+        self.assertEqual([], conditions)
+        self.assertTrue(3 <= count < 10)
+
+        (conditions, count) = run(semi_join=False)
+        self.assertEqual([], conditions)
+        self.assertEqual(100, count)
+
+        # Filter would drop rows of the other branch
+        (conditions, count) = run(audit=True)
+        self.assertEqual([], conditions)
+        self.assertEqual(100, count)
+
+        # Details might be partitioned into temporary files
+        (conditions, count) = run(max_detail_rows=2)
+        self.assertEqual([], conditions)
+        self.assertEqual(100, count)
+
     def test_fail_with_slow_source(self):
         nodes = {
             "source": SlowSourceNode(),
@@ -218,7 +930,27 @@ class StreamInitializationTestCase(unittest.TestCase):
         stream = Stream(nodes, connections)
 
         self.assertRaises(StreamRuntimeError, stream.run)
-    
+
+    def test_fail_run_processes(self):
+        nodes = {
+            "source": SlowSourceNode(),
+            "fail": FailNode(),
+            "target": RecordListTargetNode(self.target_list)
+        }
+        connections = [
+            ("source", "fail"),
+            ("fail", "target")
+        ]
+        stream = Stream(nodes, connections)
+
+        try:
+            stream.run(executor="process")
+        except StreamRuntimeError, e:
+            self.assertIs(nodes["fail"], e.node)
+            self.assertIn("fail node", str(e))
+        else:
+            self.fail("StreamRuntimeError expected")
+
 class StreamConfigurationTestCase(unittest.TestCase):
     def test_create_node(self):
         self.assertEqual(RowListSourceNode, type(create_node("row_list_source")))
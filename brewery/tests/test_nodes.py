@@ -2,7 +2,12 @@
 # -*- coding: utf-8 -*-
 
 import unittest
+import tempfile
+import shutil
+import os
+import timeit
 import brewery
+import brewery.utils
 import brewery.ds as ds
 import brewery.nodes
 
@@ -215,7 +220,7 @@ class NodesTestCase(unittest.TestCase):
         self.create_distinct_sample()
 
         node.key_fields = ["type"]
-        node.add_measure("id", ["sum"])
+        node.add_measure("id", ["sum", "min", "max", "average"])
         self.initialize_node(node)
         
         fields = node.output_fields.names()
@@ -237,6 +242,8 @@ class NodesTestCase(unittest.TestCase):
 
         self.assertEqual([90, 450, 4500], sums)
         self.assertEqual([18,9,9], counts)
+        self.assertEqual([1, 10, 100], [result["id_min"] for result in results])
+        self.assertEqual([5.0, 50.0, 500.0], [result["id_average"] for result in results])
         
         # Test no keys - only counts
         node = brewery.nodes.AggregateNode()
@@ -249,7 +256,7 @@ class NodesTestCase(unittest.TestCase):
         self.initialize_node(node)
 
         fields = node.output_fields.names()
-        a = ['id_sum', 'id_min', 'id_max', 'id_average', 'record_count']
+        a = ['id_sum', 'record_count']
         self.assertEqual(a, fields)
 
         node.run()
@@ -268,6 +275,156 @@ class NodesTestCase(unittest.TestCase):
         self.assertEqual([5040], sums)
         self.assertAllRows()
 
+    def test_aggregate_functions(self):
+        self.input.empty()
+        self.input.fields = brewery.FieldList([("key", "string"), ("value", "integer")])
+        for row in [["a", 3], ["b", 4], ["a", None], ["a", 5], ["a", 3], ["c", None]]:
+            self.input.put(row)
+
+        aggregations = ["count", "sum", "min", "max", "avg", "count_distinct", "first", "last",
+                        "variance"]
+        node = brewery.nodes.AggregateNode(keys = ["key"], measures = [("value", aggregations)])
+        self.setup_node(node)
+        self.initialize_node(node)
+
+        fields = node.output_fields
+        self.assertEqual(["key"] + ["value_" + name for name in aggregations] + ["record_count"],
+                         fields.names())
+        self.assertEqual(["string", "integer", "integer", "integer", "integer", "float",
+                          "integer", "integer", "integer", "float", "integer"],
+                         [field.storage_type for field in fields])
+
+        node.run()
+        node.finalize()
+
+        expected = [["a", 3, 11, 3, 5, 11.0 / 3, 2, 3, 3, 4.0 / 3, 4],
+                    ["b", 1, 4, 4, 4, 4.0, 1, 4, 4, None, 1],
+                    ["c", 0, None, None, None, None, 0, None, None, None, 1]]
+        self.assertEqual(expected, self.output.buffer)
+
+        # Default aggregations
+        self.output.empty()
+        node = brewery.nodes.AggregateNode(measures = ["value"],
+                                           default_aggregations = ["max", "count"])
+        self.setup_node(node)
+        self.initialize_node(node)
+        self.assertEqual(["value_max", "value_count", "record_count"],
+                         node.output_fields.names())
+
+        node = brewery.nodes.AggregateNode(measures = ["value"])
+        node.add_measure("key", ["unknown"])
+        self.setup_node(node)
+        self.assertRaises(ValueError, self.initialize_node, node)
+
+    def test_parallel_aggregate(self):
+        results = []
+        for parallelism in [1, 3]:
+            node = brewery.nodes.AggregateNode(keys=["type", "class"], parallelism=parallelism)
+            self.setup_node(node)
+            self.output.empty()
+            self.create_distinct_sample()
+
+            node.add_measure("id", ["sum"])
+            self.initialize_node(node)
+            node.run()
+            node.finalize()
+            results.append(self.output.buffer)
+
+        self.assertEqual(4, len(results[0]))
+        self.assertEqual(results[0], results[1])
+
+    def test_aggregate_spill(self):
+        aggregations = ["sum", "min", "max", "average", "count_distinct", "first", "last",
+                        "variance"]
+        results = []
+        temp_dir = tempfile.mkdtemp()
+        for (max_groups, parallelism) in [(None, 1), (10, 1), (1, 1), (10, 2), (3, 3)]:
+            node = brewery.nodes.AggregateNode(keys = ["key"],
+                                               measures = [("value", aggregations)],
+                                               parallelism = parallelism,
+                                               max_groups = max_groups, spill_partitions = 4,
+                                               temp_dir = temp_dir)
+            self.setup_node(node)
+            self.output.empty()
+            self.input.empty()
+            self.input.fields = brewery.FieldList(["key", "value"])
+            for i in range(500):
+                self.input.put([(i * 7) % 37, i % 11])
+
+            self.initialize_node(node)
+            self.assertEqual(max_groups is None, node.supports_checkpoints)
+            node.run()
+            node.finalize()
+            if parallelism == 1:
+                self.assertEqual(max_groups is not None, node.spill_count > 0)
+            # Spill files and result files of workers are removed
+            self.assertEqual([], os.listdir(temp_dir))
+            results.append(self.output.buffer)
+
+        shutil.rmtree(temp_dir)
+        self.assertEqual(37, len(results[0]))
+        self.assertEqual(0, results[0][0][0])
+        self.assertEqual(7, results[0][1][0])
+        for result in results[1:]:
+            self.assertEqual(results[0], result)
+
+    def test_aggregate_state(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "aggregate.state")
+        days = [[["a", 1], ["b", 2]], [["a", 3], ["c", 4]], [["c", 5]]]
+        measures = [("value", ["sum", "max", "average"])]
+
+        def run(rows, changed_only = False, abort = False):
+            node = brewery.nodes.AggregateNode(keys = ["key"], measures = measures,
+                                               state_path = path, changed_only = changed_only)
+            self.setup_node(node)
+            self.output.empty()
+            self.input.empty()
+            self.input.fields = brewery.FieldList(["key", "value"])
+            for row in rows:
+                self.input.put(row)
+            self.initialize_node(node)
+            self.assertEqual(None, node.aggregation())
+            node.run()
+            # Stream aborts nodes when it fails
+            if abort:
+                node.abort()
+            node.finalize()
+            return self.output.buffer
+
+        try:
+            self.assertEqual([["a", 1, 1, 1.0, 1], ["b", 2, 2, 2.0, 1]], run(days[0]))
+            # State is not written when the stream fails
+            run(days[1], abort = True)
+            self.assertEqual([["a", 4, 3, 2.0, 2], ["b", 2, 2, 2.0, 1], ["c", 4, 4, 4.0, 1]],
+                             run(days[1]))
+            self.assertEqual(["aggregate.state"], os.listdir(directory))
+            self.assertEqual([["c", 9, 5, 4.5, 2]], run(days[2], changed_only = True))
+
+            measures = ["value"]
+            self.assertRaises(brewery.common.StreamError, run, [])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_parallel_distinct(self):
+        results = []
+        for parallelism in [1, 3]:
+            for discard in [False, True]:
+                node = brewery.nodes.DistinctNode(["type", "class"], discard=discard,
+                                                  parallelism=parallelism)
+                self.setup_node(node)
+                self.output.empty()
+                self.create_distinct_sample()
+
+                self.initialize_node(node)
+                node.run()
+                node.finalize()
+                results.append(self.output.buffer)
+
+        self.assertEqual(4, len(results[0]))
+        self.assertEqual(32, len(results[1]))
+        self.assertEqual(results[:2], results[2:])
+
     def assertAllRows(self, pipe = None):
         if not pipe:
             pipe = self.output
@@ -325,6 +482,31 @@ class NodesTestCase(unittest.TestCase):
 
         self.assertEqual(8, len(self.output.buffer)) 
 
+    def test_function_select_options(self):
+        def select_greater_than(value, threshold):
+            return value > threshold
+        def select_workers(value, workers):
+            return value > workers
+
+        node = brewery.nodes.FunctionSelectNode(select_greater_than, ["i"], True,
+                                                threshold = 7, workers = 2, pure = True)
+        self.assertEqual(True, node.discard)
+        self.assertEqual({"threshold": 7}, node.kwargs)
+        self.assertEqual(2, node.workers)
+        self.assertEqual(True, node.pure)
+
+        self.assertRaises(ValueError, brewery.nodes.FunctionSelectNode, select_workers, ["i"],
+                          workers = 7)
+
+        node = brewery.nodes.FunctionSelectNode(select_workers, ["i"])
+        node.kwargs = {"workers": 7}
+        self.setup_node(node)
+        self.create_sample(10)
+        self.initialize_node(node)
+        node.run()
+        node.finalize()
+        self.assertEqual([[8], [9]], [row[:1] for row in self.output.buffer])
+
     def test_select(self):
         def select_dict(**record):
             return record["i"] < 5
@@ -358,6 +540,31 @@ class NodesTestCase(unittest.TestCase):
         node.finalize()
         self.assertEqual(5, len(self.output.buffer)) 
 
+    def test_select_filter_conditions(self):
+        node = brewery.nodes.SelectNode(condition = "i >= 5 and 10 > i and type in ('a', 'b')")
+        expected = [("i", ">=", 5), ("i", "<", 10), ("type", "in", ["a", "b"])]
+        self.assertEqual((expected, True), node.filter_conditions())
+
+        node.condition = "0 < i <= 3 and type == None"
+        expected = [("i", ">", 0), ("i", "<=", 3), ("type", "==", None)]
+        self.assertEqual((expected, True), node.filter_conditions())
+
+        # Only some parts can be pushed
+        node.condition = "i > 5 and i % 2 == 0"
+        self.assertEqual(([("i", ">", 5)], False), node.filter_conditions())
+
+        node.condition = "i > 5 or type != 'a'"
+        self.assertEqual(None, node.filter_conditions())
+        node.condition = "type > 'a'"
+        self.assertEqual(None, node.filter_conditions())
+        node.condition = "type in 'abc'"
+        self.assertEqual(None, node.filter_conditions())
+        node.condition = lambda i: i > 5
+        self.assertEqual(None, node.filter_conditions())
+
+        node = brewery.nodes.SetSelectNode(field = "type", value_set = set(["a"]), discard = True)
+        self.assertEqual(([("type", "not in", ["a"])], True), node.filter_conditions())
+
     def test_derive(self):
         def derive_dict(**record):
             return record["i"] * 10
@@ -395,6 +602,103 @@ class NodesTestCase(unittest.TestCase):
         val = sum([row[4] for row in self.output.buffer])
         self.assertEqual(49500, val)
 
+        # Function called with positional arguments and expression with own variables
+        def derive_positional(i):
+            return i * 10
+
+        for formula in [derive_positional, "sum(value for value in [i] * 10)"]:
+            self.output.empty()
+            self.setup_node(node)
+            self.create_sample()
+            node.formula = formula
+            self.initialize_node(node)
+            node.run()
+            node.finalize()
+            val = sum([row[4] for row in self.output.buffer])
+            self.assertEqual(49500, val)
+
+    def test_pure_nodes(self):
+        calls = []
+        def tens(i):
+            calls.append(i)
+            return (i % 10) * 10
+
+        node = brewery.nodes.DeriveNode(formula = "(i % 10) * 10", pure = True)
+        self.setup_node(node)
+        self.create_sample()
+        self.initialize_node(node)
+        node.run()
+        node.finalize()
+        self.assertEqual(450 * 10, sum([row[4] for row in self.output.buffer]))
+        self.assertEqual(0, node.cache_hits)
+        self.assertEqual(100, node.cache_misses)
+
+        # Cache is keyed by values of the used field only
+        self.output.empty()
+        node.formula = tens
+        node.cache_size = 5
+        self.create_sample(custom = "x")
+        for i in range(100):
+            self.input.put([i // 10, 0.0, "item", "x"])
+        self.initialize_node(node)
+        node.run()
+        node.finalize()
+        self.assertEqual(450 * 20, sum([row[4] for row in self.output.buffer]))
+        self.assertEqual(90, node.cache_hits)
+        self.assertEqual(110, node.cache_misses)
+        self.assertEqual(110, len(calls))
+
+        node = brewery.nodes.FunctionSelectNode(lambda value: value < 1, fields = ["q"],
+                                                pure = True)
+        self.output.empty()
+        self.setup_node(node)
+        self.input.empty()
+        self.input.fields = brewery.FieldList(["q"])
+        for value in [0, 0.0, False, 1, 1.0, True, 0, 1]:
+            self.input.put([value])
+        self.initialize_node(node)
+        node.run()
+        node.finalize()
+        self.assertEqual([[0], [0.0], [False], [0]], self.output.buffer)
+        self.assertEqual(2, node.cache_hits)
+        self.assertEqual(6, node.cache_misses)
+
+        node = brewery.nodes.DeriveNode(formula = "i", pure = False)
+        self.setup_node(node)
+        self.create_sample()
+        self.initialize_node(node)
+        self.assertEqual(None, node.cache_hits)
+
+    def test_cache_eviction(self):
+        cache = brewery.utils.LRUCache(3)
+        for value in ["a", "b", "c", "a", "d", "a", "b"]:
+            self.assertEqual(value * 2, cache.get((value, ), lambda: value * 2))
+        # "a" was used again, so "b" was discarded for "d"
+        self.assertEqual(2, cache.hits)
+        self.assertEqual(5, cache.misses)
+        self.assertEqual(3, len(cache))
+
+        cache = brewery.utils.LRUCache(3, shared=True)
+        for value in [1, 1.0, 1, [1]]:
+            cache.get((value, ), lambda: value)
+        self.assertEqual(1, cache.hits)
+        self.assertEqual(3, cache.misses)
+        cache.hits += 2
+        self.assertEqual(3, cache.hits)
+
+    def test_cache_hit_cost(self):
+        # Hit should be cheaper than the cheapest cached transform - coalescing to a number
+        node = brewery.nodes.CoalesceValueToTypeNode()
+        cache = brewery.utils.LRUCache(10)
+        value = " 1.5 "
+        cache.get((value, ), node.coalesce_float, value)
+
+        hit = min(timeit.repeat(lambda: cache.get((value, ), node.coalesce_float, value),
+                                number=10000, repeat=5))
+        transform = min(timeit.repeat(lambda: node.coalesce_float(value),
+                                      number=10000, repeat=5))
+        self.assertLess(hit, transform)
+
     def test_set_select(self):
         node = brewery.nodes.SetSelectNode(field = "type", value_set = ["a"])
 
@@ -531,6 +835,239 @@ class NodesTestCase(unittest.TestCase):
         self.assertEqual(5, len(self.output.buffer[0]))
         self.assertEqual(input_len, len(self.output.buffer)) 
         
+    def test_merge_spill(self):
+        def merge(**options):
+            self.create_distinct_sample()
+            self.output.empty()
+
+            types = brewery.streams.SimpleDataPipe()
+            types.fields = brewery.FieldList(["type2", "name"])
+            for row in [["a", "apple"], ["b", "bananna"], ["c", "curry"]]:
+                types.put(row)
+
+            labels = brewery.streams.SimpleDataPipe()
+            labels.fields = brewery.FieldList(["id3", "label"])
+            for i in range(1, 10):
+                labels.put([i * 10, "label-%s" % i])
+
+            node = brewery.nodes.MergeNode(**options)
+            node.inputs = [self.input, types, labels]
+            node.outputs = [self.output]
+            node.joins = [(1, "type", "type2"), (2, "id", "id3")]
+            self.initialize_node(node)
+            node.run()
+            node.finalize()
+            return list(self.output.buffer)
+
+        expected = merge()
+        self.assertEqual(9, len(expected))
+
+        temp_dir = tempfile.mkdtemp()
+        try:
+            rows = merge(max_detail_rows=3, spill_partitions=4, temp_dir=temp_dir)
+            self.assertEqual(expected, rows)
+            self.assertEqual([], os.listdir(temp_dir))
+
+            rows = merge(max_detail_rows=1, spill_partitions=2, temp_dir=temp_dir)
+            self.assertEqual(expected, rows)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_merge_sort_merge(self):
+        def merge(master_rows, detail_rows, **options):
+            self.input.empty()
+            self.input.fields = brewery.FieldList(["id", "amount"])
+            for row in master_rows:
+                self.input.put(row)
+            self.output.empty()
+
+            detail = brewery.streams.SimpleDataPipe()
+            detail.fields = brewery.FieldList(["code", "name"])
+            for row in detail_rows:
+                detail.put(row)
+
+            node = brewery.nodes.MergeNode(joins=[(1, "id", "code")], **options)
+            node.inputs = [self.input, detail]
+            node.outputs = [self.output]
+            self.initialize_node(node)
+            node.run()
+            node.finalize()
+            return list(self.output.buffer)
+
+        master = [[1, 10], [2, 20], [2, 21], [4, 40], [5, 50], [7, 70]]
+        detail = [[0, "zero"], [2, "two"], [2, "second two"], [3, "three"], [4, "four"],
+                  [7, "seven"], [8, "eight"]]
+
+        expected = merge(master, detail)
+        self.assertEqual(6, len(expected))
+        self.assertEqual([2, 20, 2, "two"], expected[0])
+        self.assertEqual([2, 20, 2, "second two"], expected[1])
+        self.assertEqual(expected, merge(master, detail, method="sort_merge"))
+
+        unsorted = [[0, "zero"], [2, "two"], [4, "four"], [3, "three"], [7, "seven"]]
+        self.assertRaises(brewery.common.StreamError, merge, master, unsorted,
+                          method="sort_merge")
+        self.assertRaises(brewery.common.StreamError, merge, list(reversed(master)), detail,
+                          method="sort_merge")
+        self.assertRaises(ValueError, merge, master, detail, method="nested_loop")
+
+        rows = merge(master, detail, method="sort_merge", join_types={1: "full"})
+        self.assertEqual([None, None, 0, "zero"], rows[0])
+        self.assertEqual([1, 10, None, None], rows[1])
+        self.assertEqual([None, None, 3, "three"], rows[6])
+        self.assertEqual([None, None, 8, "eight"], rows[-1])
+        self.assertEqual(11, len(rows))
+
+    def test_merge_outer(self):
+        def merge(join_types, **options):
+            self.input.empty()
+            self.input.fields = brewery.FieldList(["id", "type"])
+            for row in [[1, "a"], [2, "b"], [3, "a"], [5, "c"]]:
+                self.input.put(row)
+            self.output.empty()
+
+            types = brewery.streams.SimpleDataPipe()
+            types.fields = brewery.FieldList(["type2", "name"])
+            for row in [["a", "apple"], ["a", "apricot"], ["c", "curry"], ["d", "dynamite"]]:
+                types.put(row)
+
+            labels = brewery.streams.SimpleDataPipe()
+            labels.fields = brewery.FieldList(["id3", "label"])
+            for row in [[1, "one"], [3, "three"], [4, "four"]]:
+                labels.put(row)
+
+            node = brewery.nodes.MergeNode(joins=[(1, "type", "type2"), (2, "id", "id3")],
+                                           join_types=join_types, **options)
+            node.inputs = [self.input, types, labels]
+            node.outputs = [self.output]
+            self.initialize_node(node)
+            node.run()
+            node.finalize()
+            return list(self.output.buffer)
+
+        rows = merge(None)
+        self.assertEqual([[1, "a", "a", "apple", 1, "one"],
+                          [1, "a", "a", "apricot", 1, "one"],
+                          [3, "a", "a", "apple", 3, "three"],
+                          [3, "a", "a", "apricot", 3, "three"]], rows)
+
+        rows = merge({1: "left", 2: "left"})
+        self.assertEqual(6, len(rows))
+        self.assertEqual([2, "b", None, None, None, None], rows[2])
+        self.assertEqual([5, "c", "c", "curry", None, None], rows[5])
+
+        rows = merge({1: "right"})
+        self.assertEqual(5, len(rows))
+        self.assertEqual([None, None, "d", "dynamite", None, None], rows[4])
+
+        full = merge({1: "full", 2: "full"})
+        self.assertEqual(8, len(full))
+        self.assertEqual([None, None, "d", "dynamite", None, None], full[6])
+        self.assertEqual([None, None, None, None, 4, "four"], full[7])
+
+        temp_dir = tempfile.mkdtemp()
+        try:
+            for join_types in [None, {1: "left"}, {1: "right", 2: "left"}, {1: "full", 2: "full"}]:
+                expected = merge(join_types)
+                self.assertEqual(expected, merge(join_types, max_detail_rows=3,
+                                                 spill_partitions=2, temp_dir=temp_dir))
+                self.assertEqual(expected, merge(join_types, max_detail_rows=1,
+                                                 spill_partitions=3, temp_dir=temp_dir))
+            self.assertEqual([], os.listdir(temp_dir))
+        finally:
+            shutil.rmtree(temp_dir)
+
+        self.assertRaises(ValueError, merge, {1: "outer"})
+
+    def test_merge_build_side(self):
+        def merge(master_rows, join_types=None, hints=None, max_matched_rows=None, **options):
+            self.input.empty()
+            self.input.fields = brewery.FieldList(["id", "type"])
+            for row in master_rows:
+                self.input.put(row)
+            self.output.empty()
+
+            detail = brewery.streams.SimpleDataPipe()
+            detail.fields = brewery.FieldList(["type2", "name"])
+            for row in [["a", "apple"], ["b", "bananna"], ["a", "apricot"], ["d", "dynamite"],
+                        ["e", "egg"]]:
+                detail.put(row)
+
+            node = brewery.nodes.MergeNode(joins=[(1, "type", "type2")], join_types=join_types,
+                                           **options)
+            node.size_sample_rows = 10
+            if max_matched_rows:
+                node.max_matched_rows = max_matched_rows
+            node.inputs = [self.input, detail]
+            node.outputs = [self.output]
+            self.initialize_node(node)
+            node.input_size_hints = hints
+            node.run()
+            node.finalize()
+            return (node.chosen_build_side, list(self.output.buffer))
+
+        master = [[1, "a"], [2, "c"], [3, "a"], [4, "b"]]
+        for join_types in [None, {1: "left"}, {1: "right"}, {1: "full"}]:
+            (side, expected) = merge(master, join_types, build_side="detail")
+            self.assertEqual("detail", side)
+            (side, rows) = merge(master, join_types, build_side="master")
+            self.assertEqual("master", side)
+            self.assertEqual(expected, rows)
+            # Matched detail rows are spilled
+            (side, rows) = merge(master, join_types, build_side="master", max_matched_rows=1)
+            self.assertEqual(expected, rows)
+
+        (side, rows) = merge(master, {1: "full"})
+        self.assertEqual("master", side)
+        self.assertEqual([1, "a", "a", "apple"], rows[0])
+        self.assertEqual([None, None, "e", "egg"], rows[-1])
+
+        # Detail input ends sooner than the master input
+        (side, rows) = merge(master * 2)
+        self.assertEqual("detail", side)
+        self.assertEqual(10, len(rows))
+
+        # Size hints take precedence over sampling
+        (side, rows) = merge(master, hints=[100, 5])
+        self.assertEqual("detail", side)
+        (side, rows) = merge(master * 2, hints=[8, 20])
+        self.assertEqual("master", side)
+
+    def test_key_filter(self):
+        fields = brewery.FieldList(["id", "name"])
+
+        key_filter = brewery.nodes.KeyFilter(["id"])
+        self.assertFalse(key_filter.finished)
+        key_filter.set_keys([1, 2, 3], 3)
+        self.assertTrue(key_filter.finished)
+        self.assertEqual([("id", "in", [1, 2, 3])], key_filter.conditions())
+        predicate = key_filter.predicate(fields)
+        self.assertTrue(predicate([2, "b"]))
+        self.assertTrue(predicate({"id": 3, "name": "c"}))
+        self.assertFalse(predicate([4, "d"]))
+
+        # Empty values are not passed to data sources
+        key_filter = brewery.nodes.KeyFilter(["id"])
+        key_filter.set_keys([1, None], 2)
+        self.assertEqual(None, key_filter.conditions())
+        self.assertTrue(key_filter.predicate(fields)([None, "x"]))
+
+        # Many keys are kept in a Bloom filter
+        key_filter = brewery.nodes.KeyFilter(["id", "name"])
+        keys = [(i, "item-%d" % i) for i in range(5000)]
+        key_filter.set_keys(keys, len(keys))
+        self.assertEqual(None, key_filter.keys)
+        self.assertEqual(None, key_filter.conditions())
+        predicate = key_filter.predicate(fields)
+        self.assertTrue(all(predicate(list(key)) for key in keys))
+        false_positives = [i for i in range(5000, 15000) if predicate([i, "item-%d" % i])]
+        self.assertTrue(len(false_positives) < 300)
+
+        key_filter = brewery.nodes.KeyFilter(["id"])
+        key_filter.cancel()
+        self.assertTrue(key_filter.finished)
+        self.assertFalse(key_filter.active)
+
     def test_generator_function(self):
         node = brewery.nodes.GeneratorFunctionSourceNode()
         def generator(start=0, end=10):
@@ -79,6 +79,66 @@ class PipeTestCase(unittest.TestCase):
         self.assertEqual(self.processed_count, 20)
         self.assertLess(self.sent_count, 1000)
 
+    def test_batches(self):
+        self.pipe = streams.Pipe(buffer_size = 10)
+
+        def producer():
+            self.pipe.put_batch(range(0, 5))
+            self.pipe.put_batch(range(5, 25))
+            self.pipe.put(25)
+            self.pipe.done_sending()
+
+        batches = []
+        def consumer():
+            for batch in self.pipe.batches():
+                batches.append(batch)
+
+        src = threading.Thread(target=producer)
+        target = threading.Thread(target=consumer)
+        src.start()
+        target.start()
+        target.join()
+        src.join()
+
+        self.assertEqual([range(0, 5), range(5, 25), [25]], batches)
+
+    def test_depth(self):
+        self.pipe = streams.Pipe(buffer_size = 10, depth = 3)
+
+        # Producer is not blocked until there are depth batches waiting
+        self.send_sample(30)
+        self.assertEqual(3, len(self.pipe._ready))
+
+        self.pipe.done_sending()
+        self.target_function()
+        self.assertEqual(30, self.processed_count)
+
+        # Drained batches are reused
+        self.assertEqual(3, len(self.pipe._free))
+        self.assertEqual([], self.pipe._free[0])
+
+    def test_adaptive(self):
+        self.pipe = streams.Pipe(buffer_size = 10, adaptive = True, min_buffer_size = 10)
+        src = threading.Thread(target=self.source_function)
+        src.start()
+        self.target_function()
+        src.join()
+
+        self.assertEqual(1000, self.processed_count)
+        self.assertGreater(self.pipe.buffer_size, 10)
+        self.assertIsNotNone(self.pipe.row_size)
+
+        # Batches should not grow over the memory limit
+        self.pipe = streams.Pipe(buffer_size = 10, adaptive = True, min_buffer_size = 10,
+                                 max_memory = 1)
+        src = threading.Thread(target=self.source_function)
+        src.start()
+        self.target_function()
+        src.join()
+
+        self.assertEqual(1000, self.processed_count)
+        self.assertEqual(10, self.pipe.buffer_size)
+
 class Pipe2TestCase(unittest.TestCase):
 
     def setUp(self):
@@ -92,4 +92,98 @@ class SQLStreamsTestCase(unittest.TestCase):
 
         c = stream.table.c["line_item"]
 
-        self.assertEqual(123, c.type.length)
\ No newline at end of file
+        self.assertEqual(123, c.type.length)
+
+    def test_source_push_filter(self):
+        table = Table('values', self.metadata,
+                    Column('id', Integer, primary_key=True),
+                    Column('name', String(32))
+                )
+        self.metadata.create_all(self.engine)
+        rows = [(1, "a"), (2, "b"), (3, None), (4, "c")]
+        for row in rows:
+            self.engine.execute(table.insert().values(id=row[0], name=row[1]))
+
+        stream = ds.SQLDataSource(connection=self.engine, table="values")
+        self.assertEqual(4, stream.size_hint())
+        self.assertTrue(stream.push_filter([("id", ">", 1), ("name", "!=", "c")]))
+        self.assertEqual([(2, "b"), (3, None)], [tuple(row) for row in stream.rows()])
+        self.assertEqual(2, stream.size_hint())
+
+        stream = ds.SQLDataSource(connection=self.engine, table="values")
+        self.assertTrue(stream.push_filter([("name", "not in", ["a", "b"])]))
+        self.assertEqual([(3, None), (4, "c")], [tuple(row) for row in stream.rows()])
+
+        stream = ds.SQLDataSource(connection=self.engine, table="values")
+        self.assertFalse(stream.push_filter([("unknown", "==", 1)]))
+
+    def test_source_push_aggregation(self):
+        table = Table('amounts', self.metadata,
+                    Column('id', Integer, primary_key=True),
+                    Column('category', String(32)),
+                    Column('amount', Integer)
+                )
+        self.metadata.create_all(self.engine)
+        rows = [(1, "b", 10), (2, "a", 20), (3, "b", 30), (4, "c", 40)]
+        for row in rows:
+            self.engine.execute(table.insert().values(id=row[0], category=row[1], amount=row[2]))
+
+        stream = ds.SQLDataSource(connection=self.engine, table="amounts")
+        self.assertTrue(stream.push_filter([("amount", "<", 40)]))
+        self.assertTrue(stream.push_aggregation(["category"], ["amount"]))
+
+        names = ["category", "amount_sum", "amount_min", "amount_max", "amount_average",
+                 "record_count"]
+        self.assertEqual(names, stream.fields.names())
+        result = [tuple(row) for row in stream.rows()]
+        self.assertEqual([("b", 40, 10, 30, 20.0, 2), ("a", 20, 20, 20, 20.0, 1)], result)
+
+        stream = ds.SQLDataSource(connection=self.engine, table="amounts")
+        self.assertTrue(stream.push_aggregation([], [("amount", ["count", "count_distinct"])]))
+        self.assertEqual([(4, 4, 4)], [tuple(row) for row in stream.rows()])
+
+        stream = ds.SQLDataSource(connection=self.engine, table="amounts")
+        self.assertFalse(stream.push_aggregation([], [("amount", ["variance"])]))
+
+        # Groups could not be ordered by their first row
+        table = Table('no_key', self.metadata,
+                    Column('category', String(32)),
+                    Column('amount', Integer)
+                )
+        self.metadata.create_all(self.engine)
+        stream = ds.SQLDataSource(connection=self.engine, table="no_key")
+        self.assertFalse(stream.push_aggregation(["category"], ["amount"]))
+        self.assertTrue(stream.push_aggregation([], ["amount"]))
+
+    def test_target_transactional_rollback(self):
+        connection = self.engine.connect()
+        fields = brewery.metadata.FieldList([("id", "integer"), ("name", "string")])
+        stream = ds.SQLDataTarget(connection=connection, table="test", create=True,
+                                  fields=fields, buffer_size=1)
+        stream.initialize()
+        stream.transactional = True
+
+        stream.append((1, "a"))
+        self.assertEqual(1, stream.commit())
+        stream.append((2, "b"))
+        stream.append((3, "c"))
+        stream.rollback()
+        stream.finalize()
+
+        rows = connection.execute(stream.table.select()).fetchall()
+        self.assertEqual([(1, "a")], [tuple(row) for row in rows])
+
+    def test_source_seek(self):
+        table = Table('values', self.metadata,
+                    Column('id', Integer, primary_key=True),
+                    Column('name', String(32))
+                )
+        self.metadata.create_all(self.engine)
+        for row in [(3, "c"), (1, "a"), (2, "b")]:
+            self.engine.execute(table.insert().values(id=row[0], name=row[1]))
+
+        stream = ds.SQLDataSource(connection=self.engine, table="values")
+        self.assertFalse(stream.ordered)
+        stream.seek(1)
+        self.assertEqual([(2, "b"), (3, "c")], [tuple(row) for row in stream.rows()])
+        self.assertEqual(3, stream.position())
@@ -4,7 +4,13 @@
 """Brewery handy utilities"""
 
 import re
+import sys
+import time
 import logging
+import ast
+import inspect
+import threading
+import math
 
 logger_name = 'brewery'
 logger = None
@@ -97,5 +103,338 @@ def decamelize(name):
 
 def to_identifier(name):
     return re.sub(r' ', r'_', name).lower()
-    
 
+def expression_names(expression):
+    """Return set of variable names used in a python `expression` or ``None`` if the expression
+    can not be parsed."""
+    try:
+        tree = ast.parse(expression.strip(), mode="eval")
+    except SyntaxError:
+        return None
+
+    return set(node.id for node in ast.walk(tree) if isinstance(node, ast.Name))
+
+# Expression nodes with their own variables, which might shadow field names
+_scope_nodes = (ast.Lambda, ast.GeneratorExp, ast.ListComp, ast.SetComp, ast.DictComp)
+
+# Argument name of compiled row functions
+_ROW_ARGUMENT = "__row"
+
+def row_function(function, field_names, globals_dict=None, filename="<expression>"):
+    """Return a function of one argument - a row with values of fields `field_names` - that
+    evaluates `function` with the field values.
+
+    `function` is either a string with python expression where local variables are field values
+    or a callable with field names as argument names. Expressions are compiled into functions
+    that read values directly from the row by index. Callables without ``**kwargs`` are called
+    with positional arguments taken from the row. Otherwise a dictionary of field values is
+    created for each row. Other variables of expressions are taken from `globals_dict`.
+    """
+
+    indexes = dict((name, i) for (i, name) in enumerate(field_names))
+
+    if isinstance(function, basestring):
+        expression = function.strip()
+        tree = ast.parse(expression, filename, "eval")
+
+        if any(isinstance(node, _scope_nodes) for node in ast.walk(tree)):
+            code = compile(expression, filename, "eval")
+            def evaluate_record(row):
+                return eval(code, globals_dict, dict(zip(field_names, row)))
+            return evaluate_record
+
+        body = _RowIndexTransformer(indexes).visit(tree.body)
+        arguments = ast.arguments(args=[ast.Name(id=_ROW_ARGUMENT, ctx=ast.Param())],
+                                  vararg=None, kwarg=None, defaults=[])
+        tree = ast.Expression(body=ast.Lambda(args=arguments, body=body))
+        ast.fix_missing_locations(tree)
+
+        if globals_dict is None:
+            globals_dict = {}
+        return eval(compile(tree, filename, "eval"), globals_dict)
+
+    names = function_field_names(function, field_names)
+    if names is not None:
+        arg_indexes = [indexes[name] for name in names]
+        def call_positional(row):
+            return function(*[row[i] for i in arg_indexes])
+        return call_positional
+
+    def call_record(row):
+        return function(**dict(zip(field_names, row)))
+    return call_record
+
+def function_field_names(function, field_names):
+    """Return list of fields from `field_names` which values are used by `function` evaluated
+    with :func:`row_function` or ``None`` if the function might use all of them."""
+
+    if isinstance(function, basestring):
+        names = expression_names(function)
+        if names is None:
+            return None
+        return [name for name in field_names if name in names]
+
+    try:
+        argspec = inspect.getargspec(function)
+    except TypeError:
+        return None
+
+    if argspec.keywords or argspec.varargs:
+        return None
+
+    names = argspec.args
+    if inspect.ismethod(function) and function.im_self is not None:
+        names = names[1:]
+    if not all(name in field_names for name in names):
+        return None
+    return list(names)
+
+class _RowIndexTransformer(ast.NodeTransformer):
+    """Replaces variables of field names with subscripts of the row argument."""
+
+    def __init__(self, indexes):
+        self.indexes = indexes
+
+    def visit_Name(self, node):
+        index = self.indexes.get(node.id)
+        if index is None or not isinstance(node.ctx, ast.Load):
+            return node
+        row = ast.Name(id=_ROW_ARGUMENT, ctx=ast.Load())
+        subscript = ast.Subscript(value=row, slice=ast.Index(value=ast.Num(n=index)),
+                                  ctx=ast.Load())
+        return ast.copy_location(subscript, node)
+
+class LRUCache(object):
+    """Bounded cache of function results keyed by tuples of input values. When the cache is
+    full, a result that was not used recently is discarded. Results are chosen by the CLOCK
+    (second chance) approximation of least recently used order: cached results form a ring and
+    a result that was used since the clock hand passed it last time is spared once. A hit is a
+    dictionary lookup and a check of value types, results are not reordered.
+
+    Cache created with `shared` set to ``True`` might be used by several threads. It is locked
+    only when a computed result is inserted, not on hits.
+
+    Values of different types are cached separately, even if they are equal, as ``1``, ``1.0``
+    and ``True`` might give different results. Results for unhashable values are not cached.
+
+    :Attributes:
+        * `size`: maximal number of cached results
+        * `hits`: number of results taken from the cache
+        * `misses`: number of results that had to be computed
+    """
+
+    def __init__(self, size, shared=False):
+        super(LRUCache, self).__init__()
+        self.size = size
+        self.shared = shared
+        self.misses = 0
+        self._hits = 0
+
+        # Entries are lists [result, used since passed by the clock hand, value types,
+        # dictionary, key]. Results are keyed by values, results for values equal to cached
+        # values of other types are keyed by values and types in `_variants`.
+        self._items = {}
+        self._variants = {}
+        self._ring = []
+        self._hand = 0
+
+        # Hits of a shared cache are counted per thread, so the counters are exact without
+        # locking
+        self._thread_hits = []
+        if shared:
+            self._lock = threading.Lock()
+            self._local = threading.local()
+        else:
+            self._lock = None
+
+    def get(self, values, function, *args):
+        """Return result of ``function(*args)`` for the tuple of input `values`."""
+
+        try:
+            entry = self._items[values]
+        except KeyError:
+            entry = None
+        except TypeError:
+            # Unhashable values
+            self._count_miss()
+            return function(*args)
+
+        # Single values are checked without creating a tuple of types
+        if entry is not None and (type(values[0]) is not entry[2][0] if len(values) == 1
+                                  else _value_types(values) != entry[2]):
+            entry = self._variants.get(values + _value_types(values))
+
+        if entry is not None:
+            # Setting the flag concurrently is harmless, it is only a hint for the eviction
+            entry[1] = True
+            if self._lock is None:
+                self._hits += 1
+            else:
+                self._count_thread_hit()
+            return entry[0]
+
+        result = function(*args)
+
+        if self._lock is None:
+            self.misses += 1
+            self._insert(values, result)
+        else:
+            with self._lock:
+                self.misses += 1
+                self._insert(values, result)
+
+        return result
+
+    def _count_miss(self):
+        if self._lock is None:
+            self.misses += 1
+        else:
+            with self._lock:
+                self.misses += 1
+
+    def _count_thread_hit(self):
+        try:
+            counter = self._local.hits
+        except AttributeError:
+            counter = self._local.hits = [0]
+            with self._lock:
+                self._thread_hits.append(counter)
+        counter[0] += 1
+
+    def _insert(self, values, result):
+        types = _value_types(values)
+        entry = self._items.get(values)
+        if entry is None:
+            (items, key) = (self._items, values)
+        elif entry[2] == types:
+            # Inserted by another thread meanwhile
+            return
+        else:
+            (items, key) = (self._variants, values + types)
+            if key in items:
+                return
+
+        entry = [result, False, types, items, key]
+        ring = self._ring
+        if len(ring) < self.size:
+            ring.append(entry)
+        else:
+            hand = self._hand
+            while ring[hand][1]:
+                ring[hand][1] = False
+                hand = (hand + 1) % len(ring)
+            discarded = ring[hand]
+            del discarded[3][discarded[4]]
+            ring[hand] = entry
+            self._hand = (hand + 1) % len(ring)
+
+        items[key] = entry
+
+    @property
+    def hits(self):
+        return self._hits + sum(counter[0] for counter in self._thread_hits)
+
+    @hits.setter
+    def hits(self, value):
+        self._hits = value - sum(counter[0] for counter in self._thread_hits)
+
+    def clear(self):
+        """Remove all cached results and reset the counters."""
+        if self._lock:
+            self._lock.acquire()
+        try:
+            self._items.clear()
+            self._variants.clear()
+            del self._ring[:]
+            self._hand = 0
+            self.misses = 0
+            self._hits = 0
+            for counter in self._thread_hits:
+                counter[0] = 0
+        finally:
+            if self._lock:
+                self._lock.release()
+
+    def __len__(self):
+        return len(self._ring)
+
+def _value_types(values):
+    return tuple([type(value) for value in values])
+
+class BloomFilter(object):
+    """Compact set of hashable values that can only tell that a value is certainly not in the
+    set. Values that were added are always reported as contained, other values with probability
+    about `error_rate` when there are at most `capacity` values.
+
+    :Attributes:
+        * `size`: number of bits
+        * `hash_count`: number of bits set for each value
+    """
+
+    min_size = 1021
+
+    def __init__(self, capacity, error_rate=0.01):
+        super(BloomFilter, self).__init__()
+        capacity = max(capacity, 1)
+        size = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(int(round(float(size) / capacity * math.log(2))), 1)
+        # Hashes of python values are not random enough for few bits or for modulo by a power
+        # of two
+        self.size = max(size, self.min_size) | 1
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _indexes(self, value):
+        # Double hashing: i-th index is h1 + i * h2
+        first = hash((self.size, value))
+        second = hash((value, self.size)) | 1
+        for i in xrange(self.hash_count):
+            yield (first + i * second) % self.size
+
+    def add(self, value):
+        for index in self._indexes(value):
+            self.bits[index >> 3] |= 1 << (index & 7)
+
+    def __contains__(self, value):
+        bits = self.bits
+        for index in self._indexes(value):
+            if not bits[index >> 3] & (1 << (index & 7)):
+                return False
+        return True
+
+_clock_gettime = None
+
+def thread_cpu_time():
+    """Return CPU time in seconds consumed by the current thread or ``None`` if the platform does
+    not provide per-thread CPU time. Uses ``clock_gettime(CLOCK_THREAD_CPUTIME_ID)``."""
+    global _clock_gettime
+
+    if hasattr(time, "clock_gettime") and hasattr(time, "CLOCK_THREAD_CPUTIME_ID"):
+        return time.clock_gettime(time.CLOCK_THREAD_CPUTIME_ID)
+
+    if _clock_gettime is None:
+        _clock_gettime = False
+        # CLOCK_THREAD_CPUTIME_ID constant value is known only for Linux
+        if sys.platform.startswith("linux"):
+            try:
+                import ctypes
+                import ctypes.util
+
+                class _Timespec(ctypes.Structure):
+                    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+                library = ctypes.util.find_library("rt") or ctypes.util.find_library("c")
+                function = ctypes.CDLL(library).clock_gettime
+                function.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+                _clock_gettime = (function, _Timespec, ctypes.byref)
+            except (ImportError, OSError, AttributeError, TypeError):
+                pass
+
+    if not _clock_gettime:
+        return None
+
+    (function, timespec_class, byref) = _clock_gettime
+    timespec = timespec_class()
+    # 3 is CLOCK_THREAD_CPUTIME_ID
+    if function(3, byref(timespec)) != 0:
+        return None
+    return timespec.tv_sec + timespec.tv_nsec * 1e-9